@@ -0,0 +1,464 @@
+"""Local stand-ins for the CloudKit and Google Drive endpoints that pycloud uses, for offline benchmarks"""
+import json
+import time
+import uuid
+import email
+import base64
+import hashlib
+import random
+import threading
+import collections
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FOLDER = 'application/vnd.google-apps.folder'
+
+# Bytes written per write when simulating bandwidth
+WRITE_SIZE = 64 * 1024
+
+
+class Link:
+    """Network conditions of a fake server
+
+    :param latency: (float) seconds added before every response
+    :param bandwidth: (int) bytes per second of each response body, or None for unlimited
+    :param error_rate: (float) fraction of requests answered with a throttling error
+    :param seed: (int) seed of the error generator, so runs are repeatable
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fails(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        server = self.server.fake
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        server.count(self.command, url.path)
+
+        if server.link.latency:
+            time.sleep(server.link.latency)
+        if server.link.fails():
+            status, headers, content = server.throttled()
+        else:
+            status, headers, content = server.route(self.command, url.path, parse_qs(url.query), self.headers, body)
+        self._respond(status, headers, content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = _handle
+
+    def _respond(self, status, headers, content):
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode()
+            headers = {'Content-Type': 'application/json', **headers}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        bandwidth = self.server.fake.link.bandwidth
+        for i in range(0, len(content), WRITE_SIZE):
+            chunk = content[i:i + WRITE_SIZE]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+        self.server.fake.count_bytes(len(content))
+
+
+class FakeServer:
+    """Threaded HTTP server on localhost that counts requests and applies the conditions of a :class:`Link`"""
+
+    def __init__(self, link=None):
+        self.link = link or Link()
+        self.requests = collections.Counter()
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, method, path):
+        with self._lock:
+            self.requests[self.endpoint(method, path)] += 1
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def endpoint(self, method, path):
+        return f'{method} {path}'
+
+    def throttled(self):
+        return 503, {'Retry-After': '0'}, b''
+
+    def route(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+
+def _record_bytes(master_name, size):
+    """Content of a fake photo, cheap to generate and different for every photo"""
+    pattern = master_name.encode() + b'\n'
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+class FakeCloudKit(FakeServer):
+    """CloudKit photos database with an album of generated photos
+
+    Serves records/query (paged by startRank and direction, projected to desiredKeys), records/lookup,
+    records/modify deletes, the album count query, and asset downloads. Photos are one per ``spacing``
+    seconds, ending at ``newest``, and rank 0 is the oldest, like in iCloud.
+
+    :param photos: (int) number of photos in the album
+    :param sizes: (tuple) min and max size of a photo in bytes
+    :param newest: (float) timestamp of the newest photo
+    :param spacing: (float) seconds between photos
+    :param max_page: (int) max photos per records/query page, past which pages come back short
+    :param link: (Link) network conditions
+    :param seed: (int) seed of the generated sizes
+    """
+
+    ENDPOINT = '/database/1/com.apple.photos.cloud/production/private'
+
+    def __init__(self, photos=1000, sizes=(200 * 1024, 4 * 1024 * 1024), newest=None, spacing=3600.0,
+                 max_page=200, link=None, seed=0):
+        super().__init__(link)
+        self.max_page = max_page
+        rng = random.Random(seed)
+        newest = newest or time.time()
+        self.assets = []  # Sorted by rank
+        self.masters = {}
+        for rank in range(photos):
+            master_name = f'M{rank:08d}'
+            size = rng.randint(*sizes)
+            self.masters[master_name] = {
+                'recordName': master_name,
+                'recordType': 'CPLMaster',
+                'recordChangeTag': 'a',
+                'fields': {
+                    'filenameEnc': {'value': base64.b64encode(f'IMG_{rank:06d}.JPG'.encode()).decode()},
+                    'itemType': {'value': 'public.jpeg'},
+                    'resOriginalRes': {'value': {'size': size, 'downloadURL': None}},
+                    'resOriginalWidth': {'value': 4032},
+                    'resOriginalHeight': {'value': 3024},
+                    'resOriginalFileType': {'value': 'public.jpeg'},
+                    'resOriginalFingerprint': {'value': master_name},
+                    'resJPEGThumbRes': {'value': {'size': 20000, 'downloadURL': None}},
+                    'resJPEGThumbWidth': {'value': 320},
+                    'resJPEGThumbHeight': {'value': 240},
+                    'resJPEGThumbFileType': {'value': 'public.jpeg'},
+                },
+            }
+            self.assets.append({
+                'recordName': f'A{rank:08d}',
+                'recordType': 'CPLAsset',
+                'recordChangeTag': 'a',
+                'fields': {
+                    'assetDate': {'value': int((newest - (photos - 1 - rank) * spacing) * 1000)},
+                    'addedDate': {'value': int(newest * 1000)},
+                    'masterRef': {'value': {'recordName': master_name, 'zone': {'zoneName': 'PrimarySync'}}},
+                    'isFavorite': {'value': 0},
+                    'isHidden': {'value': 0},
+                },
+            })
+        self.deleted = set()
+
+    def start(self):
+        super().start()
+        for name, master in self.masters.items():
+            for key in ('resOriginalRes', 'resJPEGThumbRes'):
+                master['fields'][key]['value']['downloadURL'] = f'{self.url}/assets/{name}/{key}'
+        return self
+
+    @property
+    def endpoint_url(self):
+        return self.url + self.ENDPOINT
+
+    def endpoint(self, method, path):
+        if path.startswith('/assets/'):
+            return 'download'
+        return path.rsplit('/', 1)[-1] if path.startswith(self.ENDPOINT) else path
+
+    @staticmethod
+    def _project(record, keys):
+        if keys is None:
+            return record
+        return {**record, 'fields': {k: v for k, v in record['fields'].items() if k in keys}}
+
+    def route(self, method, path, query, headers, body):
+        if path.startswith('/assets/'):
+            _, _, name, key = path.split('/')
+            master = self.masters.get(name)
+            if master is None:
+                return 404, {}, b''
+            return 200, {'Content-Type': 'image/jpeg'}, _record_bytes(name, master['fields'][key]['value']['size'])
+
+        if not path.startswith(self.ENDPOINT):
+            return 404, {}, b''
+        request = json.loads(body or b'{}')
+        action = path[len(self.ENDPOINT):]
+        if action == '/records/query':
+            return 200, {}, self._query(request)
+        if action == '/records/lookup':
+            return 200, {}, self._lookup(request)
+        if action == '/records/modify':
+            return 200, {}, self._modify(request)
+        if action == '/internal/records/query/batch':
+            return 200, {}, {'batch': [{'records': [{'fields': {'itemCount': {'value': len(self.assets)}}}]}]}
+        return 404, {}, b''
+
+    def _query(self, request):
+        filters = {f['fieldName']: f['fieldValue']['value'] for f in request['query'].get('filterBy', [])}
+        rank = filters.get('startRank', 0)
+        step = -1 if filters.get('direction') == 'DESCENDING' else 1
+        count = min(request.get('resultsLimit', 200) // 2, self.max_page)
+        keys = set(request['desiredKeys']) if request.get('desiredKeys') else None
+
+        records = []
+        while count and 0 <= rank < len(self.assets):
+            asset = self.assets[rank]
+            master = self.masters[asset['fields']['masterRef']['value']['recordName']]
+            records.append(self._project(asset, keys))
+            records.append(self._project(master, keys))
+            rank += step
+            count -= 1
+        return {'records': records}
+
+    def _lookup(self, request):
+        assets = {asset['recordName']: asset for asset in self.assets}
+        keys = set(request['desiredKeys']) if request.get('desiredKeys') else None
+        records = []
+        for ref in request['records']:
+            name = ref['recordName']
+            record = assets.get(name) or self.masters.get(name)
+            if record is None:
+                records.append({'recordName': name, 'serverErrorCode': 'NOT_FOUND'})
+            else:
+                records.append(self._project(record, keys))
+        return {'records': records}
+
+    def _modify(self, request):
+        records, deleted = [], set()
+        for operation in request['operations']:
+            record = operation['record']
+            if record['fields'].get('isDeleted', {}).get('value'):
+                deleted.add(record['recordName'])
+            records.append({'recordName': record['recordName'], 'recordType': record['recordType'],
+                            'fields': record['fields']})
+        # Deleted photos drop out of the album, shifting the ranks after them
+        self.assets = [asset for asset in self.assets if asset['recordName'] not in deleted]
+        self.deleted |= deleted
+        return {'records': records}
+
+
+class FakeDrive(FakeServer):
+    """Google Drive v2 API with the files, about, changes, upload and batch endpoints that gDrive uses
+
+    Throttled requests are answered with a 403 userRateLimitExceeded error, like Drive does.
+
+    :param quota: (int) total storage in bytes
+    :param link: (Link) network conditions
+    """
+
+    def __init__(self, quota=15 * 1024 ** 4, link=None):
+        super().__init__(link)
+        self.quota = quota
+        self.used = 0
+        self.root_id = 'root-folder'
+        self.files = {}  # id -> files resource
+        self.changes = []  # (change id, file id)
+        self.sessions = {}  # upload id -> (metadata, bytearray of received content)
+        self._ids = iter(range(1, 1 << 62))
+
+    def endpoint(self, method, path):
+        if path.startswith('/upload/'):
+            return 'upload'
+        if path.startswith('/batch/'):
+            return 'batch'
+        return f'{method} {path.split("/")[3] if path.count("/") >= 3 else path}'
+
+    def throttled(self):
+        return 403, {}, {'error': {
+            'errors': [{'domain': 'usageLimits', 'reason': 'userRateLimitExceeded', 'message': 'Rate Limit Exceeded'}],
+            'code': 403,
+            'message': 'Rate Limit Exceeded',
+        }}
+
+    def _new_file(self, metadata, content=b''):
+        with self._lock:
+            file_id = f'F{next(self._ids):012d}'
+            self.used += len(content)
+            self.changes.append((len(self.changes) + 1, file_id))
+        parents = metadata.get('parents') or [{'id': self.root_id}]
+        file = {
+            'kind': 'drive#file',
+            'id': file_id,
+            'title': metadata.get('title', 'Untitled'),
+            'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+            'parents': [{'id': parent['id']} for parent in parents],
+            'labels': {'trashed': False},
+            'fileSize': str(len(content)),
+            'md5Checksum': None,
+        }
+        if file['mimeType'] == FOLDER:
+            del file['fileSize'], file['md5Checksum']
+        else:
+            file['md5Checksum'] = hashlib.md5(content).hexdigest()
+        self.files[file_id] = file
+        return file
+
+    def route(self, method, path, query, headers, body):
+        if path.startswith('/batch/'):
+            return self._batch(headers, body)
+        if path.startswith('/upload/drive/v2/files'):
+            return self._upload(method, query, headers, body)
+        if path == '/drive/v2/about':
+            return 200, {}, {
+                'kind': 'drive#about',
+                'rootFolderId': self.root_id,
+                'largestChangeId': str(len(self.changes)),
+                'quotaBytesTotal': str(self.quota),
+                'quotaBytesUsed': str(self.used),
+                'quotaBytesUsedInTrash': '0',
+            }
+        if path == '/drive/v2/changes':
+            return 200, {}, self._changes(query)
+        if path == '/drive/v2/files' and method == 'GET':
+            return 200, {}, self._list(query)
+        if path == '/drive/v2/files' and method == 'POST':
+            return 200, {}, self._new_file(json.loads(body or b'{}'))
+        if path.startswith('/drive/v2/files/') and method == 'GET':
+            file = self.files.get(path.rsplit('/', 1)[1])
+            return (200, {}, file) if file else (404, {}, b'')
+        return 404, {}, b''
+
+    @staticmethod
+    def _page(items, query):
+        start = int(query.get('pageToken', ['0'])[0])
+        size = int(query.get('maxResults', ['100'])[0])
+        page = {'items': items[start:start + size]}
+        if start + size < len(items):
+            page['nextPageToken'] = str(start + size)
+        return page
+
+    def _list(self, query):
+        q = query.get('q', [''])[0]
+        items = [file for file in self.files.values() if not file['labels']['trashed']]
+        for clause in q.split(' and '):
+            clause = clause.strip()
+            if clause.endswith(' in parents'):
+                parent_id = clause.split("'")[1]
+                items = [file for file in items if any(p['id'] == parent_id for p in file['parents'])]
+            elif clause.startswith('mimeType!='):
+                items = [file for file in items if file['mimeType'] != clause.split("'")[1]]
+            elif clause.startswith('mimeType='):
+                items = [file for file in items if file['mimeType'] == clause.split("'")[1]]
+        return self._page(items, query)
+
+    def _changes(self, query):
+        start = int(query.get('startChangeId', ['1'])[0])
+        items = [
+            {'kind': 'drive#change', 'id': str(change_id), 'fileId': file_id, 'deleted': False,
+             'file': self.files[file_id]}
+            for change_id, file_id in self.changes if change_id >= start
+        ]
+        page = self._page(items, query)
+        page['largestChangeId'] = str(len(self.changes))
+        return page
+
+    def _upload(self, method, query, headers, body):
+        upload_type = query.get('uploadType', [''])[0]
+        if method == 'POST' and upload_type == 'multipart':
+            message = email.message_from_bytes(
+                b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+            metadata_part, media_part = message.get_payload()
+            return 200, {}, self._new_file(json.loads(metadata_part.get_payload(decode=True)),
+                                           media_part.get_payload(decode=True))
+        if method == 'POST' and upload_type == 'resumable':
+            upload_id = uuid.uuid4().hex
+            self.sessions[upload_id] = (json.loads(body or b'{}'), bytearray())
+            return 200, {'Location': f'{self.url}/upload/drive/v2/files?uploadType=resumable&upload_id={upload_id}'}, b''
+        if method == 'PUT' and 'upload_id' in query:
+            return self._upload_chunk(query['upload_id'][0], headers, body)
+        return 400, {}, b''
+
+    def _upload_chunk(self, upload_id, headers, body):
+        if upload_id not in self.sessions:
+            return 404, {}, b''
+        metadata, content = self.sessions[upload_id]
+        # Content-Range is "bytes start-end/total", or "bytes */total" to ask for the committed offset
+        span, _, total = headers.get('Content-Range', 'bytes */*')[6:].partition('/')
+        if span != '*':
+            start = int(span.split('-')[0])
+            del content[start:]
+            content += body
+        if total != '*' and len(content) == int(total):
+            del self.sessions[upload_id]
+            return 200, {}, self._new_file(metadata, bytes(content))
+        range_header = {'Range': f'bytes=0-{len(content) - 1}'} if content else {}
+        return 308, range_header, b''
+
+    def _batch(self, headers, body):
+        message = email.message_from_bytes(
+            b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            if not isinstance(request, str):
+                request = request.as_string()
+            head, _, request_body = request.replace('\r\n', '\n').partition('\n\n')
+            method, target, _ = head.split('\n', 1)[0].split(' ', 2)
+            url = urlsplit(target)
+            status, _, content = self.route(method, url.path, parse_qs(url.query), {}, request_body.encode())
+            if isinstance(content, (dict, list)):
+                content = json.dumps(content)
+            else:
+                content = content.decode()
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n{content}\r\n'
+            )
+        content = (''.join(parts) + f'--{boundary}--\r\n').encode()
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, content
@@ -0,0 +1,252 @@
+"""Offline throughput benchmarks of pycloud against the local stand-ins in :mod:`benchmarks.fakes`
+
+Each scenario runs in its own process, so startup time and peak RSS are measured for pycloud alone,
+while the fake servers run in this one and count every request made to them::
+
+    python -m benchmarks.run --photos 500 --latency 0.02 --json results.json
+    python -m benchmarks.run --baseline results.json --tolerance 0.25  # Exits with 1 on a regression
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import datetime
+import tempfile
+import resource
+import subprocess
+
+from benchmarks.fakes import Link, FakeCloudKit, FakeDrive
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('listing', 'seek', 'transfer', 'stream')
+
+# Metrics where a higher value is a regression; for every other compared metric, lower is
+LOWER_IS_BETTER = ('seconds', 'requests_per_asset', 'peak_rss_mb', 'startup_seconds', 'setup_seconds')
+COMPARED = ('photos_per_sec', 'bytes_per_sec') + LOWER_IS_BETTER
+
+
+class _Credentials:
+    """OAuth credentials that authorize nothing, since the fake Drive doesn't check them"""
+
+    access_token = 'benchmark'
+    access_token_expired = False
+    invalid = False
+
+    def authorize(self, http):
+        return http
+
+
+def _drive(url, scheduler, workdir):
+    """gDrive service whose API and upload URLs point at a fake Drive"""
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    from pydrive2.auth import GoogleAuth
+    from pydrive2.drive import GoogleDrive
+    from pycloud import gDrive
+
+    doc = get_static_doc('drive', 'v2').replace('https://www.googleapis.com/', url + '/')
+    auth = GoogleAuth(settings={
+        'client_config_backend': 'settings',
+        'client_config': {'client_id': 'benchmark', 'client_secret': 'benchmark'},
+        'save_credentials': False,
+        'oauth_scope': ['https://www.googleapis.com/auth/drive'],
+    })
+    auth.credentials = _Credentials()
+    auth.http = httplib2.Http()
+    auth.service = build_from_document(doc, http=auth.http)
+    return gDrive(
+        drive=GoogleDrive(auth),
+        scheduler=scheduler,
+        folder_cache=None,
+        session_file=os.path.join(workdir, 'upload_sessions.json')
+    )
+
+
+def _cloud(url, scheduler, workdir):
+    """iCloud service whose photos endpoint points at a fake CloudKit"""
+    import requests
+    from pyicloud_ipd.services.photos import PhotoAlbum
+    from pycloud import iCloud
+
+    service = types.SimpleNamespace(
+        session=requests.Session(),
+        params={},
+        _service_endpoint=url + FakeCloudKit.ENDPOINT,
+    )
+    album = PhotoAlbum(
+        service,
+        'All Photos',
+        'CPLAssetAndMasterByAssetDateWithoutHiddenOrDeleted',
+        'CPLAssetByAssetDateWithoutHiddenOrDeleted',
+        'ASCENDING',
+    )
+    service.albums = {'All Photos': album}
+    cloud = iCloud(download_dir=os.path.join(workdir, 'Photos'), scheduler=scheduler)
+    cloud.api = types.SimpleNamespace(photos=service, session=service.session, params=service.params)
+    return cloud
+
+
+def worker(args):
+    """Run one scenario against fake servers started by the parent process, and write its results"""
+    from pycloud import TransferEngine, RequestScheduler
+
+    scheduler = RequestScheduler()
+    start = time.perf_counter()
+    cloud = _cloud(args.cloudkit, scheduler, args.workdir)
+    drive = _drive(args.drive, scheduler, args.workdir) if args.scenario in ('transfer', 'stream') else None
+    album = cloud.get_album('All Photos')
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.scenario == 'listing':
+        photos = list(album.fetch_photos(profile='transfer'))
+        size = sum(photo.size for photo in photos)
+    elif args.scenario == 'seek':
+        photos = list(album.fetch_photos(
+            date_start=datetime.date.fromisoformat(args.date_start),
+            date_end=datetime.date.fromisoformat(args.date_end),
+            profile='transfer'))
+        size = sum(photo.size for photo in photos)
+    else:
+        engine = TransferEngine(
+            cloud,
+            drive,
+            download_workers=args.workers,
+            upload_workers=args.workers,
+            stream=args.scenario == 'stream'
+        )
+        photos, failed = engine.run(album.fetch_photos(profile='transfer'))
+        size = sum(photo.size for photo in photos)
+    elapsed = time.perf_counter() - start
+
+    with open(args.result, 'w') as f:
+        json.dump({
+            'photos': len(photos),
+            'bytes': size,
+            'seconds': elapsed,
+            'setup_seconds': setup,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }, f)
+
+
+def startup_seconds(runs=5):
+    """Seconds taken to import pycloud in a fresh interpreter, less the interpreter's own startup"""
+    def best(code):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+    return max(best('import pycloud') - best('pass'), 0.0)
+
+
+def run_scenario(scenario, args):
+    link = dict(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate, seed=args.seed)
+    cloudkit = FakeCloudKit(photos=args.photos, max_page=args.max_page, link=Link(**link), seed=args.seed)
+    drive = FakeDrive(link=Link(**link))
+
+    # Seek the middle tenth of the album
+    ranks = (args.photos * 45 // 100, args.photos * 55 // 100)
+    date_start, date_end = (
+        datetime.datetime.fromtimestamp(cloudkit.assets[rank]['fields']['assetDate']['value'] / 1000).date()
+        for rank in ranks
+    )
+
+    workdir = tempfile.mkdtemp(prefix=f'pycloud-bench-{scenario}-')
+    result = os.path.join(workdir, 'result.json')
+    try:
+        with cloudkit, drive:
+            subprocess.run([
+                sys.executable, '-m', 'benchmarks.run', '--worker', scenario,
+                '--cloudkit', cloudkit.url, '--drive', drive.url, '--workdir', workdir, '--result', result,
+                '--workers', str(args.workers), '--date-start', date_start.isoformat(),
+                '--date-end', date_end.isoformat(),
+            ], cwd=workdir, env={**os.environ, 'PYTHONPATH': ROOT}, check=True, stdout=subprocess.DEVNULL)
+            with open(result) as f:
+                metrics = json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    photos = metrics['photos'] or 1
+    requests = cloudkit.total_requests + drive.total_requests
+    metrics.update(
+        photos_per_sec=metrics['photos'] / metrics['seconds'],
+        bytes_per_sec=metrics['bytes'] / metrics['seconds'],
+        requests=requests,
+        requests_per_asset=requests / photos,
+        icloud_requests=dict(cloudkit.requests),
+        drive_requests=dict(drive.requests),
+    )
+    return metrics
+
+
+def regressions(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than the tolerance, as a list of messages"""
+    found = []
+    for scenario, metrics in results.items():
+        for metric in COMPARED:
+            old, new = baseline.get(scenario, {}).get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if metric in LOWER_IS_BETTER else change < -tolerance
+            if worse:
+                found.append(f'{scenario} {metric}: {old:.4g} -> {new:.4g} ({change:+.0%})')
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma separated scenarios to run, out of {", ".join(SCENARIOS)}')
+    parser.add_argument('--photos', type=int, default=500, help='photos in the fake album')
+    parser.add_argument('--max-page', type=int, default=200, help='max photos per fake records/query page')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake response')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second of each fake response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake requests throttled')
+    parser.add_argument('--workers', type=int, default=4, help='download and upload workers of transfers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare against; exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed change from the baseline')
+
+    # Options of the scenario processes
+    parser.add_argument('--worker', choices=SCENARIOS, dest='scenario', help=argparse.SUPPRESS)
+    for option in ('--cloudkit', '--drive', '--workdir', '--result', '--date-start', '--date-end'):
+        parser.add_argument(option, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        return worker(args)
+
+    results = {'startup': {'startup_seconds': startup_seconds()}}
+    print(f'startup: {results["startup"]["startup_seconds"]:.3f}s to import pycloud')
+    for scenario in args.scenarios.split(','):
+        results[scenario] = metrics = run_scenario(scenario, args)
+        print(f'{scenario}: {metrics["photos"]} photos in {metrics["seconds"]:.2f}s, '
+              f'{metrics["photos_per_sec"]:.1f} photos/s, {metrics["bytes_per_sec"] / 1024 ** 2:.1f} MiB/s, '
+              f'{metrics["requests_per_asset"]:.2f} requests/asset, {metrics["peak_rss_mb"]:.0f} MiB peak RSS, '
+              f'{metrics["setup_seconds"]:.2f}s setup')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for message in found:
+            print(f'Regression: {message}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,32 @@
-from .services import gDrive, iCloud
-from .logger import PyCloudLogger
+import importlib
+
+# Public names and the modules they're defined in. Modules are only imported when one of their names is
+# first used, so that importing pycloud doesn't pull in PyDrive2, icloudpd and their dependencies
+_EXPORTS = {
+    'gDrive': 'services',
+    'iCloud': 'services',
+    'PyCloudLogger': 'logger',
+    'TransferEngine': 'engine',
+    'TransferJournal': 'journal',
+    'StagingCache': 'staging',
+    'RequestScheduler': 'ratelimit',
+    'Metrics': 'metrics',
+    'TransferPlanner': 'planner',
+    'ChangeWatcher': 'watch',
+    'AsyncICloud': 'aio',
+    'AsyncDrive': 'aio',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,601 @@
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+import mimetypes
+import collections
+
+from urllib.parse import urlencode
+
+from pyicloud_ipd.services.photos import PhotoAsset
+
+from pycloud.utils import PROFILES, _loads
+from pycloud.index import AlbumIndex
+from pycloud.folders import path_titles
+from pycloud.upload import CHUNK_SIZE
+from pycloud.records import AssetRecord
+from pycloud.ratelimit import classify, rejected
+from pycloud.logger import PyCloudLogger
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+DRIVE_API = 'https://www.googleapis.com/drive/v2'
+DRIVE_UPLOAD_API = 'https://www.googleapis.com/upload/drive/v2'
+
+# Bytes read from an iCloud download response at a time
+READ_SIZE = 1024 * 1024
+
+# Seconds between checks of whether a concurrency limit of the request scheduler has room again
+LIMIT_POLL_INTERVAL = 0.01
+
+
+def connector(limit=100, limit_per_host=32):
+    """Keep-alive connection pool to share between an :class:`AsyncICloud` and an :class:`AsyncDrive`
+
+    Must be created inside the event loop it's used on.
+
+    :param limit: (int) max open connections in total
+    :param limit_per_host: (int) max open connections to a single host
+    """
+    if aiohttp is None:
+        raise ImportError('The asyncio API requires aiohttp, install it with "pip install aiohttp"')
+    return aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=300)
+
+
+class AsyncService:
+    """Base class of the asyncio services, which share a connection pool and close their own session
+
+    Requests are paced by the :class:`RequestScheduler` of the wrapped service, so they share its rate and
+    concurrency limits with any threaded requests, and waiting for them doesn't block the event loop.
+
+    :param scheduler: (RequestScheduler) scheduler whose endpoint families the requests are paced by
+    :param conn: (aiohttp.TCPConnector) connection pool from :func:`connector`, or None to create one
+    :param retries: (int) times to retry a request after a server error or rate limit
+    """
+
+    def __init__(self, name, scheduler, conn=None, retries=5):
+        if aiohttp is None:
+            raise ImportError('The asyncio API requires aiohttp, install it with "pip install aiohttp"')
+        self.name = name
+        self.logger = PyCloudLogger(name=name)
+        self.scheduler = scheduler
+        self.retries = retries
+        self._conn = conn
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            owner = self._conn is None
+            self._session = aiohttp.ClientSession(
+                connector=self._conn or connector(),
+                connector_owner=owner,
+                headers=self._headers(),
+                cookie_jar=self._cookie_jar(),
+            )
+        return self._session
+
+    def _headers(self):
+        return None
+
+    def _cookie_jar(self):
+        return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _acquire(self, family):
+        """Wait for room in the concurrency limit and token bucket of an endpoint family"""
+        while not family.limiter.try_acquire():
+            await asyncio.sleep(LIMIT_POLL_INTERVAL)
+        while wait := family.bucket.take():
+            await asyncio.sleep(wait)
+
+    async def _request(self, family, method, url, idempotent=True, **kwargs):
+        """Send a request of an endpoint family, retrying it after a connection error, server error or rate limit
+
+        Responses are classified like :meth:`RequestScheduler.call` does, so throttling also cuts the
+        family's concurrency limit, and retries back off the same way. Requests that aren't ``idempotent``
+        are only retried when they're rejected for a rate limit. The caller is responsible for releasing
+        the response, e.g. with ``async with``.
+        """
+        family = self.scheduler.family(family)
+        for attempt in range(self.retries + 1):
+            await self._acquire(family)
+            family.stats['requests'] += 1
+            start = time.perf_counter()
+            response, reasons = None, ''
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                kind = 'transient'
+                if not idempotent or attempt == self.retries:
+                    family.limiter.release()
+                    self.scheduler.observe(family, time.perf_counter() - start, kind)
+                    raise
+                self.logger.debug('%s %s failed (%s), retrying', method, url, e)
+            else:
+                # Drive answers 403 for rate limits, with the reason only in the body
+                if response.status == 403:
+                    reasons = await response.text()
+                kind = classify(response, reasons)
+            family.limiter.release(throttled=kind == 'throttled')
+            self.scheduler.observe(family, time.perf_counter() - start, kind)
+
+            if response is not None and (
+                    kind is None or attempt == self.retries or not (idempotent or rejected(response, reasons))):
+                return response
+            if kind == 'throttled':
+                family.stats['throttled'] += 1
+            family.stats['retries'] += 1
+            delay = self.scheduler.backoff(attempt, response)
+            if response is not None:
+                self.logger.debug('%s %s returned HTTP %d, retrying in %.1fs', method, url, response.status, delay)
+                response.release()
+            await asyncio.sleep(delay)
+
+
+class AsyncICloud(AsyncService):
+    """Asyncio counterpart of :class:`iCloud`, for listing, downloading and deleting photos without threads
+
+    Uses the cookies and headers of an already logged in :class:`iCloud`, which is still used to log in,
+    find albums and compute date ranges.
+
+    :param cloud: (iCloud) logged in iCloud service
+    :param conn: (aiohttp.TCPConnector) connection pool from :func:`connector`, or None to create one
+    :param retries: (int) times to retry a request after a server error or rate limit
+    """
+
+    def __init__(self, cloud, conn=None, retries=5):
+        super().__init__(name='AsyncICloud', scheduler=cloud.scheduler, conn=conn, retries=retries)
+        self.cloud = cloud
+
+    def _headers(self):
+        return dict(self.cloud.api.session.headers)
+
+    def _cookie_jar(self):
+        jar = aiohttp.CookieJar()
+        for cookie in self.cloud.api.session.cookies:
+            jar.update_cookies({cookie.name: cookie.value}, URL(f'https://{cookie.domain.lstrip(".")}/'))
+        return jar
+
+    @property
+    def _endpoint(self):
+        return self.cloud.api.photos._service_endpoint
+
+    async def _post(self, family, path, data):
+        url = f'{self._endpoint}/{path}?' + urlencode(self.cloud.api.params)
+        async with await self._request(
+                family, 'POST', url, data=json.dumps(data), headers={'Content-type': 'text/plain'}) as response:
+            response.raise_for_status()
+            return _loads(await response.read())
+
+    async def fetch_photos(self, album, last=None, date_start=None, date_end=None, profile='transfer'):
+        """Async generator of the photos of a :class:`FilterAlbum`, like :meth:`FilterAlbum.fetch_photos`
+
+        The date range is resolved by the album, then pages are requested with up to ``album.read_ahead``
+        requests in flight. Photos are added to the album's index as they're listed.
+        """
+        if profile not in PROFILES:
+            raise ValueError('Not a valid profile. Valid profiles: {}'.format([p for p in PROFILES]))
+
+        # Binary searching the date range is a few dozen sequential probes, so it stays on the album
+        offset, cnt = await asyncio.to_thread(
+            album.calculate_offset_and_cnt, last=last, date_start=date_start, date_end=date_end)
+
+        step = -1 if album.direction == 'DESCENDING' else 1
+        size = album._page_assets
+        pending = collections.deque()
+        next_offset, unscheduled = offset, cnt
+        try:
+            while cnt:
+                while unscheduled and len(pending) < album.read_ahead:
+                    page = min(size, unscheduled)
+                    query = album._list_query_gen(
+                        next_offset, album.list_type, album.direction, album.query_filter, profile=profile)
+                    query['resultsLimit'] = page * 2
+                    pending.append((next_offset, page, asyncio.ensure_future(
+                        self._post('icloud.query', 'records/query', query))))
+                    next_offset += step * page
+                    unscheduled -= page
+
+                if not pending:
+                    break
+                page_offset, page, task = pending.popleft()
+                asset_records, master_records = album._parse_page(await task)
+                if not asset_records:
+                    break
+
+                got = len(asset_records)
+                asset_records = asset_records[:min(page, cnt)]
+                cnt -= len(asset_records)
+                if got < page:
+                    # Pages in flight assumed this one was full, so request them again from the right offset
+                    for _, _, stale in pending:
+                        stale.cancel()
+                    pending.clear()
+                    next_offset = page_offset + step * got
+                    unscheduled = cnt
+                    size = max(got, 1)
+
+                if album.index is not None:
+                    # SQLite writes wait on the disk, and on other threads holding the index
+                    await asyncio.to_thread(album.index.add, album.name, [
+                        AlbumIndex.row_from_records(asset_record, master_records[master_id])
+                        for asset_record, master_id in asset_records
+                    ])
+                for asset_record, master_id in asset_records:
+                    yield PhotoAsset(album.service, master_records[master_id], asset_record)
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+
+    async def download(self, photo, version='original', read_size=READ_SIZE):
+        """Async generator of the bytes of a photo, read from the download response as they arrive"""
+        if isinstance(photo, AssetRecord):
+            # Looks up the photo's records again for fresh download URLs
+            photo = await asyncio.to_thread(photo.promote)
+        url = photo.versions[version]['url']
+        async with await self._request('icloud.download', 'GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(read_size):
+                yield chunk
+
+    async def delete_photos(self, photos, permanent=False, batch_size=100):
+        """Delete photos with one records/modify request per batch, with every batch in flight at once
+
+        :return: tuple of lists of the (deleted, failed) photos
+        """
+        photos = iter(photos)
+        batches = []
+        while batch := list(itertools.islice(photos, batch_size)):
+            batches.append(batch)
+
+        deleted, failed = [], []
+        for batch_deleted, batch_failed in await asyncio.gather(
+                *(self._delete_batch(batch, permanent) for batch in batches)):
+            deleted.extend(batch_deleted)
+            failed.extend(batch_failed)
+        return deleted, failed
+
+    async def _delete_batch(self, photos, permanent=False):
+        try:
+            response = await self._post('icloud.modify', 'records/modify', {
+                'operations': [self.cloud._delete_operation(photo, permanent) for photo in photos],
+                'zoneID': {
+                    'zoneName': 'PrimarySync',
+                    'zoneType': 'REGULAR_CUSTOM_ZONE'
+                },
+                'atomic': False,
+            })
+        except aiohttp.ClientError as e:
+            self.logger.error(f'Failed to delete {len(photos)} photos from iCloud: {e}')
+            return [], list(photos)
+
+        errors = {
+            rec['recordName']: rec.get('reason', rec['serverErrorCode'])
+            for rec in response.get('records', []) if 'serverErrorCode' in rec
+        }
+        deleted, failed = [], []
+        for photo in photos:
+            if error := errors.get(photo._asset_record['recordName']):
+                self.logger.error(f'Failed to delete {photo.filename} from iCloud: {error}')
+                failed.append(photo)
+            else:
+                self.logger.info(f'Deleted {photo.filename} from iCloud')
+                deleted.append(photo)
+
+        if deleted and self.cloud.index is not None:
+            await asyncio.to_thread(self.cloud.index.remove, [photo._asset_record['recordName'] for photo in deleted])
+        return deleted, failed
+
+
+class AsyncDrive(AsyncService):
+    """Asyncio counterpart of :class:`gDrive`, for uploads, listings and folder creation without threads
+
+    Shares the folder map, folder tree, content index and quota of a :class:`gDrive`, and authorizes
+    requests with its OAuth access token, refreshing it when it expires.
+
+    :param drive: (gDrive) Google Drive service
+    :param conn: (aiohttp.TCPConnector) connection pool from :func:`connector`, or None to create one
+    :param retries: (int) times to retry a request or upload chunk after a server error or rate limit
+    """
+
+    def __init__(self, drive, conn=None, retries=5):
+        super().__init__(name='AsyncDrive', scheduler=drive.scheduler, conn=conn, retries=retries)
+        self.drive = drive
+        self._auth = None
+        self._creating = {}  # Relative path -> Future of the folder id, while the folder is being created
+        self._refreshing = None
+
+    async def _credentials(self):
+        if self._auth is None:
+            # Authenticates with Drive if the gDrive hasn't yet
+            self._auth = await asyncio.to_thread(lambda: self.drive.drive.auth)
+        return self._auth.credentials
+
+    async def _folders(self):
+        """Folder map of the gDrive, mapping the folders in a thread if they haven't been yet"""
+        await asyncio.to_thread(self.drive.ensure_initialized)
+        return self.drive.folders
+
+    async def _authorized(self, family, method, url, **kwargs):
+        """Send a Drive API request with the access token, refreshing it once if it's rejected"""
+        for refreshed in (False, True):
+            credentials = await self._credentials()
+            if credentials.access_token_expired:
+                await self._refresh()
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers['Authorization'] = f'Bearer {credentials.access_token}'
+            response = await self._request(family, method, url, headers=headers, **kwargs)
+            if response.status != 401 or refreshed:
+                return response
+            response.release()
+            await self._refresh()
+            kwargs['headers'] = headers
+
+    async def _refresh(self):
+        # Concurrent requests share a single refresh
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(asyncio.to_thread(self._auth.Refresh))
+            self._refreshing.add_done_callback(lambda _: setattr(self, '_refreshing', None))
+        await asyncio.shield(self._refreshing)
+
+    async def _json(self, family, method, url, **kwargs):
+        async with await self._authorized(family, method, url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def list_files(self, folder_id):
+        """Files in a folder, excluding subfolders, as Drive files resources"""
+        params = {
+            'q': f"'{folder_id}' in parents and trashed=false and mimeType!='{self.drive.FOLDER}'",
+            'maxResults': 1000,
+            'fields': 'items(id,title,fileSize,md5Checksum),nextPageToken',
+        }
+        items = []
+        while True:
+            response = await self._json('drive.metadata', 'GET', f'{DRIVE_API}/files', params=params)
+            items.extend(response.get('items', []))
+            if not response.get('nextPageToken'):
+                return items
+            params['pageToken'] = response['nextPageToken']
+
+    async def has_file(self, title, parent_id, size):
+        """Whether a folder already holds a file with the same title and size"""
+        if not self.drive.contents.is_loaded(parent_id):
+            self.drive.contents.load(parent_id, await self.list_files(parent_id))
+        return self.drive.contents.find(parent_id, title, size) is not None
+
+    async def new_folder(self, title, parent_id, key=None):
+        folder = await self._json('drive.metadata', 'POST', f'{DRIVE_API}/files',
+                                  params={'fields': 'id,title,parents(id)'}, json={
+            'title': title,
+            'parents': [
+                {
+                    "kind": "drive#fileLink",
+                    "id": parent_id
+                }
+            ],
+            "mimeType": self.drive.FOLDER
+        }, idempotent=False)
+        self.drive.folders[key or title] = folder['id']
+        self.drive.tree.add_item(folder)
+        self.logger.info(f'Created folder {title}')
+        return folder
+
+    async def get_date_folder(self, date):
+        """Get ID of the folder at a relative path like "YYYY/mm", like :meth:`gDrive.get_date_folder`"""
+        folders = await self._folders()
+        if folders.get(date):
+            return folders[date]
+
+        creating = self._creating.get(date)
+        if creating is None:
+            creating = self._creating[date] = asyncio.ensure_future(self._create_date_folder(date))
+            creating.add_done_callback(lambda _: self._creating.pop(date, None))
+        return await asyncio.shield(creating)
+
+    async def _create_date_folder(self, date):
+        parent, _, _ = date.rpartition('/')
+        parent_id = await self.get_date_folder(parent) if parent else self.drive.folders['upload']
+        await self.new_folder(path_titles(date)[-1], parent_id, key=date)
+        return self.drive.folders[date]
+
+    async def upload(self, data, title, parent_id=None, size=None, digest=None):
+        """Upload a file. Returns its metadata
+
+        Bytes smaller than the multipart threshold of the :class:`gDrive` are sent in one request. Anything
+        else, including async iterables of bytes such as :meth:`AsyncICloud.download`, is sent in chunks
+        through a resumable session.
+
+        :param data: bytes, or async iterable of bytes
+        :param title: (str) title of the file in Drive
+        :param parent_id: (str) id of the folder to upload to
+        :param size: (int) size of the file in bytes, if known
+        :param digest: hashlib digest updated with the bytes of the file as they're uploaded
+        """
+        body = {'title': title}
+        if parent_id:
+            body['parents'] = [
+                {
+                    "kind": "drive#fileLink",
+                    "id": parent_id
+                }
+            ]
+        mimetype = mimetypes.guess_type(title)[0] or 'application/octet-stream'
+
+        if digest is not None:
+            if isinstance(data, (bytes, bytearray)):
+                digest.update(data)
+            else:
+                data = _ahashed(data, digest)
+
+        if isinstance(data, (bytes, bytearray)) and len(data) < self.drive.multipart_threshold:
+            metadata = await self._multipart_upload(bytes(data), body, mimetype)
+        else:
+            if isinstance(data, (bytes, bytearray)):
+                data, size = _aiter_bytes(data), len(data)
+            metadata = await self._resumable_upload(data, body, mimetype, size)
+
+        if parent_id:
+            self.drive.contents.add(parent_id, metadata)
+        return metadata
+
+    async def _multipart_upload(self, data, body, mimetype):
+        with aiohttp.MultipartWriter('related') as writer:
+            writer.append_json(body)
+            writer.append(data, {'Content-Type': mimetype})
+        return await self._json(
+            'drive.upload', 'POST', f'{DRIVE_UPLOAD_API}/files',
+            params={'uploadType': 'multipart', 'supportsAllDrives': 'true'}, data=writer, idempotent=False)
+
+    async def _resumable_upload(self, chunks, body, mimetype, size=None):
+        headers = {'X-Upload-Content-Type': mimetype}
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+        async with await self._authorized(
+                'drive.upload', 'POST', f'{DRIVE_UPLOAD_API}/files',
+                params={'uploadType': 'resumable', 'supportsAllDrives': 'true'}, json=body, headers=headers) as response:
+            response.raise_for_status()
+            uri = response.headers['Location']
+
+        chunks = chunks.__aiter__()
+        buffer = bytearray()
+        offset = 0  # Offset in the file of the first buffered byte, which is everything Drive has committed
+        eof = False
+        while True:
+            while len(buffer) < self.drive.chunk_size and not eof:
+                try:
+                    buffer += await chunks.__anext__()
+                except StopAsyncIteration:
+                    eof = True
+
+            length = len(buffer) if eof else self.drive.chunk_size
+            total = offset + length if eof else (size if size is not None else '*')
+            content_range = f'bytes {offset}-{offset + length - 1}/{total}' if length else f'bytes */{total}'
+            async with await self._authorized(
+                    'drive.upload', 'PUT', uri, data=bytes(buffer[:length]),
+                    headers={'Content-Range': content_range}) as response:
+                if response.status in (200, 201):
+                    return await response.json()
+                if response.status != 308:
+                    response.raise_for_status()
+                    raise RuntimeError(f'Unexpected HTTP {response.status} uploading {body["title"]}')
+                # The Range header holds the last committed byte, and is missing if nothing was committed
+                committed = response.headers.get('Range')
+                committed = int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+            del buffer[:committed - offset]
+            offset = committed
+
+
+async def _aiter_bytes(data, chunksize=CHUNK_SIZE):
+    for i in range(0, len(data), chunksize):
+        yield data[i:i + chunksize]
+
+
+async def _ahashed(chunks, digest):
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+async def _md5(chunks):
+    digest = hashlib.md5()
+    async for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def transfer_photos(cloud, drive, photos, concurrency=64, delete=True, delete_batch_size=100):
+    """Transfer photos from iCloud to Google Drive on the running event loop
+
+    Each photo is streamed from its download response into a Drive upload, with up to ``concurrency``
+    photos in flight at once, so thousands of small photos can be in flight on a single thread.
+    Uploaded photos are then deleted from iCloud in batches, but only if the MD5 of the bytes streamed
+    matches the md5Checksum of the file in Drive. Photos already in Drive from an earlier run are
+    downloaded and hashed to check them first.
+
+    :param cloud: (AsyncICloud) iCloud service
+    :param drive: (AsyncDrive) Google Drive service
+    :param photos: iterable or async iterable of PhotoAssets
+    :param concurrency: (int) max photos in flight at once
+    :param delete: (bool) whether to delete photos from iCloud after they're uploaded
+    :param delete_batch_size: (int) max number of photos deleted per iCloud request
+    :return: tuple of lists of the (successful, failed) photos
+    """
+    quota = drive.drive.quota
+    semaphore = asyncio.Semaphore(concurrency)
+    uploaded, failed, tasks = [], [], set()
+
+    async def transfer(photo):
+        try:
+            date_path = cloud.cloud.date_path(photo)
+            folder_id = await drive.get_date_folder(date_path)
+            if await drive.has_file(photo.filename, folder_id, photo.size):
+                drive.logger.info(f'Skipping {photo.filename}, it\'s already in folder {date_path}')
+                file = drive.drive.contents.find(folder_id, photo.filename, photo.size)
+                if delete and await _md5(cloud.download(photo)) != file.get('md5Checksum'):
+                    drive.logger.error(f'Checksum of {photo.filename} in Google Drive doesn\'t match, not deleting it')
+                    failed.append(photo)
+                    return
+                uploaded.append(photo)
+                return
+            # Syncs the quota with Drive when it's stale
+            if not await asyncio.to_thread(quota.reserve, photo.size):
+                drive.logger.error(f'Skipping {photo.filename}, it doesn\'t fit in Google Drive')
+                failed.append(photo)
+                return
+            digest = hashlib.md5()
+            try:
+                metadata = await drive.upload(
+                    cloud.download(photo), photo.filename, folder_id, size=photo.size, digest=digest)
+            except Exception:
+                quota.release(photo.size, error=True)
+                raise
+            quota.commit(photo.size)
+            drive.logger.info(f'Uploaded {photo.filename} to folder {date_path}')
+            if metadata.get('md5Checksum') != digest.hexdigest():
+                drive.logger.error(f'Checksum of {photo.filename} in Google Drive ({metadata.get("md5Checksum")}) '
+                                   f'doesn\'t match the photo ({digest.hexdigest()}), not deleting it')
+                failed.append(photo)
+                return
+            uploaded.append(photo)
+        except Exception as e:
+            drive.logger.error(f'Failed to transfer {photo.filename}: {e}')
+            failed.append(photo)
+        finally:
+            semaphore.release()
+
+    async def start(photo):
+        await semaphore.acquire()
+        task = asyncio.ensure_future(transfer(photo))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if hasattr(photos, '__aiter__'):
+        async for photo in photos:
+            await start(photo)
+    else:
+        for photo in photos:
+            await start(photo)
+    if tasks:
+        await asyncio.wait(tasks)
+
+    if not delete:
+        return uploaded, failed
+    deleted, delete_failed = await cloud.delete_photos(uploaded, batch_size=delete_batch_size)
+    return deleted, failed + delete_failed
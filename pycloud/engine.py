@@ -0,0 +1,586 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+
+from pycloud.logger import PyCloudLogger
+from pycloud.metrics import Metrics
+from pycloud.services import DeleteBuffer
+from pycloud.upload import StreamError
+from pycloud.journal import TransferJournal
+from pycloud.staging import StagingCache
+from pycloud.records import Promoter
+
+# Bytes read from an iCloud download response at a time when streaming
+READ_SIZE = 1024 * 1024
+
+_DONE = object()  # Sentinel telling a stage worker to exit
+
+
+class TransferJob:
+    """State of a single photo as it moves through the transfer pipeline"""
+
+    def __init__(self, photo):
+        self.photo = photo
+        self.date_path = None
+        self.download_path = None
+        self.file = None
+        self.md5 = None  # Hex MD5 of the bytes of the photo, hashed as they were transferred
+        self.existing = None  # File found in Drive from an earlier run, that still has to be verified
+        self.retransfer = False  # Whether the file in Drive didn't match, so the photo is uploaded again
+        self.kept = False  # Whether the photo was found in Drive unconfirmed, so it's neither uploaded nor deleted
+        self.uploaded = False  # Whether the upload succeeded, and was verified if verifying
+        self.reserved = 0  # Bytes of Drive quota reserved for this photo
+
+
+class Stage:
+    """A pool of worker threads that consume a bounded queue and feed the next stage
+
+    Putting a job into a full queue blocks the producer, so a slow stage throttles
+    every stage before it instead of letting work pile up in memory or on disk.
+
+    :param name: (str) name of the stage, used for thread names
+    :param handler: callable taking a TransferJob; returns True if the job should be passed on
+    :param workers: (int) number of worker threads
+    :param maxsize: (int) maximum number of jobs waiting in the queue
+    :param on_error: callable taking (job, exception) if the handler raises
+    :param metrics: (Metrics) registry to record the latency and errors of the handler in
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=0, on_error=None, metrics=None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.on_error = on_error
+        self.next_stage = None
+        self.threads = []
+        self.latency = self.errors = None
+        if metrics is not None:
+            self.latency = metrics.histogram('stage_seconds', 'Time spent handling a job, by stage', ('stage',))
+            self.errors = metrics.counter('stage_errors_total', 'Jobs whose handler raised, by stage', ('stage',))
+            metrics.gauge('queue_depth', 'Jobs waiting in the queue of each stage', ('stage',)).set_function(
+                self.queue.qsize, stage=name)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def put(self, job):
+        self.queue.put(job)
+
+    def close(self):
+        """Wait for all queued jobs to be handled, then stop the workers"""
+        for _ in self.threads:
+            self.queue.put(_DONE)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                forward = self.handler(job)
+            except Exception as e:
+                if self.errors is not None:
+                    self.errors.inc(stage=self.name)
+                if self.on_error:
+                    self.on_error(job, e)
+                continue
+            finally:
+                if self.latency is not None:
+                    self.latency.observe(time.perf_counter() - start, stage=self.name)
+            if forward and self.next_stage:
+                self.next_stage.put(job)
+
+
+class TransferEngine:
+    """Moves photos from iCloud to Google Drive through pipelined download, upload and delete stages
+
+    Each stage has its own worker pool, and stages are joined by bounded queues. Downloaded files are
+    kept in a :class:`StagingCache` within its byte budget until their upload is verified, so a photo
+    whose upload failed is retried from disk instead of being downloaded again.
+
+    In streaming mode, the download and upload stages are replaced by a single stage that feeds
+    each iCloud download response straight into a Drive resumable upload, using one upload chunk of
+    memory per worker and no disk. A photo only falls back to being downloaded to disk when its
+    stream fails in a way that can't be retried.
+
+    :param cloud: (iCloud) logged in iCloud service
+    :param drive: (gDrive) Google Drive service
+    :param download_dir: (str) directory that photos are staged in before being uploaded, if ``staging``
+        isn't provided
+    :param download_workers: (int) max number of concurrent downloads
+    :param upload_workers: (int) max number of concurrent uploads
+    :param delete_workers: (int) max number of concurrent iCloud deletion requests
+    :param queue_size: (int) max number of jobs waiting between two stages
+    :param delete: (bool) whether to delete photos from iCloud after they're uploaded
+    :param delete_batch_size: (int) max number of photos deleted per iCloud request
+    :param delete_wait: (float) max seconds an uploaded photo waits for its deletion batch to fill up
+    :param stream: (bool) whether to stream downloads into uploads instead of going through disk.
+        Uses ``upload_workers`` workers
+    :param journal: (TransferJournal) journal that each completed stage is recorded in, so that a re-run
+        resumes every photo at the stage after its last completed one
+    :param metrics: (Metrics) registry that stage latencies, queue depths, photos, bytes moved and quota headroom
+        are recorded in
+    :param verify: (bool) whether photos are only deleted once the MD5 of their bytes, hashed as they're
+        transferred, matches the md5Checksum of their file in Drive. Otherwise a matching size is enough for the
+        photos it uploads, while those found in Drive are only deleted if an MD5 of them is already known
+    :param staging: (StagingCache) cache that photos are downloaded to before being uploaded. Defaults to one
+        in ``download_dir`` with the default budget
+    """
+
+    def __init__(self, cloud, drive, download_dir=None, download_workers=4, upload_workers=4,
+                 delete_workers=2, queue_size=8, delete=True, delete_batch_size=100, delete_wait=5.0, stream=False,
+                 journal=None, metrics=None, verify=True, staging=None):
+        self.cloud = cloud
+        self.drive = drive
+        self.staging = staging or StagingCache(download_dir or os.path.join(cloud.download_dir, 'PyCloud Staging'))
+        self.download_dir = self.staging.root
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.delete_workers = delete_workers
+        self.queue_size = queue_size
+        self.delete = delete
+        self.delete_batch_size = delete_batch_size
+        self.delete_wait = delete_wait
+        self.stream = stream
+        self.journal = journal
+        self.verify = verify
+        self.logger = PyCloudLogger(name='TransferEngine')
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.photos = self.metrics.counter('photos_total', 'Photos by outcome', ('outcome',))
+        self.bytes = self.metrics.counter('bytes_total', 'Bytes moved, by stage', ('stage',))
+        self.folder_latency = self.metrics.histogram('folder_lookup_seconds', 'Time taken to get a date folder')
+        self.listing = self.metrics.counter('listing_seconds_total', 'Time spent waiting for photos to be listed')
+        self.mismatches = self.metrics.counter(
+            'checksum_mismatches_total', 'Photos whose file in Drive didn\'t match their MD5')
+        quota = drive.quota
+        self.metrics.gauge('quota_headroom_bytes', 'Drive storage left after used and reserved bytes').set_function(
+            lambda: quota.total - quota.used - quota.reserved)
+
+        self.success, self.failed, self.skipped = [], [], []
+        self._promoter = Promoter()
+        self._lock = threading.Lock()
+
+    def run(self, photos, folders=None):
+        """Transfer an iterable of photos. Returns a tuple of the (successful, failed) photos
+
+        If the relative folder paths of the photos are known up front, any missing ones are created in bulk
+        before the transfer starts, instead of one at a time as photos reach the upload stage.
+
+        Photos that don't fit in the remaining Drive quota are skipped, so smaller photos after them can
+        still be packed in. Photos that would only fit once in-flight uploads release their reserved
+        quota are retried in a second pass, after the first one finishes.
+        """
+        self.success, self.failed, self.skipped = [], [], []
+        if folders:
+            self.drive.ensure_folders(folders)
+
+        deferred = self._run_pipeline(photos)
+        if deferred:
+            self.logger.info(f'Retrying {len(deferred)} photos that were waiting for quota')
+            self.skipped.extend(self._run_pipeline(deferred))
+        if self.skipped:
+            self.logger.info(f'Skipped {len(self.skipped)} photos that don\'t fit in Google Drive')
+        return self.success, self.failed
+
+    def _run_pipeline(self, photos):
+        """Run photos through the pipeline. Returns photos that didn't fit in the quota at the time"""
+        deferred = []
+        stages = self._build_stages()
+        for stage in stages:
+            stage.start()
+        by_name = self._stages = {stage.name: stage for stage in stages}
+        self._promoter = Promoter(batch_size=self.queue_size + max(self.download_workers, self.upload_workers))
+        self._deletes = DeleteBuffer(
+            self.cloud, self.delete_batch_size, self.delete_wait, callback=self._on_deleted)
+
+        try:
+            for photo in self._listed(photos):
+                job = TransferJob(photo)
+                stage = self._resume(job, by_name) if self.journal else stages[0]
+                if stage is None:
+                    continue
+                if stage.name != 'delete' and not job.retransfer and self._in_drive(job):
+                    if job.kept:
+                        continue
+                    if not self.delete:
+                        self._succeed(job)
+                        continue
+                    # A file that wasn't verified when it was uploaded is checked by the first stage
+                    stage = stages[0] if job.existing else by_name['delete']
+                if stage.name == 'delete' or job.existing:
+                    # Already uploaded, so no quota is needed
+                    pass
+                elif self.admit(job):
+                    if job.download_path and not self.staging.get(job.download_path, photo.size):
+                        # Evicted since it was found, so it's downloaded again
+                        job.date_path = job.download_path = None
+                        stage = stages[0]
+                elif self.drive.quota.fits(photo.size):
+                    # Fits once reservations of in-flight photos are released, which may fail and free space
+                    deferred.append(photo)
+                    continue
+                else:
+                    self.photos.inc(outcome='skipped')
+                    self.skipped.append(photo)
+                    continue
+                if stage is stages[0] and not job.download_path:
+                    # Looked up along with the other photos queued for download by the time it's downloaded
+                    self._promoter.add(photo)
+                stage.put(job)
+        finally:
+            # Close stages in pipeline order so that each one drains into the next
+            for stage in stages:
+                stage.close()
+            self._deletes.close()
+            if self.journal:
+                self.journal.flush()
+
+        return deferred
+
+    def _listed(self, photos):
+        """Yield photos, counting the time spent waiting for each one to be listed"""
+        photos = iter(photos)
+        while True:
+            start = time.perf_counter()
+            try:
+                photo = next(photos)
+            except StopIteration:
+                return
+            finally:
+                self.listing.inc(time.perf_counter() - start)
+            yield photo
+
+    def _folder(self, date_path):
+        with self.folder_latency.time():
+            return self.drive.get_date_folder(date_path)
+
+    @staticmethod
+    def _key(photo):
+        """Journal key of a photo"""
+        return photo._asset_record['recordName']
+
+    def _resume(self, job, stages):
+        """Stage a photo should enter based on its journal entry, or None if it needs nothing more"""
+        first = stages.get('stream') or stages['download']
+        entry = self.journal.get(self._key(job.photo))
+        if not entry:
+            return first
+
+        if entry['stage'] == TransferJournal.DELETED:
+            return None
+        if entry['stage'] in (TransferJournal.UPLOADED, TransferJournal.VERIFIED):
+            if not self.delete:
+                self._succeed(job)
+                return None
+            if entry['stage'] == TransferJournal.VERIFIED:
+                return stages['delete']
+            # Uploaded without being verified, so _in_drive() has it checked before it's deleted
+            return first
+        if entry['stage'] == TransferJournal.MISMATCH:
+            job.retransfer = True
+            return first
+        # Only pinned once the photo is admitted, since it may still be deferred, skipped or found in Drive
+        if entry['download_path'] and self.staging.contains(entry['download_path'], job.photo.size):
+            job.date_path = entry['date_path']
+            job.download_path = entry['download_path']
+            return stages.get('upload') or first
+        return first
+
+    def _in_drive(self, job):
+        """Whether a photo is already in its Drive folder with the same size, from a previous run
+
+        A matching title and size isn't enough to delete the photo from iCloud. When verifying, the first
+        stage downloads and hashes it. Otherwise it's only deleted if its MD5 is known without downloading
+        it and matches the file. Photos that can't be checked are kept in iCloud, and don't go further.
+        """
+        photo = job.photo
+        date_path = job.date_path or self.cloud.date_path(photo)
+        folder_id = self.drive.folders.get(date_path)
+        if not folder_id:
+            return False
+
+        file = self.drive.get_file(photo.filename, folder_id, size=photo.size)
+        if not file:
+            return False
+        self.drive.info(f'Skipping {photo.filename}, it\'s already in folder {date_path}')
+        # Only checked when the photo would be deleted
+        md5 = self._known_md5(job) if self.delete and not self.verify else None
+        if job.download_path:
+            self.staging.discard(job.download_path)
+        job.date_path = date_path
+        if self.verify:
+            self._record(job, TransferJournal.UPLOADED, filename=photo.filename, date_path=date_path,
+                         drive_id=file['id'])
+            job.existing = file
+        elif md5:
+            job.file, job.md5 = file, md5
+            job.kept = not self._verified(job)
+            job.file = None
+            if job.kept:
+                self._fail(job)
+        else:
+            self._record(job, TransferJournal.UPLOADED, filename=photo.filename, date_path=date_path,
+                         drive_id=file['id'])
+            if self.delete:
+                self.logger.warning(f'No checksum of {photo.filename} to check against the file in Drive, '
+                                    f'so it won\'t be deleted from iCloud')
+                job.kept = True
+                self._succeed(job)
+        return True
+
+    def _known_md5(self, job):
+        """MD5 of a photo known without downloading it, from the journal or its staged copy, or None"""
+        entry = self.journal.get(self._key(job.photo)) if self.journal else None
+        if entry and entry['md5']:
+            return entry['md5']
+        if not job.download_path:
+            return None
+        digest = hashlib.md5()
+        try:
+            with open(job.download_path, 'rb') as f:
+                while chunk := f.read(READ_SIZE):
+                    digest.update(chunk)
+        except OSError:
+            return None  # Evicted since it was found
+        return digest.hexdigest()
+
+    def _record(self, job, stage, **fields):
+        if self.journal:
+            self.journal.record(self._key(job.photo), stage, **fields)
+
+    def admit(self, job):
+        """Reserve Drive quota for a photo before it enters the pipeline. Returns False if it doesn't fit"""
+        if self.drive.quota.reserve(job.photo.size):
+            job.reserved = job.photo.size
+            return True
+        return False
+
+    def _build_stages(self):
+        if self.stream:
+            stages = [Stage('stream', self._stream, self.upload_workers, self.queue_size, self._on_upload_error,
+                            self.metrics)]
+        else:
+            download = Stage(
+                'download', self._download, self.download_workers, self.queue_size, self._on_error, self.metrics)
+            upload = Stage(
+                'upload', self._upload, self.upload_workers, self.queue_size, self._on_upload_error, self.metrics)
+            stages = [download, upload]
+
+        if self.delete:
+            delete = Stage('delete', self._delete, self.delete_workers, self.queue_size, self._on_error, self.metrics)
+            stages.append(delete)
+
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        return stages
+
+    def _download(self, job):
+        from icloudpd.download import download_media
+
+        if job.existing:
+            return self._verify_existing(job)
+
+        photo = job.photo
+        job.date_path = self.cloud.date_path(photo)
+        job.download_path = os.path.normpath(
+            os.path.join(self.download_dir, job.date_path, photo.filename))
+
+        if self.staging.get(job.download_path, photo.size):
+            # Staged by an earlier attempt whose upload failed
+            self._promoter.discard(photo)
+            self.cloud.info(f'Reusing staged copy of {photo.filename} in {job.date_path}')
+            self._record(job, TransferJournal.DOWNLOADED, filename=photo.filename,
+                         date_path=job.date_path, download_path=job.download_path)
+            return True
+
+        # Waits until the staging cache has room for the photo
+        if not self.staging.reserve(photo.size):
+            self.logger.error(f'No room in the staging cache to download {photo.filename}')
+            job.download_path = None
+            return self._fail(job)
+        part_path = self.staging.part_path(job.download_path)
+        downloaded = False
+        try:
+            # All directories will be made by the icloudpd.download.download_media() function
+            if self.cloud.scheduler.call(
+                    'icloud.download', download_media, self.cloud.api, self._promoter.get(photo), part_path,
+                    size='original'):
+                os.replace(part_path, job.download_path)
+                self.staging.add(job.download_path, photo.size)
+                downloaded = True
+        finally:
+            if not downloaded:
+                self.staging.cancel(photo.size)
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+        if downloaded:
+            self.cloud.info(f'Downloaded {photo.filename} to {job.date_path}')
+            self.bytes.inc(photo.size, stage='download')
+            self._record(job, TransferJournal.DOWNLOADED, filename=photo.filename,
+                         date_path=job.date_path, download_path=job.download_path)
+            return True
+
+        self.logger.error(f'Failed to download photo {photo.filename} from iCloud')
+        return self._fail(job)
+
+    def _upload(self, job):
+        # If the upload fails, _fail() releases the staged copy, which is kept for a retry
+        upload_id = self._folder(job.date_path)
+        digest = hashlib.md5() if self.verify else None
+        job.file = self.drive.add_file(job.download_path, parent_id=upload_id, digest=digest)
+        job.md5 = digest and digest.hexdigest()
+        forward = self._uploaded(job)
+        if job.uploaded:
+            self.staging.discard(job.download_path)
+        return forward
+
+    def _stream(self, job):
+        photo = job.photo
+        if job.existing:
+            return self._verify_existing(job)
+        if job.download_path:
+            # Resuming a photo that was already downloaded to disk
+            return self._upload(job)
+
+        job.date_path = self.cloud.date_path(photo)
+        upload_id = self._folder(job.date_path)
+
+        response = self.cloud.scheduler.call('icloud.download', self._promoter.get(photo).download, 'original')
+        try:
+            response.raise_for_status()
+            digest = hashlib.md5() if self.verify else None
+            job.file = self.drive.upload_stream(
+                response.iter_content(READ_SIZE), photo.filename, upload_id, size=photo.size, digest=digest)
+            job.md5 = digest and digest.hexdigest()
+        except StreamError as e:
+            self.logger.warning(f'Could not stream {photo.filename} ({e}), transferring it through disk instead')
+            return self._download(job) and self._upload(job)
+        finally:
+            response.close()
+
+        self.cloud.info(f'Streamed {photo.filename} to {job.date_path}')
+        return self._uploaded(job)
+
+    def _uploaded(self, job):
+        photo = job.photo
+        if not job.file:
+            self.logger.error(
+                f'Failed to upload photo {photo.filename} to Google Drive folder {job.date_path}')
+            return self._fail(job, upload_error=True)
+
+        self.drive.quota.commit(job.reserved)
+        job.reserved = 0
+        self.bytes.inc(photo.size, stage='upload')
+        self.drive.info(f'Uploaded {photo.filename} to folder {job.date_path}')
+        if self.verify:
+            verified = self._verified(job)
+            job.file = None
+            if not verified:
+                return self._fail(job)
+        else:
+            verified = int(job.file.get('fileSize') or -1) == photo.size
+            self._record(job, TransferJournal.VERIFIED if verified else TransferJournal.UPLOADED,
+                         filename=photo.filename, date_path=job.date_path, drive_id=job.file['id'])
+            job.file = None
+        job.uploaded = True
+        if self.delete:
+            return True
+        return self._succeed(job)
+
+    def _verified(self, job):
+        """Whether the MD5 hashed while a photo was transferred matches the md5Checksum of its file in Drive
+
+        The outcome is recorded in the journal, so a photo whose file doesn't match is uploaded again
+        on the next run instead of being deleted.
+        """
+        photo = job.photo
+        checksum = job.file.get('md5Checksum')
+        if job.md5 and job.md5 == checksum:
+            self._record(job, TransferJournal.VERIFIED, filename=photo.filename, date_path=job.date_path,
+                         drive_id=job.file['id'], md5=job.md5)
+            return True
+
+        self.logger.error(f'Checksum of {photo.filename} in Google Drive ({checksum}) doesn\'t match '
+                          f'the photo ({job.md5}), so it won\'t be deleted from iCloud')
+        self.mismatches.inc()
+        self._record(job, TransferJournal.MISMATCH, filename=photo.filename, date_path=job.date_path,
+                     drive_id=job.file['id'], md5=job.md5)
+        return False
+
+    def _verify_existing(self, job):
+        """Hash a download of a photo found in Drive from an earlier run, and pass it on to be deleted if it matches
+
+        This is the only case where a photo is read twice, and only happens to photos uploaded by a run that
+        stopped before verifying them.
+        """
+        photo = job.photo
+        digest = hashlib.md5()
+        response = self.cloud.scheduler.call('icloud.download', self._promoter.get(photo).download, 'original')
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(READ_SIZE):
+                digest.update(chunk)
+        finally:
+            response.close()
+
+        job.md5 = digest.hexdigest()
+        job.file, job.existing = job.existing, None
+        verified = self._verified(job)
+        job.file = None
+        if not verified:
+            return self._fail(job)
+        self._stages['delete'].put(job)
+        return False
+
+    def _delete(self, job):
+        # Deleted in batches by the buffer, which reports back through _on_deleted()
+        self._deletes.add(job.photo)
+        return False
+
+    def _on_deleted(self, deleted, failed):
+        if self.journal:
+            for photo in deleted:
+                self.journal.record(self._key(photo), TransferJournal.DELETED)
+        self.photos.inc(len(deleted), outcome='success')
+        self.photos.inc(len(failed), outcome='failed')
+        with self._lock:
+            self.success.extend(deleted)
+            self.failed.extend(failed)
+
+    def _on_error(self, job, error, upload_error=False):
+        self.logger.error(f'Failed to transfer {job.photo.filename}: {error}')
+        self._fail(job, upload_error=upload_error)
+
+    def _on_upload_error(self, job, error):
+        self._on_error(job, error, upload_error=True)
+
+    def _succeed(self, job):
+        self.photos.inc(outcome='success')
+        with self._lock:
+            self.success.append(job.photo)
+        return False
+
+    def _fail(self, job, upload_error=False):
+        self._promoter.discard(job.photo)
+        if job.download_path:
+            self.staging.release(job.download_path)
+        if job.reserved:
+            self.drive.quota.release(job.reserved, error=upload_error)
+            job.reserved = 0
+        self.photos.inc(outcome='failed')
+        with self._lock:
+            self.failed.append(job.photo)
+        return False
@@ -0,0 +1,171 @@
+import os
+import json
+import calendar
+import threading
+
+MONTHS = {name: str(number).zfill(2) for number, name in enumerate(calendar.month_name) if name}
+
+
+def _is_year(part):
+    return len(part) == 4 and part.isdigit()
+
+
+def path_titles(path):
+    """Folder titles along a relative path. Months after a year are named, so "2020/01" is ["2020", "January"]"""
+    parts = path.split('/')
+    titles = []
+    for i, part in enumerate(parts):
+        if i and _is_year(parts[i - 1]) and part.isdigit() and 1 <= int(part) <= 12:
+            part = calendar.month_name[int(part)]
+        titles.append(part)
+    return titles
+
+
+def titles_path(titles):
+    """Relative path of a list of folder titles, the inverse of :func:`path_titles`"""
+    parts = []
+    for i, title in enumerate(titles):
+        if i and _is_year(titles[i - 1]) and title in MONTHS:
+            title = MONTHS[title]
+        parts.append(title)
+    return '/'.join(parts)
+
+
+class FolderTree:
+    """Every Drive folder, as a trie of folder titles that's built from a single listing
+
+    Can be saved to a file and kept up to date with the Drive changes feed, instead of being listed again.
+
+    :param root_id: (str) id of the Drive root folder
+    :param change_id: (int) largest Drive change id that the tree reflects
+    """
+
+    def __init__(self, root_id=None, change_id=None):
+        self.root_id = root_id
+        self.change_id = change_id
+        self.nodes = {}  # Folder id -> (title, parent id)
+        self.children = {}  # Folder id -> {title: child folder id}
+        self._lock = threading.RLock()
+
+    def add(self, folder_id, title, parent_id):
+        with self._lock:
+            self._remove(folder_id)
+            self.nodes[folder_id] = (title, parent_id)
+            self.children.setdefault(parent_id, {})[title] = folder_id
+
+    def remove(self, folder_id):
+        with self._lock:
+            self._remove(folder_id)
+
+    def _remove(self, folder_id):
+        if folder_id in self.nodes:
+            title, parent_id = self.nodes.pop(folder_id)
+            siblings = self.children.get(parent_id, {})
+            if siblings.get(title) == folder_id:
+                del siblings[title]
+
+    def add_item(self, item):
+        """Add a folder from a Drive files resource with its id, title and parents"""
+        parents = item.get('parents') or [{}]
+        self.add(item['id'], item['title'], parents[0].get('id'))
+
+    def child(self, parent_id, title):
+        return self.children.get(parent_id, {}).get(title)
+
+    def resolve(self, titles, base_id=None):
+        """Id of the folder at a list of titles below a base folder, or None if any of them is missing"""
+        folder_id = base_id or self.root_id
+        for title in titles:
+            folder_id = self.child(folder_id, title)
+            if folder_id is None:
+                return None
+        return folder_id
+
+    def paths(self, base_id):
+        """Every folder below a base folder, as a dict of relative path (see :func:`titles_path`) to id"""
+        paths = {}
+        stack = [(base_id, [])]
+        with self._lock:
+            while stack:
+                folder_id, titles = stack.pop()
+                for title, child_id in self.children.get(folder_id, {}).items():
+                    child_titles = titles + [title]
+                    paths[titles_path(child_titles)] = child_id
+                    stack.append((child_id, child_titles))
+        return paths
+
+    def save(self, path):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with self._lock, open(tmp, 'w') as f:
+            json.dump({'root_id': self.root_id, 'change_id': self.change_id, 'nodes': self.nodes}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        tree = cls(data['root_id'], data['change_id'])
+        for folder_id, (title, parent_id) in data['nodes'].items():
+            tree.add(folder_id, title, parent_id)
+        return tree
+
+
+class ContentIndex:
+    """Title, size and md5Checksum of the files in each folder, listed once per folder and updated as files are added
+
+    :param list_files: callable taking a folder id and returning the Drive files resources of its files
+    """
+
+    def __init__(self, list_files):
+        self.list_files = list_files
+        self._folders = {}  # Folder id -> {title: [file, ...]}
+        self._lock = threading.Lock()
+        self._loading = {}  # Folder id -> lock held while its files are listed
+
+    def files(self, folder_id):
+        """Files of a folder as a dict of title to a list of files with that title"""
+        if folder_id not in self._folders:
+            with self._lock:
+                loading = self._loading.setdefault(folder_id, threading.Lock())
+            with loading:
+                # Another thread may have listed the folder while this one waited
+                if folder_id not in self._folders:
+                    files = {}
+                    for item in self.list_files(folder_id):
+                        files.setdefault(item['title'], []).append(self._entry(item))
+                    self._folders[folder_id] = files
+        return self._folders[folder_id]
+
+    @staticmethod
+    def _entry(item):
+        return {
+            'id': item['id'],
+            'title': item['title'],
+            'fileSize': int(item.get('fileSize') or 0),
+            'md5Checksum': item.get('md5Checksum'),
+        }
+
+    def find(self, folder_id, title, size=None):
+        """A file in a folder with the given title, and size if provided, or None"""
+        for file in self.files(folder_id).get(title, []):
+            if size is None or file['fileSize'] == size:
+                return file
+        return None
+
+    def load(self, folder_id, items):
+        """Fill in the files of a folder that were listed elsewhere, unless it's already been listed"""
+        files = {}
+        for item in items:
+            files.setdefault(item['title'], []).append(self._entry(item))
+        with self._lock:
+            self._folders.setdefault(folder_id, files)
+        return self._folders[folder_id]
+
+    def is_loaded(self, folder_id):
+        return folder_id in self._folders
+
+    def add(self, folder_id, item):
+        """Add a newly uploaded file, if its folder has already been listed"""
+        if folder_id in self._folders:
+            with self._lock:
+                self._folders[folder_id].setdefault(item['title'], []).append(self._entry(item))
@@ -0,0 +1,187 @@
+import base64
+import sqlite3
+import datetime
+import threading
+
+
+def _date_to_ms(date):
+    """Milliseconds timestamp of local midnight at the start of a date"""
+    return int(datetime.datetime.combine(date, datetime.time.min).timestamp() * 1000)
+
+
+class AlbumIndex:
+    """On-disk SQLite index of album records, keyed by recordName
+
+    Holds enough metadata to answer date range queries, counts and histograms locally,
+    so that a re-run over a date range doesn't have to page through the album again.
+
+    :param path: (str) path of the SQLite database file
+    """
+
+    FIELDS = ('record_name', 'asset_date', 'master_ref', 'change_tag', 'filename', 'size', 'fingerprint',
+              'master_change_tag')
+
+    def __init__(self, path='pycloud_index.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS assets ("
+                "album TEXT NOT NULL, record_name TEXT NOT NULL, asset_date INTEGER NOT NULL, "
+                "master_ref TEXT, change_tag TEXT, filename TEXT, size INTEGER, fingerprint TEXT, "
+                "master_change_tag TEXT, PRIMARY KEY (album, record_name))"
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(assets)")]
+            if "master_change_tag" not in columns:
+                # Indexed before master change tags were kept, so every album is synced again to fill them in
+                self.conn.execute("ALTER TABLE assets ADD COLUMN master_change_tag TEXT")
+                self.conn.execute("DELETE FROM albums")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS assets_by_date ON assets (album, asset_date)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS albums ("
+                "album TEXT PRIMARY KEY, count INTEGER NOT NULL, synced REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def row_from_records(asset_record, master_record):
+        """Build an index row from a CPLAsset record and its CPLMaster record"""
+        fields = master_record.get("fields", {})
+        filename = fields.get("filenameEnc", {}).get("value")
+        if filename:
+            filename = base64.b64decode(filename).decode("utf-8")
+        original = fields.get("resOriginalRes", {}).get("value", {})
+        return (
+            asset_record["recordName"],
+            asset_record["fields"]["assetDate"]["value"],
+            master_record["recordName"],
+            asset_record.get("recordChangeTag"),
+            filename,
+            original.get("size"),
+            fields.get("resOriginalFingerprint", {}).get("value"),
+            master_record.get("recordChangeTag"),
+        )
+
+    def add(self, album, rows):
+        """Insert or update rows of an album"""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO assets (album, {}) VALUES ({})".format(
+                    ", ".join(self.FIELDS), ", ".join("?" * (len(self.FIELDS) + 1))),
+                [(album, *row) for row in rows]
+            )
+
+    def remove(self, record_names):
+        """Remove records from every album they're indexed in, e.g. once they're deleted from iCloud"""
+        record_names = list(record_names)
+        marks = ", ".join("?" * len(record_names))
+        with self._lock, self.conn:
+            removed = self.conn.execute(
+                f"SELECT album, COUNT(*) FROM assets WHERE record_name IN ({marks}) GROUP BY album",
+                record_names).fetchall()
+            self.conn.execute(f"DELETE FROM assets WHERE record_name IN ({marks})", record_names)
+            # Keep the synced count in step, so the index stays current for the shrunken album
+            self.conn.executemany(
+                "UPDATE albums SET count = count - ? WHERE album = ?",
+                [(count, album) for album, count in removed])
+
+    def clear(self, album):
+        """Remove every row of an album"""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM assets WHERE album = ?", (album,))
+            self.conn.execute("DELETE FROM albums WHERE album = ?", (album,))
+
+    def mark_synced(self, album, count):
+        """Record that the index holds all ``count`` records of an album"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO albums (album, count, synced) VALUES (?, ?, ?)",
+                (album, count, datetime.datetime.now().timestamp())
+            )
+
+    def synced_count(self, album):
+        """Number of records the index held when the album was last synced, or None if it never was"""
+        with self._lock:
+            synced = self.conn.execute("SELECT count FROM albums WHERE album = ?", (album,)).fetchone()
+        return synced[0] if synced else None
+
+    def newest(self, album):
+        """recordName of the newest indexed photo of an album, or None if it has none"""
+        with self._lock:
+            newest = self.conn.execute(
+                "SELECT record_name FROM assets WHERE album = ? ORDER BY asset_date DESC LIMIT 1", (album,)
+            ).fetchone()
+        return newest[0] if newest else None
+
+    def is_current(self, album, album_len, newest_record=None):
+        """Whether the index holds exactly the album's records
+
+        :param album: (str) name of the album
+        :param album_len: (int) current length of the album
+        :param newest_record: (str) recordName of the newest photo in the album, if known
+        """
+        with self._lock:
+            synced = self.conn.execute(
+                "SELECT count FROM albums WHERE album = ?", (album,)).fetchone()
+            if not synced or synced[0] != album_len or self._count(album) != album_len:
+                return False
+            if newest_record:
+                newest = self.conn.execute(
+                    "SELECT asset_date = (SELECT MAX(asset_date) FROM assets WHERE album = ?) "
+                    "FROM assets WHERE album = ? AND record_name = ?",
+                    (album, album, newest_record)).fetchone()
+                return bool(newest and newest[0])
+            return True
+
+    def _where(self, album, date_start=None, date_end=None):
+        clause, params = "album = ?", [album]
+        if date_start:
+            clause += " AND asset_date >= ?"
+            params.append(_date_to_ms(date_start))
+        if date_end:
+            # End date is inclusive
+            clause += " AND asset_date < ?"
+            params.append(_date_to_ms(date_end + datetime.timedelta(days=1)))
+        return clause, params
+
+    def _count(self, album, date_start=None, date_end=None):
+        clause, params = self._where(album, date_start, date_end)
+        return self.conn.execute(f"SELECT COUNT(*) FROM assets WHERE {clause}", params).fetchone()[0]
+
+    def count(self, album, date_start=None, date_end=None):
+        """Number of indexed photos in an album, optionally within a date range"""
+        with self._lock:
+            return self._count(album, date_start, date_end)
+
+    def select(self, album, date_start=None, date_end=None, last=None, descending=True):
+        """Rows of an album sorted by date, optionally within a date range or limited to the most recent
+
+        :return: (list) tuples with the values of :attr:`FIELDS`
+        """
+        clause, params = self._where(album, date_start, date_end)
+        query = "SELECT {} FROM assets WHERE {} ORDER BY asset_date {}".format(
+            ", ".join(self.FIELDS), clause, "DESC" if descending or last else "ASC")
+        if last:
+            query += " LIMIT ?"
+            params.append(last)
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        if last and not descending:
+            rows.reverse()
+        return rows
+
+    def histogram(self, album, date_start=None, date_end=None):
+        """Number of indexed photos per month, as a dict of "YYYY/mm" to count"""
+        clause, params = self._where(album, date_start, date_end)
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT strftime('%Y/%m', asset_date / 1000, 'unixepoch', 'localtime') AS month, COUNT(*) "
+                f"FROM assets WHERE {clause} GROUP BY month ORDER BY month", params
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,106 @@
+import time
+import sqlite3
+import threading
+
+
+class TransferJournal:
+    """Durable record of how far each photo got through a transfer, keyed by its asset recordName
+
+    Every entry is loaded into memory when the journal is opened, so looking up where a photo should
+    resume takes constant time. Updates are written to SQLite in batches: a commit (and its fsync) happens
+    once ``batch_size`` updates are pending or ``flush_interval`` seconds have passed, so a crash can lose
+    at most the last batch.
+
+    :param path: (str) path of the SQLite database file
+    :param batch_size: (int) pending updates that trigger a commit
+    :param flush_interval: (float) max seconds an update stays uncommitted
+    """
+
+    DOWNLOADED = 'downloaded'
+    MISMATCH = 'mismatch'  # Uploaded, but the file in Drive doesn't match the MD5 of the photo
+    UPLOADED = 'uploaded'
+    VERIFIED = 'verified'
+    DELETED = 'deleted'
+    STAGES = (DOWNLOADED, MISMATCH, UPLOADED, VERIFIED, DELETED)
+
+    FIELDS = ('stage', 'filename', 'date_path', 'download_path', 'drive_id', 'md5')
+
+    def __init__(self, path='pycloud_journal.db', batch_size=50, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Processes sharing the file wait for each other's commits
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS transfers ("
+                "record_name TEXT PRIMARY KEY, stage TEXT NOT NULL, filename TEXT, date_path TEXT, "
+                "download_path TEXT, drive_id TEXT, md5 TEXT, updated REAL NOT NULL)"
+            )
+        self._entries = self._load()
+
+    def _load(self):
+        return {
+            row[0]: dict(zip(self.FIELDS, row[1:]))
+            for row in self.conn.execute(
+                "SELECT record_name, {} FROM transfers".format(", ".join(self.FIELDS)))
+        }
+
+    def reload(self):
+        """Commit pending updates, then load the entries committed since, e.g. by other processes sharing the file"""
+        with self._lock:
+            self._flush()
+            self._entries = self._load()
+
+    def get(self, record_name):
+        """Journal entry of a photo as a dict of :attr:`FIELDS`, or None if it was never started"""
+        return self._entries.get(record_name)
+
+    def stage(self, record_name):
+        """Last completed stage of a photo, or None"""
+        entry = self._entries.get(record_name)
+        return entry['stage'] if entry else None
+
+    def reached(self, record_name, stage):
+        """Whether a photo has completed the given stage"""
+        last = self.stage(record_name)
+        return last is not None and self.STAGES.index(last) >= self.STAGES.index(stage)
+
+    def record(self, record_name, stage, **fields):
+        """Record that a photo completed a stage, along with any of the other :attr:`FIELDS`"""
+        if stage not in self.STAGES:
+            raise ValueError('Not a valid stage. Valid stages: {}'.format([s for s in self.STAGES]))
+
+        with self._lock:
+            entry = self._entries.setdefault(record_name, dict.fromkeys(self.FIELDS))
+            entry.update(fields, stage=stage)
+            self._pending[record_name] = dict(entry)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._flushed_at > self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """Commit every pending update"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO transfers (record_name, {}, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(
+                        ", ".join(self.FIELDS)),
+                    [(name, *(entry[f] for f in self.FIELDS), now) for name, entry in self._pending.items()]
+                )
+            self._pending = {}
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
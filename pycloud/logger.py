@@ -1,7 +1,82 @@
-import logging
 import sys
-from pycloud.utils import convert_bytes
-logging.basicConfig(filename='pycloud.log', level=logging.DEBUG)
+import queue
+import atexit
+import logging
+import logging.handlers
+import collections.abc
+
+# Logger that the loggers of every PyCloudLogger are children of, so that only their records are handled
+LOGGER_NAME = 'pycloud'
+
+_listener = None
+
+
+def setup_logging(filename='pycloud.log', level=logging.DEBUG):
+    """Send log records through a queue, so that writing them to disk never blocks the calling thread
+
+    Records of the :data:`LOGGER_NAME` loggers are written to ``filename`` and to stdout (INFO and up) by a
+    background listener thread, while those of other libraries are left to their own configuration.
+    Only the first call has any effect, so it must come before the first PyCloudLogger is created to
+    change the file.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = logging.Formatter(
+        fmt="%(asctime)s %(levelname)-2s  %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S")
+    stdout_handler = logging.StreamHandler(stream=sys.stdout)
+    stdout_handler.setFormatter(formatter)
+    stdout_handler.setLevel(logging.INFO)
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    file_handler.setLevel(level)
+
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stdout_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+class _Message:
+    """Log message that's only formatted if the record is actually emitted"""
+
+    __slots__ = ('name', 'msg', 'args', 'storage')
+
+    def __init__(self, name, msg, args, storage):
+        self.name = name
+        self.msg = msg
+        # Like logging.LogRecord, a single mapping is used for "%(name)s" style formatting
+        if len(args) == 1 and isinstance(args[0], collections.abc.Mapping) and args[0]:
+            args = args[0]
+        self.args = args
+        self.storage = storage
+
+    def __str__(self):
+        new_msg = "|[{name}]|:{tabs}{message}".format(
+            name=self.name,
+            tabs='\t\t\t',
+            message=self.msg % self.args if self.args else self.msg
+        )
+        if self.storage:
+            # Imported here so that logging doesn't pull in the iCloud dependencies of pycloud.utils
+            from pycloud.utils import convert_bytes
+
+            # Google Drive API provides information about storage usage
+            used, total = self.storage
+            new_msg += "\t  ||  [{used:.2f}/{total:.2f}GB] ".format(
+                used=convert_bytes(used, 'GB'),
+                total=convert_bytes(total, 'GB')
+            )
+        return new_msg
 
 
 class PyCloudLogger:
@@ -20,54 +95,28 @@ class PyCloudLogger:
         self.logger = self.setup_logger()
 
     def setup_logger(self):
-        logger = logging.getLogger(name=self.name)
-        handler_name = f'{self.name}_stdoutLogger'
-
-        for handler in logger.handlers:
-            if handler.name == handler_name:
-                return logger
-
-        formatter = logging.Formatter(
-            fmt="%(asctime)s %(levelname)-2s  %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S")
-        stdout_handler = logging.StreamHandler(stream=sys.stdout)
-        stdout_handler.setFormatter(formatter)
-        stdout_handler.setLevel(logging.INFO)
-        stdout_handler.name = handler_name
-        logger.addHandler(stdout_handler)
+        setup_logging()
+        return logging.getLogger(name=f'{LOGGER_NAME}.{self.name}')
 
-        return logger
+    def format_msg(self, msg, *args):
+        storage = None
+        if hasattr(self.obj, 'storage_snapshot'):
+            # Use the last known storage usage; never make a network call just to log a message
+            storage = self.obj.storage_snapshot()
+        return _Message(self.name, msg, args, storage)
 
-    def format_msg(self, msg):
-        new_msg = "|[{name}]|:{tabs}{message}".format(
-            name=self.name,
-            tabs='\t\t\t',
-            message=msg
-        )
-        if hasattr(self.obj, 'used_storage') and hasattr(self.obj, 'total_storage'):
-            # Google Drive API provides information about storage usage
-            new_msg += "\t  ||  [{used:.2f}/{total:.2f}GB] ".format(
-                used = convert_bytes(self.obj.used_storage, 'GB'),
-                total = convert_bytes(self.obj.total_storage, 'GB')
-            )
-        return new_msg
+    def log(self, level, msg, *args):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, self.format_msg(msg, *args))
 
-    def info(self, msg):
-        return self.logger.info(
-            self.format_msg(msg)
-        )
+    def info(self, msg, *args):
+        return self.log(logging.INFO, msg, *args)
 
-    def debug(self, msg):
-        return self.logger.debug(
-            self.format_msg(msg)
-        )
+    def debug(self, msg, *args):
+        return self.log(logging.DEBUG, msg, *args)
 
-    def warning(self, msg):
-        return self.logger.warning(
-            self.format_msg(msg)
-        )
+    def warning(self, msg, *args):
+        return self.log(logging.WARNING, msg, *args)
 
-    def error(self, msg):
-        return self.logger.error(
-            self.format_msg(msg)
-        )
+    def error(self, msg, *args):
+        return self.log(logging.ERROR, msg, *args)
@@ -0,0 +1,302 @@
+import os
+import json
+import math
+import time
+import threading
+import contextlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, math.inf)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    """A named metric with a value per combination of label values
+
+    :param name: (str) metric name
+    :param help: (str) description of the metric
+    :param labels: (tuple) label names
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """Tuples of (suffix, label values, extra labels, value) of every sample to expose"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def summary(self):
+        with self._lock:
+            return self._summarize(dict(self._values))
+
+    def _summarize(self, values):
+        if not self.labels:
+            return values.get((), 0)
+        return {','.join(key): value for key, value in values.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Metric that's set to a value, or read from a function whenever it's exposed"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def _read(self):
+        with self._lock:
+            values, functions = dict(self._values), dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                values[key] = math.nan
+        return values
+
+    def samples(self):
+        return [('', key, (), value) for key, value in self._read().items()]
+
+    def summary(self):
+        return self._summarize(self._read())
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets
+
+    :param buckets: (tuple) upper bounds of the buckets, ending with infinity
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+            state['max'] = max(state['max'], value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the seconds taken by the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state['counts']):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_sum', key, (), state['sum']))
+                samples.append(('_count', key, (), state['count']))
+        return samples
+
+    def _summarize(self, values):
+        values = {
+            key: {
+                'count': state['count'],
+                'sum': round(state['sum'], 6),
+                'mean': round(state['sum'] / state['count'], 6) if state['count'] else 0.0,
+                'max': round(state['max'], 6),
+            }
+            for key, state in values.items()
+        }
+        return super()._summarize(values)
+
+
+class Metrics:
+    """Registry of the metrics of a transfer run, exposed in the Prometheus text format or as a JSON summary
+
+    Metrics are created on first use, so any component can share a registry without declaring its metrics
+    up front. Names are prefixed with ``prefix``.
+
+    :param prefix: (str) prefix of every metric name
+    """
+
+    def __init__(self, prefix='pycloud'):
+        self.prefix = prefix
+        self.started = time.time()
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        name = f'{self.prefix}_{name}'
+        if name not in self._metrics:
+            with self._lock:
+                if name not in self._metrics:
+                    self._metrics[name] = cls(name, help, labels, **kwargs)
+        metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError(f'Metric {name} is already registered as a {metric.type}')
+        return metric
+
+    def counter(self, name, help='', labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=(), buckets=BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(metric.labels, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Every metric as a dict, with histograms reduced to their count, sum, mean and max"""
+        return {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'metrics': {metric.name: metric.summary() for metric in list(self._metrics.values())},
+        }
+
+    def write_textfile(self, path):
+        """Write the metrics for the node_exporter textfile collector, replacing the file atomically"""
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def write_summary(self, path):
+        """Write the JSON summary of the metrics"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, default=str)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        content = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MetricsServer:
+    """Serves the metrics at /metrics on a local HTTP endpoint, from a background thread
+
+    :param metrics: (Metrics) registry to serve
+    :param port: (int) port to listen on
+    :param host: (str) address to listen on
+    """
+
+    def __init__(self, metrics, port=9464, host='127.0.0.1'):
+        self._httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.metrics = metrics
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics-server', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class TextfileWriter:
+    """Writes the metrics to a textfile collector file every ``interval`` seconds, and once more when closed
+
+    :param metrics: (Metrics) registry to write
+    :param path: (str) path of the .prom file
+    :param interval: (float) seconds between writes
+    """
+
+    def __init__(self, metrics, path, interval=15.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._write_periodically, name='metrics-textfile', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.metrics.write_textfile(self.path)
+
+    def _write_periodically(self):
+        while not self._closed.wait(self.interval):
+            self.metrics.write_textfile(self.path)
@@ -0,0 +1,254 @@
+import os
+import json
+import math
+import datetime
+
+from pycloud.utils import convert_bytes
+
+# Assumed bytes per second of a single worker of each stage, when none was measured or configured
+DEFAULT_THROUGHPUT = {
+    'download': 8 * 1024 * 1024,
+    'upload': 4 * 1024 * 1024,
+    'stream': 4 * 1024 * 1024,
+}
+
+
+def measured_throughput(summary, prefix='pycloud'):
+    """Bytes per second of a single worker of each stage, measured by an earlier run
+
+    Each stage's bytes are divided by the total time its workers spent handling jobs, so the result doesn't
+    depend on how many workers that run had.
+
+    :param summary: (dict) summary written by :meth:`Metrics.write_summary`, or the path of its JSON file
+    :param prefix: (str) prefix of the metric names
+    :return: (dict) stage name -> bytes per second, for every stage that moved any bytes
+    """
+    if isinstance(summary, str):
+        with open(summary) as f:
+            summary = json.load(f)
+    metrics = summary.get('metrics', {})
+    moved = metrics.get(f'{prefix}_bytes_total') or {}
+    busy = metrics.get(f'{prefix}_stage_seconds') or {}
+
+    throughput = {}
+    # Streamed bytes are counted once they're uploaded
+    for stage, counted_as in (('download', 'download'), ('upload', 'upload'), ('stream', 'upload')):
+        seconds = busy.get(stage, {}).get('sum')
+        if seconds and moved.get(counted_as):
+            throughput[stage] = moved[counted_as] / seconds
+    return throughput
+
+
+def _format_bytes(size):
+    return f'{convert_bytes(size, "GB"):.2f} GB'
+
+
+class FolderPlan:
+    """Photos that a transfer would put in one Drive folder"""
+
+    __slots__ = ('path', 'assets', 'bytes', 'exists')
+
+    def __init__(self, path, exists=False):
+        self.path = path
+        self.assets = 0
+        self.bytes = 0
+        self.exists = exists
+
+
+class TransferPlan:
+    """What a transfer of an album would do, as sized by :meth:`TransferPlanner.plan`
+
+    ``folders`` maps the relative path of each destination folder to its :class:`FolderPlan`, and
+    ``missing_folders`` holds every folder that would be created, including parents. Photos are packed
+    into the ``available`` Drive quota in listing order, like :class:`TransferEngine` does, so ``fit_assets``
+    and ``fit_bytes`` count the photos that would be transferred. ``requests`` holds the expected number
+    of requests of each endpoint family, and ``durations`` the expected seconds of each stage and family.
+    """
+
+    def __init__(self, album, date_start=None, date_end=None):
+        self.album = album
+        self.date_start = date_start
+        self.date_end = date_end
+        self.folders = {}
+        self.missing_folders = []
+        self.assets = 0
+        self.bytes = 0
+        self.fit_assets = 0
+        self.fit_bytes = 0
+        self.available = 0
+        self.requests = {}
+        self.throughput = {}
+        self.durations = {}
+
+    @property
+    def eta(self):
+        """Expected seconds of the transfer. Stages run concurrently, so it's that of the slowest one"""
+        return max(self.durations.values(), default=0.0)
+
+    @property
+    def bottleneck(self):
+        """Stage or endpoint family that the transfer is expected to wait on"""
+        return max(self.durations, key=self.durations.get) if self.durations else None
+
+    def summary(self):
+        """The plan as a dict, e.g. to be written as JSON"""
+        return {
+            'album': self.album,
+            'date_start': self.date_start,
+            'date_end': self.date_end,
+            'assets': self.assets,
+            'bytes': self.bytes,
+            'fit_assets': self.fit_assets,
+            'fit_bytes': self.fit_bytes,
+            'available': self.available,
+            'folders': {
+                path: {'assets': folder.assets, 'bytes': folder.bytes, 'exists': folder.exists}
+                for path, folder in self.folders.items()
+            },
+            'missing_folders': self.missing_folders,
+            'requests': self.requests,
+            'throughput': self.throughput,
+            'durations': self.durations,
+            'eta': self.eta,
+            'bottleneck': self.bottleneck,
+        }
+
+    def report(self):
+        """Readable report of the plan, as a list of lines"""
+        lines = [f'Plan for album {self.album} from {self.date_start or "the start"} to {self.date_end or "today"}']
+        for path in sorted(self.folders):
+            folder = self.folders[path]
+            lines.append(f'  {path}: {folder.assets} photos, {_format_bytes(folder.bytes)}'
+                         + ('' if folder.exists else ' (new folder)'))
+        lines.append(f'Total: {self.assets} photos, {_format_bytes(self.bytes)}')
+        lines.append(f'Fit in the {_format_bytes(self.available)} available in Google Drive: '
+                     f'{self.fit_assets} photos, {_format_bytes(self.fit_bytes)}'
+                     + (f' ({self.assets - self.fit_assets} don\'t fit)' if self.fit_assets < self.assets else ''))
+        lines.append(f'Folders to create: {", ".join(self.missing_folders) or "none"}')
+        lines.append('Requests: ' + ', '.join(f'{family} {count}' for family, count in self.requests.items()))
+        lines.append('Throughput per worker: ' + ', '.join(
+            f'{stage} {convert_bytes(rate):.1f} MB/s ({source})' for stage, (rate, source) in self.throughput.items()))
+        lines.append(f'ETA: {datetime.timedelta(seconds=round(self.eta))}, limited by {self.bottleneck}')
+        return lines
+
+
+class TransferPlanner:
+    """Sizes a transfer before it runs, without downloading anything
+
+    Photos are listed with the cheap ``simple=True`` metadata, which comes from the album index when it's
+    current. The expected time of each stage comes from its throughput per worker, which is taken from
+    ``throughput`` if configured, measured from the metrics summary of an earlier run if there is one, or
+    else assumed from :data:`DEFAULT_THROUGHPUT`. The expected time of each endpoint family comes from
+    its rate limit in the :class:`RequestScheduler` of the Drive service.
+
+    :param cloud: (iCloud) logged in iCloud service
+    :param drive: (gDrive) Google Drive service
+    :param download_workers: (int) download workers the transfer would have
+    :param upload_workers: (int) upload or stream workers the transfer would have
+    :param queue_size: (int) max jobs the transfer would have waiting between two stages
+    :param stream: (bool) whether the transfer would stream downloads into uploads
+    :param delete: (bool) whether the transfer would delete photos from iCloud
+    :param delete_batch_size: (int) max number of photos deleted per iCloud request
+    :param throughput: (dict) stage name -> bytes per second of a single worker
+    :param metrics_summary: (str) path of the metrics summary of an earlier run, to measure throughput from
+    """
+
+    def __init__(self, cloud, drive, download_workers=4, upload_workers=4, queue_size=8, stream=False, delete=True,
+                 delete_batch_size=100, throughput=None, metrics_summary=None):
+        self.cloud = cloud
+        self.drive = drive
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.stream = stream
+        self.delete = delete
+        self.delete_batch_size = delete_batch_size
+
+        measured = {}
+        if metrics_summary and os.path.exists(metrics_summary):
+            measured = measured_throughput(metrics_summary)
+        self.throughput = {}
+        for stage, default in DEFAULT_THROUGHPUT.items():
+            if stage in (throughput or {}):
+                self.throughput[stage] = (throughput[stage], 'configured')
+            elif stage in measured:
+                self.throughput[stage] = (measured[stage], 'measured')
+            else:
+                self.throughput[stage] = (default, 'assumed')
+
+    def upload_requests(self, size):
+        """Requests needed to upload a file: one multipart request, or a session and its chunks"""
+        if not self.stream and size < self.drive.multipart_threshold:
+            return 1
+        return 1 + max(1, math.ceil(size / self.drive.chunk_size))
+
+    def plan(self, album, date_start=None, date_end=None):
+        """Size a transfer of the photos of an album in a date range
+
+        :param album: (FilterAlbum) album to transfer
+        :param date_start: (datetime.date) start date of the range
+        :param date_end: (datetime.date) end date of the range (inclusive)
+        :return: (TransferPlan)
+        """
+        plan = TransferPlan(album.name, date_start, date_end)
+        plan.available = remaining = self.drive.quota.available
+        uploads = 0
+
+        for photo in album.fetch_photos(date_start=date_start, date_end=date_end, simple=True, compact=True):
+            size = photo.size or 0
+            path = self.cloud.date_path(photo)
+            folder = plan.folders.get(path)
+            if folder is None:
+                folder = plan.folders[path] = FolderPlan(path, exists=bool(self.drive.folders.get(path)))
+            folder.assets += 1
+            folder.bytes += size
+            plan.assets += 1
+            plan.bytes += size
+            if size <= remaining:
+                remaining -= size
+                plan.fit_assets += 1
+                plan.fit_bytes += size
+                uploads += self.upload_requests(size)
+
+        missing = self.drive.missing_folders(plan.folders)
+        plan.missing_folders = sorted(missing)
+        # Folders are created in one batch request per level, and each destination folder is listed once
+        folder_batches = sum(
+            math.ceil(count / self.drive.BATCH_SIZE)
+            for count in _count_by_depth(missing).values()
+        )
+
+        # Download URLs are refreshed with a lookup per batch of photos queued for download, as TransferEngine does
+        lookup_batch = min(album.page_size, self.queue_size + max(self.download_workers, self.upload_workers))
+        plan.requests = {
+            # Listing pages, then the lookups
+            'icloud.query': math.ceil(plan.assets / album.page_size) + math.ceil(plan.fit_assets / lookup_batch),
+            'icloud.download': plan.fit_assets,
+            'drive.metadata': folder_batches + len(plan.folders),
+            'drive.upload': uploads,
+        }
+        if self.delete:
+            plan.requests['icloud.modify'] = math.ceil(plan.fit_assets / self.delete_batch_size)
+
+        if self.stream:
+            workers = {'stream': self.upload_workers}
+        else:
+            workers = {'download': self.download_workers, 'upload': self.upload_workers}
+        for stage, count in workers.items():
+            plan.throughput[stage] = self.throughput[stage]
+            plan.durations[stage] = plan.fit_bytes / (self.throughput[stage][0] * count)
+
+        limits = self.drive.scheduler.limits
+        for family, count in plan.requests.items():
+            rate = limits.get(family, {}).get('rate')
+            if rate:
+                plan.durations[family] = count / rate
+        return plan
+
+
+def _count_by_depth(paths):
+    counts = {}
+    for path in paths:
+        depth = path.count('/')
+        counts[depth] = counts.get(depth, 0) + 1
+    return counts
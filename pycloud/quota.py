@@ -0,0 +1,85 @@
+import time
+import threading
+
+
+class QuotaTracker:
+    """Keeps a local account of Google Drive storage so that quota checks don't need a network call
+
+    Quota is fetched from Drive once, then kept up to date by adding the size of each uploaded file
+    locally. It's only fetched again after ``resync_interval`` seconds, or after an upload error
+    leaves the local account in doubt.
+
+    Bytes are reserved for a file before it's transferred, so concurrent uploads can't
+    overshoot the quota together.
+
+    :param fetch: callable returning a Drive "about" resource
+    :param resync_interval: (int) seconds before the local account is refreshed from Drive
+    """
+
+    def __init__(self, fetch, resync_interval=600):
+        self.fetch = fetch
+        self.resync_interval = resync_interval
+        self.total = 0
+        self.used = 0
+        self.reserved = 0
+        self._synced_at = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """Fetch quotaBytesTotal/Used/UsedInTrash from Drive"""
+        about = self.fetch()
+        with self._lock:
+            self.total = int(about['quotaBytesTotal'])
+            self.used = int(about['quotaBytesUsed']) + int(about['quotaBytesUsedInTrash'])
+            self._synced_at = time.monotonic()
+            self._stale = False
+
+    def ensure_synced(self):
+        """Fetch quota from Drive if it has never been fetched, is stale, or the resync interval has passed"""
+        if self._stale or time.monotonic() - self._synced_at > self.resync_interval:
+            self.sync()
+
+    @property
+    def available(self):
+        """Bytes that can still be reserved"""
+        self.ensure_synced()
+        return self.total - self.used - self.reserved
+
+    def fits(self, size):
+        """Whether a file of the given size would fit once every current reservation is released"""
+        self.ensure_synced()
+        return size <= self.total - self.used
+
+    def reserve(self, size):
+        """Reserve bytes for a file about to be transferred. Returns False if it doesn't fit"""
+        self.ensure_synced()
+        with self._lock:
+            if size > self.total - self.used - self.reserved:
+                return False
+            self.reserved += size
+            return True
+
+    def commit(self, size):
+        """Count reserved bytes as used once the file has been uploaded"""
+        with self._lock:
+            self.reserved -= size
+            self.used += size
+
+    def release(self, size, error=False):
+        """Give back reserved bytes for a file that wasn't uploaded
+
+        :param size: (int) number of reserved bytes
+        :param error: (bool) whether an upload error occurred, in which case Drive may have stored part
+            of the file, so the local account is refreshed on next use
+        """
+        with self._lock:
+            self.reserved -= size
+            if error:
+                self._stale = True
+
+    def snapshot(self):
+        """The last known (used, total) bytes, without making any network calls"""
+        if self._synced_at is None:
+            return None
+        return self.used, self.total
@@ -0,0 +1,306 @@
+import time
+import random
+import threading
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from pycloud.logger import PyCloudLogger
+
+# Statuses that mean the provider is throttling requests. iCloud answers 421 and 503 when overloaded
+THROTTLE_STATUSES = (421, 429, 503)
+
+# Statuses of transient server errors, which are retried without backing off the concurrency limit
+TRANSIENT_STATUSES = (500, 502, 504)
+
+# Drive answers 403 for these reasons when a rate limit is exceeded, instead of 429
+RATE_LIMIT_REASONS = ('ratelimitexceeded', 'userratelimitexceeded')
+
+# Exceptions of a connection that failed, was reset or timed out. httplib2 raises the socket errors as they are,
+# while requests wraps them in its own
+CONNECTION_ERRORS = (ConnectionError, TimeoutError)
+if requests is not None:
+    CONNECTION_ERRORS += (requests.ConnectionError, requests.Timeout)
+
+# Requests per second, burst size and starting concurrency of each endpoint family
+DEFAULT_LIMITS = {
+    'drive.metadata': {'rate': 10.0, 'burst': 20, 'concurrency': 8},
+    'drive.upload': {'rate': 5.0, 'burst': 10, 'concurrency': 4},
+    'icloud.query': {'rate': 10.0, 'burst': 10, 'concurrency': 4},
+    'icloud.modify': {'rate': 2.0, 'burst': 4, 'concurrency': 2},
+    'icloud.download': {'rate': 20.0, 'burst': 20, 'concurrency': 8},
+}
+
+
+def _status(result, reasons=''):
+    """HTTP status of a response or exception from a request, or None if it has none, and its lowercase reasons"""
+    status, reasons = None, reasons.lower()
+    if hasattr(result, 'status_code'):
+        # requests Response
+        status = result.status_code
+    elif isinstance(getattr(result, 'status', None), int):
+        # aiohttp ClientResponse
+        status = result.status
+    elif isinstance(getattr(result, 'error', None), dict):
+        # PyDrive2 ApiRequestError, which holds the decoded error of the HttpError it wraps
+        status = result.error.get('code')
+        reasons = str(result.error.get('errors', '')).lower()
+    elif getattr(result, 'resp', None) is not None:
+        # googleapiclient HttpError
+        status = getattr(result.resp, 'status', None)
+        reasons = str(getattr(result, 'content', b'')).lower()
+    elif isinstance(getattr(result, 'code', None), int):
+        # PyiCloudAPIResponseException
+        status = result.code
+
+    try:
+        return int(status), reasons
+    except (TypeError, ValueError):
+        return None, reasons
+
+
+def _rate_limited(status, reasons):
+    return status == 429 or (status == 403 and any(reason in reasons for reason in RATE_LIMIT_REASONS))
+
+
+def classify(result, reasons=''):
+    """Whether a response or exception from a request should be retried
+
+    :param result: a requests or aiohttp response, or the exception raised by a request
+    :param reasons: (str) body of the response, if it's read separately, as for aiohttp
+    :return: (str) "throttled", "transient", or None if it shouldn't be retried
+    """
+    if isinstance(result, CONNECTION_ERRORS):
+        return 'transient'
+    status, reasons = _status(result, reasons)
+    if status is None:
+        return None
+    if status in THROTTLE_STATUSES or _rate_limited(status, reasons):
+        return 'throttled'
+    if status in TRANSIENT_STATUSES:
+        return 'transient'
+    return None
+
+
+def rejected(result, reasons=''):
+    """Whether the provider turned a request down for a rate limit, before handling it
+
+    Only such requests are safe to retry when they aren't idempotent, such as creating a file or folder.
+    After a server error or a dropped connection, the request may have been applied anyway.
+
+    :param result: a requests or aiohttp response, or the exception raised by a request
+    :param reasons: (str) body of the response, if it's read separately, as for aiohttp
+    """
+    return _rate_limited(*_status(result, reasons))
+
+
+def retry_after(result):
+    """Seconds the provider asked to wait before retrying, from the Retry-After header if there is one"""
+    headers = getattr(result, 'headers', None)
+    if headers is None and getattr(result, 'resp', None) is not None:
+        headers = result.resp
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows ``rate`` requests per second on average, with bursts of up to ``burst`` requests
+
+    :param rate: (float) tokens added per second
+    :param burst: (int) max tokens held
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available"""
+        while wait := self.take():
+            time.sleep(wait)
+
+    def take(self):
+        """Take a token if one is available, without blocking. Returns 0, or the seconds until one will be"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows additively while requests succeed, and is cut multiplicatively when throttled
+
+    The limit grows by ``increase`` once every ``limit`` successful requests, and is multiplied by
+    ``decrease`` when a request is throttled. Throttled requests that were already in flight when the
+    limit was cut don't cut it again, for ``cooldown`` seconds.
+
+    :param initial: (int) starting limit
+    :param minimum: (int) lowest limit
+    :param maximum: (int) highest limit
+    :param increase: (float) growth of the limit per window of successful requests
+    :param decrease: (float) factor the limit is multiplied by when throttled
+    :param cooldown: (float) seconds after a cut during which throttling doesn't cut the limit again
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1.0, decrease=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._cut_at = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """Take a slot if the limit allows it, without blocking. Returns whether it was taken"""
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                if self._cut_at is None or now - self._cut_at > self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._cut_at = now
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+
+class EndpointFamily:
+    """Token bucket, concurrency limit and counters shared by a group of requests to the same provider"""
+
+    def __init__(self, name, rate, burst=None, concurrency=4, max_concurrency=64):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AIMDLimiter(initial=concurrency, maximum=max(concurrency, max_concurrency))
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0}
+
+
+class RequestScheduler:
+    """Paces every API request through the token bucket and AIMD concurrency limit of its endpoint family
+
+    Throttled and transient failures are retried after a jittered exponential backoff (or the provider's
+    Retry-After), and throttling also cuts the family's concurrency limit, which then grows back as
+    requests succeed. One scheduler should be shared by every service, so they all see the same limits.
+
+    :param limits: (dict) family name -> dict of rate, burst and concurrency, overriding :data:`DEFAULT_LIMITS`
+    :param retries: (int) max retries of a request
+    :param base_delay: (float) seconds of backoff before the first retry
+    :param max_delay: (float) max seconds of backoff
+    :param max_concurrency: (int) highest concurrency limit of any family
+    :param metrics: (Metrics) registry to count requests, errors and latency per family in
+    """
+
+    def __init__(self, limits=None, retries=5, base_delay=1.0, max_delay=64.0, max_concurrency=64, metrics=None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.metrics = metrics
+        self.families = {}
+        self.logger = PyCloudLogger(name='RequestScheduler')
+        self._lock = threading.Lock()
+
+    def family(self, name):
+        """Endpoint family by name, created from its limits on first use"""
+        if name not in self.families:
+            with self._lock:
+                if name not in self.families:
+                    limits = self.limits.get(name, {'rate': 10.0})
+                    self.families[name] = EndpointFamily(name, max_concurrency=self.max_concurrency, **limits)
+        return self.families[name]
+
+    def backoff(self, attempt, result=None):
+        """Seconds to wait before a retry: the provider's Retry-After, or full jitter exponential backoff"""
+        delay = retry_after(result)
+        if delay is not None:
+            return min(delay, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, family, func, *args, idempotent=True, **kwargs):
+        """Call a function that makes a request of an endpoint family, retrying it when throttled
+
+        Exceptions that aren't throttling, transient or connection errors are raised right away. A response
+        whose status is still throttled after the last retry is returned to the caller as is.
+
+        :param idempotent: (bool) False for requests that create something, such as a file or folder, which are
+            only retried when the provider rejected them for a rate limit, so they can't be applied twice
+        """
+        family = self.family(family)
+        for attempt in range(self.retries + 1):
+            family.limiter.acquire()
+            family.bucket.acquire()
+            family.stats['requests'] += 1
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                result, error = e, e
+            else:
+                error = None
+            kind = classify(result)
+            family.limiter.release(throttled=kind == 'throttled')
+            self.observe(family, time.perf_counter() - start, kind or ('error' if error else None))
+
+            if kind is None or attempt == self.retries or not (idempotent or rejected(result)):
+                if error is not None:
+                    raise error
+                return result
+
+            if kind == 'throttled':
+                family.stats['throttled'] += 1
+            family.stats['retries'] += 1
+            delay = self.backoff(attempt, result)
+            self.logger.debug('%s request %s (%s), retrying in %.1fs with concurrency %d',
+                              family.name, kind, error or getattr(result, 'status_code', ''), delay,
+                              int(family.limiter.limit))
+            time.sleep(delay)
+
+    def observe(self, family, elapsed, error=None):
+        """Record a request of an endpoint family in the metrics, along with the kind of error it failed with"""
+        if self.metrics is None:
+            return
+        self.metrics.counter('requests_total', 'API requests by endpoint family', ('family',)).inc(family=family.name)
+        self.metrics.histogram(
+            'request_seconds', 'Latency of API requests by endpoint family', ('family',)
+        ).observe(elapsed, family=family.name)
+        if error:
+            self.metrics.counter(
+                'request_errors_total', 'Failed API requests by endpoint family and kind of error', ('family', 'kind')
+            ).inc(family=family.name, kind=error)
+        self.metrics.gauge(
+            'request_concurrency', 'Concurrency limit of each endpoint family', ('family',)
+        ).set(int(family.limiter.limit), family=family.name)
+
+    def stats(self):
+        """Counters and current concurrency limit of every family"""
+        return {
+            name: {**family.stats, 'concurrency': int(family.limiter.limit)}
+            for name, family in self.families.items()
+        }
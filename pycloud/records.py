@@ -0,0 +1,215 @@
+import base64
+import datetime
+import threading
+import collections
+
+from concurrent.futures import Future
+
+
+class AssetRecord:
+    """Compact stand-in for a PhotoAsset, holding only the fields a transfer needs
+
+    A PhotoAsset keeps the whole CPLAsset and CPLMaster records, with dozens of fields each, while this
+    keeps a few scalars in slots, so hundreds of thousands of them fit in a small worker's memory.
+
+    Download URLs aren't kept, since they're large and expire. When a photo is about to be downloaded,
+    :meth:`promote` looks up its records again and returns a full PhotoAsset with fresh URLs. Many photos
+    are promoted with a request per page by :func:`promote_all`, or by a :class:`Promoter`.
+
+    :param album: (FilterAlbum) album the photo was listed from, used to look its records up again
+    """
+
+    __slots__ = ('record_name', 'record_type', 'asset_change_tag', 'master_name', 'master_change_tag',
+                 'asset_date', 'filename', 'size', 'fingerprint', '_album')
+
+    def __init__(self, album, record_name, master_name, asset_date, filename=None, size=None, fingerprint=None,
+                 record_type='CPLAsset', asset_change_tag=None, master_change_tag=None):
+        self._album = album
+        self.record_name = record_name
+        self.record_type = record_type
+        self.asset_change_tag = asset_change_tag
+        self.master_name = master_name
+        self.master_change_tag = master_change_tag
+        self.asset_date = asset_date
+        self.filename = filename
+        self.size = size
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_records(cls, album, asset_record, master_record):
+        """Build a compact record from a CPLAsset record and its CPLMaster record"""
+        fields = master_record.get('fields', {})
+        filename = fields.get('filenameEnc', {}).get('value')
+        if filename:
+            filename = base64.b64decode(filename).decode('utf-8')
+        return cls(
+            album,
+            asset_record['recordName'],
+            master_record['recordName'],
+            asset_record['fields']['assetDate']['value'],
+            filename=filename,
+            size=fields.get('resOriginalRes', {}).get('value', {}).get('size'),
+            fingerprint=fields.get('resOriginalFingerprint', {}).get('value'),
+            record_type=asset_record.get('recordType', 'CPLAsset'),
+            asset_change_tag=asset_record.get('recordChangeTag'),
+            master_change_tag=master_record.get('recordChangeTag'),
+        )
+
+    @property
+    def id(self):
+        return self.record_name
+
+    @property
+    def created(self):
+        return datetime.datetime.fromtimestamp(self.asset_date / 1000, tz=datetime.timezone.utc)
+
+    @property
+    def _asset_record(self):
+        """Minimal CPLAsset record, for code written against PhotoAsset"""
+        return {
+            'recordName': self.record_name,
+            'recordType': self.record_type,
+            'recordChangeTag': self.asset_change_tag,
+            'fields': {
+                'assetDate': {'value': self.asset_date},
+                'masterRef': {'value': {'recordName': self.master_name}},
+            },
+        }
+
+    @property
+    def _master_record(self):
+        """Minimal CPLMaster record, for code written against PhotoAsset"""
+        return {'recordName': self.master_name, 'recordChangeTag': self.master_change_tag}
+
+    def promote(self, profile='transfer'):
+        """Full PhotoAsset of the photo, with fresh download URLs. It isn't kept, so it's freed once used
+
+        :raises LookupError: if the photo no longer exists in iCloud
+        """
+        asset = promote_all([self], profile).get(self.record_name)
+        if asset is None:
+            raise LookupError(f'{self.filename} ({self.record_name}) no longer exists in iCloud')
+        return asset
+
+    @property
+    def versions(self):
+        return self.promote().versions
+
+    def download(self, version='original'):
+        return self.promote().download(version)
+
+    def __repr__(self):
+        return f'<AssetRecord: id={self.record_name}>'
+
+
+def promote_all(photos, profile='transfer'):
+    """Full PhotoAssets of compact records, looked up with one records/lookup request per page of each album
+
+    :param photos: iterable of :class:`AssetRecord` objects
+    :param profile: (str) name of the desiredKeys projection to fetch
+    :return: (dict) recordName -> PhotoAsset, without the photos that no longer exist in iCloud
+    """
+    from pyicloud_ipd.services.photos import PhotoAsset
+
+    by_album = {}
+    for photo in photos:
+        by_album.setdefault(id(photo._album), []).append(photo)
+
+    assets = {}
+    for batch in by_album.values():
+        album = batch[0]._album
+        for i in range(0, len(batch), album.page_size):
+            page = batch[i:i + album.page_size]
+            records = album._lookup([photo.record_name for photo in page] + [photo.master_name for photo in page],
+                                    profile)
+            for photo in page:
+                asset_record, master_record = records.get(photo.record_name), records.get(photo.master_name)
+                if asset_record and master_record:
+                    assets[photo.record_name] = PhotoAsset(album.service, master_record, asset_record)
+    return assets
+
+
+class Promoter:
+    """Promotes compact records to PhotoAssets in batches, as they're about to be downloaded
+
+    Photos are added as they're queued for download. The first one that a worker asks for is looked up
+    along with the others queued by then, up to ``batch_size``, in one records/lookup request instead of one
+    per photo. Workers asking for a photo of a lookup in progress wait for that lookup only, while others
+    look up their own batches at the same time. Since download URLs expire, photos are only looked up once
+    they near the front of the queue, and each PhotoAsset is dropped once it's handed out.
+
+    :param profile: (str) name of the desiredKeys projection to fetch
+    :param batch_size: (int) max photos looked up at once
+    """
+
+    def __init__(self, profile='transfer', batch_size=100):
+        self.profile = profile
+        self.batch_size = batch_size
+        self._queued = collections.OrderedDict()  # recordName -> AssetRecord not looked up yet, oldest first
+        self._pending = {}  # recordName -> Future of the PhotoAssets of the batch it's looked up with
+        self._lock = threading.Lock()
+
+    def add(self, photo):
+        """Queue a photo to be looked up with the next batch"""
+        if isinstance(photo, AssetRecord):
+            with self._lock:
+                self._queued[photo.record_name] = photo
+
+    def discard(self, photo):
+        """Forget a photo that won't be downloaded after all"""
+        if isinstance(photo, AssetRecord):
+            with self._lock:
+                self._queued.pop(photo.record_name, None)
+                pending = self._pending.pop(photo.record_name, None)
+            if pending is not None and pending.done() and not pending.exception():
+                pending.result().pop(photo.record_name, None)
+
+    def get(self, photo):
+        """Full PhotoAsset of a photo, promoting it along with the other queued photos if it's compact
+
+        :raises LookupError: if the photo no longer exists in iCloud
+        """
+        if not isinstance(photo, AssetRecord):
+            return photo
+        name = photo.record_name
+        while True:
+            with self._lock:
+                pending = self._pending.get(name)
+                owner = pending is None
+                if owner:
+                    self._queued.pop(name, None)
+                    batch = [photo]
+                    while self._queued and len(batch) < self.batch_size:
+                        batch.append(self._queued.popitem(last=False)[1])
+                    pending = Future()
+                    for queued in batch:
+                        self._pending[queued.record_name] = pending
+
+            if owner:
+                try:
+                    pending.set_result(promote_all(batch, self.profile))
+                except Exception as e:
+                    with self._lock:
+                        for queued in batch:
+                            if self._pending.get(queued.record_name) is pending:
+                                del self._pending[queued.record_name]
+                    pending.set_exception(e)
+                    raise
+            try:
+                assets = pending.result()
+                break
+            except Exception:
+                # The lookup of another worker's batch failed, so the photo is looked up again
+                continue
+
+        with self._lock:
+            self._pending.pop(name, None)
+        asset = assets.pop(name, None)
+        if asset is None:
+            raise LookupError(f'{photo.filename} ({photo.record_name}) no longer exists in iCloud')
+        return asset
+
+
+def full_asset(photo):
+    """Full PhotoAsset of a photo, promoting it if it's a compact :class:`AssetRecord`"""
+    return photo.promote() if isinstance(photo, AssetRecord) else photo
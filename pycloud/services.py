@@ -1,19 +1,33 @@
 import os
 import sys
-import calendar
+import time
+import threading
+import itertools
+import mimetypes
+
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
 
-from datetime import datetime
 from abc import abstractmethod, ABC
 
-from pydrive2.auth import GoogleAuth
-from pydrive2.drive import GoogleDrive
+from tzlocal import get_localzone
 
-from icloudpd.authentication import authenticate, TwoStepAuthRequiredError
-from pyicloud_ipd.services.photos import PhotoAsset
+# PyDrive2, icloudpd and pyicloud_ipd are imported where they're first needed, so that creating the
+# services is fast and authentication can be deferred until the first request
 
-from pycloud.utils import FilterAlbum
+from pycloud.index import AlbumIndex
+from pycloud.quota import QuotaTracker
+from pycloud.ratelimit import RequestScheduler
+from pycloud.folders import FolderTree, ContentIndex, path_titles
+from pycloud.upload import (
+    UploadSessions, HashingReader, hashed, resumable_upload, query_upload_offset, CHUNK_SIZE,
+    MULTIPART_THRESHOLD
+)
 from pycloud.logger import PyCloudLogger
 
+if TYPE_CHECKING:
+    from pyicloud_ipd.services.photos import PhotoAsset
+
 
 class CloudService(ABC):
 
@@ -33,6 +47,15 @@ class CloudService(ABC):
     # def total_storage(self):
     #     pass
 
+    def warm_up(self):
+        """Prepare the service in a background thread, so it's ready by the time it's first used"""
+        thread = threading.Thread(target=self._warm_up, name=f'{self.name}-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        pass
+
     def info(self, msg):
         return self.logger.info(msg)
 
@@ -45,101 +68,289 @@ class CloudService(ABC):
 
 class gDrive(CloudService):
     FOLDER = 'application/vnd.google-apps.folder'
+    UPLOAD_DIR = 'PyCloud Drive'
+    BATCH_SIZE = 100  # Max requests in a Drive batch request
 
-    def __init__(self, drive=None):
+    def __init__(self, drive=None, quota_resync_interval=600, chunk_size=CHUNK_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD, upload_retries=5, session_file='upload_sessions.json',
+                 folder_cache='folder_cache.json', max_folder_changes=20000, scheduler=None):
         super().__init__(name='gDrive')
-        self.drive = drive
-        self.folders = {}
-
-        if not self.drive:
-            self.drive = self.get_drive()
-
-        self.initialize_folders()
+        self._drive = drive
+        self.scheduler = scheduler or RequestScheduler()
+        self._folders = {}
+        self.quota = QuotaTracker(lambda: self.about, resync_interval=quota_resync_interval)
+        self.chunk_size = chunk_size
+        self.multipart_threshold = multipart_threshold
+        self.upload_retries = upload_retries
+        self.sessions = UploadSessions(session_file)
+        self.folder_cache = folder_cache
+        self.max_folder_changes = max_folder_changes  # Past this many changes, list the folders again instead
+        self._tree = None
+        self.contents = ContentIndex(self._list_files)
+        self._folder_lock = threading.Lock()
+        self._creating = {}  # Relative path -> Future of the folder id, while the folder is being created
+        self._local = threading.local()
+        self._init_lock = threading.RLock()
+        self._initializing = False
 
     @staticmethod
     def get_drive():
+        """Authenticate with Google Drive. Credentials saved by a previous run are reused if they're still valid"""
+        from pydrive2.auth import GoogleAuth
+        from pydrive2.drive import GoogleDrive
+
         auth = GoogleAuth()
         auth.LocalWebserverAuth()
         drive = GoogleDrive(auth)
         return drive
 
+    @property
+    def drive(self):
+        """PyDrive2 GoogleDrive, authenticated on first use"""
+        if self._drive is None:
+            with self._init_lock:
+                if self._drive is None:
+                    self._drive = self.get_drive()
+        return self._drive
+
+    @property
+    def folders(self):
+        """Folder ids by relative path, mapped on first use"""
+        self.ensure_initialized()
+        return self._folders
+
+    @property
+    def tree(self):
+        self.ensure_initialized()
+        return self._tree
+
+    def ensure_initialized(self):
+        """Authenticate and map the folders, unless it's been done already or is being done by this thread"""
+        if self._tree is None:
+            with self._init_lock:
+                if self._tree is None and not self._initializing:
+                    self._initializing = True
+                    try:
+                        self.initialize_folders()
+                    finally:
+                        self._initializing = False
+
+    def _warm_up(self):
+        self.ensure_initialized()
+
+    @property
+    def http(self):
+        """Authorized http object for the current thread, since httplib2 isn't thread-safe"""
+        if getattr(self._local, 'http', None) is None:
+            self._local.http = self.drive.auth.Get_Http_Object()
+        return self._local.http
+
     def initialize_folders(self):
-        if self.upload_dir:
+        """Map the upload folder and every folder below it to their ids, creating the upload folder if needed
+
+        Folders are loaded from the cache file and brought up to date with the Drive changes feed, or
+        listed with a single paginated query if there's no usable cache.
+
+        The tree and folder map are built aside and only published once they're complete, since other
+        threads stop waiting for them as soon as ``_tree`` is set.
+        """
+        tree = self._load_folder_tree()
+        folders = {}
+        upload_id = tree.child(tree.root_id, gDrive.UPLOAD_DIR)
+
+        if upload_id:
             # If root upload directory is already created, map it, and its subfolders, to their folder ids
-            self.folders['upload'] = self.upload_dir['id']
-            self.map_folders(self.upload_dir)
+            folders['upload'] = upload_id
+            folders.update(tree.paths(upload_id))
         else:
             # If root upload dir hasn't been created, we create it
-            upload_dir = self.new_folder('PyCloud Drive', parent_id='root', key='upload')
-            if not upload_dir.uploaded:
+            upload_dir = self._create_folder(gDrive.UPLOAD_DIR, tree.root_id)
+            if not upload_dir:
                 self.error('Unable to initialize PyCloud Drive root upload folder')
                 raise RuntimeError('Unable to initialize PyCloud Drive root upload folder')
-            else:
-                # After creating, there's nothing to map; new_folder() maps automatically
-                self.info('Created PyCloud Drive root upload folder')
-                return
+            tree.add_item(upload_dir)
+            folders['upload'] = upload_dir['id']
+            self.info('Created PyCloud Drive root upload folder')
+
+        self._folders = folders
+        self._tree = tree
+        self.save_folder_tree()
+
+    def save_folder_tree(self):
+        if self.folder_cache:
+            self.tree.save(self.folder_cache)
+
+    def _load_folder_tree(self):
+        about = self.about
+        change_id = int(about['largestChangeId'])
+
+        if self.folder_cache and os.path.exists(self.folder_cache):
+            tree = FolderTree.load(self.folder_cache)
+            if tree.root_id == about['rootFolderId'] and change_id - tree.change_id <= self.max_folder_changes:
+                self._apply_folder_changes(tree)
+                return tree
+
+        tree = FolderTree(about['rootFolderId'], change_id)
+        folders = self.scheduler.call('drive.metadata', self.drive.ListFile({
+            'q': f"mimeType='{gDrive.FOLDER}' and trashed=false",
+            'maxResults': 1000,
+            'fields': 'items(id,title,parents(id)),nextPageToken',
+        }).GetList)
+        for folder in folders:
+            tree.add_item(folder)
+        self.debug(f'Listed {len(folders)} folders')
+        return tree
+
+    def _apply_folder_changes(self, tree):
+        """Bring a cached folder tree up to date with the changes made in Drive since it was saved"""
+        changes = self.drive.auth.service.changes()
+        params = {
+            'startChangeId': tree.change_id + 1,
+            'maxResults': 1000,
+            'fields': 'items(fileId,deleted,file(id,title,mimeType,parents(id),labels(trashed))),'
+                      'nextPageToken,largestChangeId',
+        }
+        count = 0
+        while True:
+            response = self.scheduler.call('drive.metadata', changes.list(**params).execute, http=self.http)
+            for change in response.get('items', []):
+                file = change.get('file')
+                if change.get('deleted') or not file or file['labels']['trashed'] or file['mimeType'] != gDrive.FOLDER:
+                    tree.remove(change['fileId'])
+                else:
+                    tree.add_item(file)
+                count += 1
+            tree.change_id = int(response['largestChangeId'])
+            if not response.get('nextPageToken'):
+                break
+            params['pageToken'] = response['nextPageToken']
+        self.debug(f'Applied {count} Drive changes to the cached folder tree')
 
     def map_folders(self, root):
-        """Given a root directory, recursively map the ids of its subdirectories"""
-        folders = self.get_folder_contents(root['id'])['folders']
-        if not folders:
-            # No subdirectories to map
-            return
-
-        for folder in folders:
-            # If there's subdirectories, recursively map them to their folder ids
-            name, id = folder['title'], folder['id']
-            try:
-                # If it's a month folder, convert month name to integer value
-                month = str(datetime.strptime(name, "%B").month).zfill(2)
-            except ValueError:
-                month = None
-
-            if month:  # Month folder dict key format is "YYYY/mm", need the name of parent(year) folder
-                year_dir = self.drive.CreateFile({'id': folder['parents'][0]['id']})
-                year_dir.FetchMetadata()
-                year = year_dir['title']
-                key = f'{year}/{month}'
-
-            else:  # Any other folder's dict key is just the folder name
-                key = name
-
-            self.folders[key] = id
-            self.map_folders(folder)
+        """Given a root directory, map the ids of all its subdirectories by their path relative to it"""
+        self.folders.update(self.tree.paths(root['id']))
 
     def get_date_folder(self, date):
-        """Get ID of the folder corresponding to a date in "YYYY/mm" format. Creates the folder if needed."""
+        """Get ID of the folder at a relative path like "YYYY/mm". Creates any missing folders along the path
+
+        Concurrent calls for the same missing path are merged, so the folder is only created once.
+        """
         if self.folders.get(date):
             return self.folders[date]
 
-        year, month = date.split('/')
-        if year not in self.folders:
-            # Both year and month folders need to be made
-            year_dir = self.new_folder(
-                name=year,
-                parent_id=self.upload_dir['id']
-            )
-            if not year_dir.uploaded:
-                self.error('Unable to create folder %s' % year)
-                raise RuntimeError('Unable to create folder %s' % year)
+        with self._folder_lock:
+            if self.folders.get(date):
+                return self.folders[date]
+            creating = self._creating.get(date)
+            if creating is None:
+                creating = self._creating[date] = Future()
+                owner = True
             else:
-                self.info('Created year folder for %s' % year)
-
-        # Year folder exists. Creating month folder now
-        month_name = calendar.month_name[int(month.lstrip('0'))]
-        month_dir = self.new_folder(
-            name=month_name,
-            parent_id=self.folders[year],
-            key=date
-        )
-        if month_dir.uploaded:
-            self.info(f'Created month folder {month_name} for {date}')
-            return self.get_date_folder(date)
-        else:
-            self.error(f'Unable to create month folder {month_name} for {date}')
-            raise RuntimeError(f'Unable to create month folder {month_name} for {date}')
+                owner = False
+
+        if not owner:
+            # Another thread is already creating this folder
+            return creating.result()
+
+        try:
+            folder_id = self._create_date_folder(date)
+            creating.set_result(folder_id)
+            return folder_id
+        except Exception as e:
+            creating.set_exception(e)
+            raise
+        finally:
+            with self._folder_lock:
+                del self._creating[date]
+
+    def _create_date_folder(self, date):
+        parent, _, _ = date.rpartition('/')
+        parent_id = self.get_date_folder(parent) if parent else self.folders['upload']
+        title = path_titles(date)[-1]
+        if not self.new_folder(name=title, parent_id=parent_id, key=date):
+            self.error(f'Unable to create folder {title} for {date}')
+            raise RuntimeError(f'Unable to create folder {title} for {date}')
+
+        self.info(f'Created folder {title} for {date}')
+        self.save_folder_tree()
+        return self.folders[date]
+
+    def ensure_folders(self, paths):
+        """Create every missing folder along a set of relative paths up front, in batch requests
+
+        Folders are created one level at a time, since each level needs the ids of the one above it.
+        Any folder that fails here is created on demand by :meth:`get_date_folder` instead.
+        """
+        missing = self.missing_folders(paths)
+        created = 0
+        for depth in sorted({path.count('/') for path in missing}):
+            level = sorted(path for path in missing if path.count('/') == depth)
+            for i in range(0, len(level), gDrive.BATCH_SIZE):
+                created += self._create_folders(level[i:i + gDrive.BATCH_SIZE])
+
+        if created:
+            self.info(f'Created {created} folders')
+            self.save_folder_tree()
+        return created
+
+    def missing_folders(self, paths):
+        """Relative paths of every folder that doesn't exist yet along a set of relative paths"""
+        missing = set()
+        for path in paths:
+            parts = path.split('/')
+            for depth in range(1, len(parts) + 1):
+                prefix = '/'.join(parts[:depth])
+                if not self.folders.get(prefix):
+                    missing.add(prefix)
+        return missing
+
+    def _create_folders(self, paths):
+        """Create folders at relative paths whose parents exist, with one batch request"""
+        service = self.drive.auth.service
+        created = []
+
+        def callback(path, response, exception):
+            if exception is not None:
+                self.error(f'Unable to create folder for {path}: {exception}')
+            else:
+                self.folders[path] = response['id']
+                self.tree.add_item(response)
+                created.append(path)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for path in paths:
+            parent, _, _ = path.rpartition('/')
+            parent_id = self.folders.get(parent) if parent else self.folders['upload']
+            if not parent_id:
+                continue  # Parent failed to be created
+            body = {
+                'title': path_titles(path)[-1],
+                'parents': [
+                    {
+                        "kind": "drive#fileLink",
+                        "id": parent_id
+                    }
+                ],
+                "mimeType": gDrive.FOLDER
+            }
+            batch.add(
+                service.files().insert(body=body, fields='id,title,parents(id)', supportsAllDrives=True),
+                request_id=path
+            )
+        self.scheduler.call('drive.metadata', batch.execute, http=self.http, idempotent=False)
+        return len(created)
 
     def new_folder(self, name, parent_id='root', key=None):
+        folder = self._create_folder(name, parent_id)
+        if folder:
+            key = key if key else name
+            self.folders[key] = folder['id']
+            self.tree.add_item(folder)
+            self.info(f'Created folder {name}')
+        return folder
+
+    def _create_folder(self, name, parent_id):
+        """Create a folder in Drive, without mapping it. Returns the created file, or False if it failed"""
         folder = self.drive.CreateFile(
             {
                 'title': name,
@@ -152,35 +363,122 @@ class gDrive(CloudService):
                 "mimeType": gDrive.FOLDER
             }
         )
-        folder.Upload()
+        self.scheduler.call('drive.metadata', folder.Upload, param={'http': self.http}, idempotent=False)
         if folder.uploaded:
-            key = key if key else name
-            self.folders[key] = folder['id']
-            self.info(f'Created folder {name}')
             return folder
         else:
             self.error(f'Failed to create folder {name}')
             print(f'Failed to create folder {name}')
             return False
 
-    def add_file(self, filepath, title=None, parent_id=None):
-        file = self.drive.CreateFile()
+    def add_file(self, filepath, title=None, parent_id=None, digest=None):
+        """Upload a file. Small files are sent in one multipart request, and larger ones in chunks
+
+        Chunked uploads retry each chunk up to ``upload_retries`` times, and save their session URI
+        to :attr:`sessions`, so an upload cut off by a crash continues from the last committed chunk.
+
+        :param digest: hashlib digest updated with the bytes of the file as they're uploaded, to check
+            against the md5Checksum of the uploaded file
+        """
+        if not title:
+            title = os.path.basename(filepath)
+
+        body = {'title': title}
         if parent_id:
-            file['parents'] = [
+            body['parents'] = [
                 {
                     "kind": "drive#fileLink",
                     "id": parent_id
                 }
             ]
-        if not title:
-            title = os.path.basename(filepath)
+        mimetype = mimetypes.guess_type(title)[0] or 'application/octet-stream'
+        size = os.path.getsize(filepath)
+
+        from googleapiclient.http import MediaIoBaseUpload
+
+        with open(filepath, 'rb') as raw:
+            fd = HashingReader(raw, digest) if digest is not None else raw
+            if size < self.multipart_threshold:
+                media = MediaIoBaseUpload(fd, mimetype, resumable=False)
+                request = self.drive.auth.service.files().insert(
+                    body=body, media_body=media, supportsAllDrives=True)
+                metadata = self.scheduler.call('drive.upload', request.execute, http=self.http, idempotent=False)
+            else:
+                metadata = self._resumable_upload(filepath, fd, body, mimetype, size)
+            if digest is not None:
+                fd.finish()
+
+        return self._uploaded_file(metadata, parent_id)
 
-        file['title'] = title
-        file.SetContentFile(filepath)
-        file.Upload()
-        if file.uploaded:
-            return file
-        return False
+    def _uploaded_file(self, metadata, parent_id=None):
+        from pydrive2.files import GoogleDriveFile
+
+        if parent_id:
+            self.contents.add(parent_id, metadata)
+        return GoogleDriveFile(auth=self.drive.auth, metadata=metadata, uploaded=True)
+
+    def _resumable_upload(self, filepath, fd, body, mimetype, size):
+        from googleapiclient.http import MediaIoBaseUpload
+
+        media = MediaIoBaseUpload(fd, mimetype, chunksize=self.chunk_size, resumable=True)
+        request = self.drive.auth.service.files().insert(
+            body=body, media_body=media, supportsAllDrives=True)
+
+        if uri := self.sessions.get(filepath):
+            offset, metadata = self.scheduler.call('drive.upload', query_upload_offset, self.http, uri, size)
+            if metadata:
+                self.sessions.remove(filepath)
+                return metadata
+            if offset is not None:
+                self.debug(f'Resuming upload of {body["title"]} from byte {offset}')
+                request.resumable_uri = uri
+                request.resumable_progress = offset
+
+        # A retry continues the session from the last chunk Drive committed
+        metadata = self.scheduler.call(
+            'drive.upload',
+            resumable_upload,
+            request,
+            http=self.http,
+            num_retries=self.upload_retries,
+            on_session=lambda session_uri: self.sessions.save(filepath, session_uri)
+        )
+        self.sessions.remove(filepath)
+        return metadata
+
+    def upload_stream(self, chunks, title, parent_id=None, size=None, chunksize=None, digest=None):
+        """Upload a file from an iterator of byte chunks with a resumable upload, without writing it to disk
+
+        :param chunks: iterable of bytes, such as the iter_content() of a download response
+        :param title: (str) title of the file in Drive
+        :param parent_id: (str) id of the folder to upload to
+        :param size: (int) size of the file in bytes, if known
+        :param chunksize: (int) bytes per upload request, a multiple of 256 KiB. Defaults to :attr:`chunk_size`
+        :param digest: hashlib digest updated with each chunk as it's read from ``chunks``
+        :raises StreamError: if the source fails, or Drive asks to resume from bytes no longer buffered
+        """
+        # Imports googleapiclient, which pycloud.upload leaves out
+        from pycloud.streammedia import StreamMedia
+
+        body = {'title': title}
+        if parent_id:
+            body['parents'] = [
+                {
+                    "kind": "drive#fileLink",
+                    "id": parent_id
+                }
+            ]
+        media = StreamMedia(
+            hashed(chunks, digest) if digest is not None else chunks,
+            mimetype=mimetypes.guess_type(title)[0] or 'application/octet-stream',
+            chunksize=chunksize or self.chunk_size,
+            size=size
+        )
+        request = self.drive.auth.service.files().insert(
+            body=body, media_body=media, supportsAllDrives=True)
+        metadata = self.scheduler.call(
+            'drive.upload', resumable_upload, request, http=self.http, num_retries=self.upload_retries)
+        return self._uploaded_file(metadata, parent_id)
 
     def get_folder(self, title, parent_id):
         """Search for folders by title within a given folder"""
@@ -189,15 +487,24 @@ class gDrive(CloudService):
                 return folder
         return None
 
-    def get_file(self, title, parent_id):
-        """Search for files by title within a given folder"""
-        for file in self.get_folder_contents(parent_id)['files']:
-            if file['title'] == title:
-                return file
-        return None
+    def get_file(self, title, parent_id, size=None):
+        """Search for files by title, and size if provided, within a given folder"""
+        return self.contents.find(parent_id, title, size)
+
+    def has_file(self, title, parent_id, size):
+        """Whether a folder already holds a file with the same title and size"""
+        return self.contents.find(parent_id, title, size) is not None
+
+    def _list_files(self, folder_id):
+        return self.scheduler.call('drive.metadata', self.drive.ListFile({
+            'q': f"'{folder_id}' in parents and trashed=false and mimeType!='{gDrive.FOLDER}'",
+            'maxResults': 1000,
+            'fields': 'items(id,title,fileSize,md5Checksum),nextPageToken',
+        }).GetList)
 
     def get_folder_contents(self, folder_id):
-        folder_contents = self.drive.ListFile({'q': "'" + folder_id + "' in parents and trashed=false"}).GetList()
+        folder_contents = self.scheduler.call(
+            'drive.metadata', self.drive.ListFile({'q': "'" + folder_id + "' in parents and trashed=false"}).GetList)
         items = {
             'folders': [],
             'files': [],
@@ -212,7 +519,9 @@ class gDrive(CloudService):
 
     @property
     def upload_dir(self):
-        return self.get_folder('PyCloud Drive', 'root')
+        if 'upload' in self.folders:
+            return {'id': self.folders['upload'], 'title': gDrive.UPLOAD_DIR}
+        return None
 
     @property
     def root(self):
@@ -226,121 +535,284 @@ class gDrive(CloudService):
     def root_files(self):
         return self.root['files']
 
+    def storage_snapshot(self):
+        """Last known (used, total) storage in bytes, without making any network calls"""
+        return self.quota.snapshot()
+
     @property
     def about(self):
-        return self.drive.GetAbout()
+        return self.scheduler.call('drive.metadata', self.drive.GetAbout)
 
     @property
     def total_storage(self):
-        if not self._total_storage:
-            # Total storage should be constant, store value after retrieving
-            self._total_storage = int(self.about['quotaBytesTotal'])
-        return self._total_storage
+        self.quota.ensure_synced()
+        return self.quota.total
 
     @property
     def used_storage(self):
-        return int(self.about['quotaBytesUsed']) + int(self.about['quotaBytesUsedInTrash'])
+        self.quota.ensure_synced()
+        return self.quota.used
 
     @property
     def available_storage(self):
-        return self.total_storage - self.used_storage
+        return self.quota.available
 
 
 class iCloud(CloudService):
 
     def __init__(self, **kwargs):
         super().__init__(name="iCloud")
-        self.api = None
+        self._api = None
+        self._credentials = None
+        self._auth_lock = threading.Lock()
         self.cookie_dir = kwargs.get('cookie_dir', '~/.pyicloud')
         self.download_dir = os.path.normpath(kwargs.get('download_dir', './Photos'))
         self.folder_structure = kwargs.get('folder_structure', '{:%Y/%m}')
+        self.index = AlbumIndex(kwargs['index_path']) if kwargs.get('index_path') else None
+        self.scheduler = kwargs.get('scheduler') or RequestScheduler()
 
     def login(self, username, password):
+        """Set the credentials to log in with. Authentication happens on first use of :attr:`api`"""
+        self._credentials = (username, password)
+        return self
+
+    @property
+    def api(self):
+        """Authenticated PyiCloudService, which reuses the session cookies saved in ``cookie_dir``"""
+        if self._api is None and self._credentials is not None:
+            with self._auth_lock:
+                if self._api is None:
+                    self._api = self._authenticate(*self._credentials)
+        return self._api
+
+    @api.setter
+    def api(self, api):
+        self._api = api
+
+    def _warm_up(self):
+        return self.api
+
+    def _authenticate(self, username, password):
+        from icloudpd.authentication import authenticate, TwoStepAuthRequiredError
+
         self.info('Authenticating...')
         try:
-            self.api = authenticate(
+            api = authenticate(
                 username=username,
                 password=password,
                 cookie_directory=self.cookie_dir,
                 raise_error_on_2sa=False,  # For now
                 client_id=os.environ.get("CLIENT_ID")
             )
-            self.info(f'Logged into {self.api}')
-            return self
+            self.info(f'Logged into {api}')
+            return api
         except TwoStepAuthRequiredError as e:
             self.error(str(e))
             sys.exit(1)
 
+    def date_path(self, photo):
+        """Relative folder path for a photo, built from its local creation date and the folder structure"""
+        try:
+            created_date = photo.created.astimezone(get_localzone())
+        except (ValueError, OSError):
+            self.error(
+                "Could not convert photo created date to local timezone (%s)" % photo.created)
+            created_date = photo.created
+        return self.folder_structure.format(created_date)
+
+    def date_paths(self, photos):
+        """Set of the relative folder paths of some photos"""
+        return {self.date_path(photo) for photo in photos}
+
     @property
     def albums(self):
         if self.api:
             return self.api.photos.albums
 
     def get_album(self, album_name):
+        from pycloud.utils import FilterAlbum
+
         if album := self.albums.get(album_name, None):
-            return FilterAlbum(album)
+            return FilterAlbum(album, index=self.index, scheduler=self.scheduler)
         else:
             for name, album in self.albums.items():
                 if name.lower() == album_name.lower():
                     self.info('Retrieved album: {}'.format(album))
-                    return FilterAlbum(album)
+                    return FilterAlbum(album, index=self.index, scheduler=self.scheduler)
         self.error(f'No Album found for {album_name}')
         return None
 
-    def delete_photo(self, photo: PhotoAsset, permanent=False):
-        """Adapted from @jacobpgallagher via https://github.com/picklepete/pyicloud/pull/354/"""
-        record_name = photo._asset_record['recordName']
-        record_type = photo._asset_record['recordType']
-        record_change_tag = photo._master_record['recordChangeTag']
-
-        json_data = {
-            'operations': {
-                'operationType': 'update',
-                'record': {
-                    'recordType': record_type,
-                    'recordName': record_name,
-                    'recordChangeTag': record_change_tag,  # '3t',
-                    'fields': {
-                        'isDeleted': {
-                            'value': 1,
-                        },
-                        'isExpunged': {
-                            'value': int(permanent),
-                        },
+    @staticmethod
+    def _delete_operation(photo: 'PhotoAsset', permanent=False):
+        """records/modify operation that marks a photo as deleted
+
+        Adapted from @jacobpgallagher via https://github.com/picklepete/pyicloud/pull/354/
+        """
+        return {
+            'operationType': 'update',
+            'record': {
+                'recordType': photo._asset_record['recordType'],
+                'recordName': photo._asset_record['recordName'],
+                'recordChangeTag': photo._master_record.get('recordChangeTag'),  # '3t',
+                'fields': {
+                    'isDeleted': {
+                        'value': 1,
+                    },
+                    'isExpunged': {
+                        'value': int(permanent),
                     },
                 },
             },
+        }
+
+    def delete_photos(self, photos, permanent=False, batch_size=100):
+        """Delete photos with one records/modify request per batch
+
+        Batches aren't atomic, so each photo succeeds or fails on its own.
+
+        :param photos: iterable of PhotoAssets
+        :param permanent: (bool) whether to expunge the photos instead of moving them to Recently Deleted
+        :param batch_size: (int) max number of photos per request
+        :return: tuple of lists of the (deleted, failed) photos
+        """
+        deleted, failed = [], []
+        photos = iter(photos)
+        while batch := list(itertools.islice(photos, batch_size)):
+            batch_deleted, batch_failed = self._delete_batch(batch, permanent)
+            deleted.extend(batch_deleted)
+            failed.extend(batch_failed)
+        return deleted, failed
+
+    def _delete_batch(self, photos, permanent=False):
+        json_data = {
+            'operations': [self._delete_operation(photo, permanent) for photo in photos],
             'zoneID': {
                 'zoneName': 'PrimarySync',
                 'zoneType': 'REGULAR_CUSTOM_ZONE'
             },
-            'atomic': True,
+            'atomic': False,
         }
         endpoint = self.api.photos._service_endpoint
         url = f'{endpoint}/records/modify'
 
-        response = self.api.session.post(
+        response = self.scheduler.call(
+            'icloud.modify',
+            self.api.session.post,
             url=url,
             json=json_data,
             params=self.api.params
         )
-        if response.ok:
-            self.info(f'Deleted {photo.filename} from iCloud')
-            return True
-        else:
-            self.error(f'Failed to delete {photo.filename} from iCloud')
+        if not response.ok:
+            self.error(f'Failed to delete {len(photos)} photos from iCloud: HTTP {response.status_code}')
+            return [], list(photos)
+
+        # Records that failed come back with a serverErrorCode and reason instead of their fields
+        errors = {
+            rec['recordName']: rec.get('reason', rec['serverErrorCode'])
+            for rec in response.json().get('records', []) if 'serverErrorCode' in rec
+        }
+        deleted, failed = [], []
+        for photo in photos:
+            if error := errors.get(photo._asset_record['recordName']):
+                self.error(f'Failed to delete {photo.filename} from iCloud: {error}')
+                failed.append(photo)
+            else:
+                self.info(f'Deleted {photo.filename} from iCloud')
+                deleted.append(photo)
+
+        if deleted and self.index is not None:
+            self.index.remove([photo._asset_record['recordName'] for photo in deleted])
+        return deleted, failed
+
+    def delete_photo(self, photo: 'PhotoAsset', permanent=False):
+        deleted, failed = self.delete_photos([photo], permanent=permanent)
+        if failed:
             print(f'Failed to delete {photo.filename} from iCloud')
             return False
+        return True
 
     def clear_deleted_photos(self):
         """Permanently deletes photos from the Recently Deleted iCloud folder"""
         album = self.get_album('Recently Deleted')
-        photos = album.fetch_photos()
-        deleted_count = 0
-
-        for photo in photos:
-            self.delete_photo(photo, permanent=True)
-            deleted_count += 1
-
-        self.info(f"Permanently deleted {deleted_count} photos from iCloud")
-        return True
+        deleted, failed = self.delete_photos(album.fetch_photos(profile='transfer', compact=True), permanent=True)
+
+        self.info(f"Permanently deleted {len(deleted)} photos from iCloud")
+        return not failed
+
+
+class DeleteBuffer:
+    """Buffers photos to delete from iCloud, so they can be deleted in batches as they come in
+
+    A batch is deleted once ``max_size`` photos are buffered, or ``max_wait`` seconds after the first
+    photo of the batch was added, whichever comes first.
+
+    :param cloud: (iCloud) logged in iCloud service
+    :param max_size: (int) number of buffered photos that triggers a flush
+    :param max_wait: (float) max seconds a photo waits in the buffer
+    :param permanent: (bool) whether to expunge the photos instead of moving them to Recently Deleted
+    :param callback: callable taking the (deleted, failed) photos of each flushed batch
+    """
+
+    def __init__(self, cloud, max_size=100, max_wait=5.0, permanent=False, callback=None):
+        self.cloud = cloud
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.permanent = permanent
+        self.callback = callback
+        self._photos = []
+        self._deadline = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._timer = threading.Thread(target=self._flush_on_time, name='delete-buffer', daemon=True)
+        self._timer.start()
+
+    def add(self, photo):
+        with self._cond:
+            self._photos.append(photo)
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.max_wait
+                self._cond.notify()
+            batch = self._take() if len(self._photos) >= self.max_size else None
+        if batch:
+            self._delete(batch)
+
+    def flush(self):
+        """Delete everything in the buffer now"""
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._delete(batch)
+
+    def close(self):
+        """Flush the buffer and stop the timer"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._timer.join()
+        self.flush()
+
+    def _take(self):
+        batch, self._photos, self._deadline = self._photos, [], None
+        return batch
+
+    def _delete(self, batch):
+        try:
+            deleted, failed = self.cloud.delete_photos(batch, permanent=self.permanent, batch_size=self.max_size)
+        except Exception as e:
+            # Reported as failed, so the timer thread keeps running and every photo is accounted for
+            self.cloud.error(f'Failed to delete {len(batch)} photos from iCloud: {e}')
+            deleted, failed = [], list(batch)
+        if self.callback:
+            self.callback(deleted, failed)
+
+    def _flush_on_time(self):
+        while True:
+            with self._cond:
+                while not self._closed and (self._deadline is None or time.monotonic() < self._deadline):
+                    timeout = None if self._deadline is None else self._deadline - time.monotonic()
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                batch = self._take()
+            if batch:
+                self._delete(batch)
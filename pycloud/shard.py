@@ -0,0 +1,218 @@
+import time
+import sqlite3
+import datetime
+import threading
+
+from pycloud.logger import PyCloudLogger
+
+
+class Shard:
+    """A date range whose photos all go to the same folder
+
+    :param key: (str) relative folder path of the shard, from the folder structure
+    :param start: (datetime.date) first date of the shard
+    :param end: (datetime.date) last date of the shard (inclusive)
+    """
+
+    __slots__ = ('key', 'start', 'end')
+
+    def __init__(self, key, start, end):
+        self.key = key
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f'Shard({self.key!r}, {self.start}, {self.end})'
+
+
+def granularity(folder_structure):
+    """Smallest date unit that a folder structure like "{:%Y/%m}" distinguishes: "day", "month" or "year" """
+    if any(code in folder_structure for code in ('%d', '%j', '%a', '%A', '%x', '%F')):
+        return 'day'
+    if any(code in folder_structure for code in ('%m', '%b', '%B')):
+        return 'month'
+    return 'year'
+
+
+def _next_start(date, unit):
+    if unit == 'day':
+        return date + datetime.timedelta(days=1)
+    if unit == 'month':
+        return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    return date.replace(year=date.year + 1, month=1, day=1)
+
+
+def make_shards(date_start, date_end, folder_structure='{:%Y/%m}'):
+    """Split a date range into shards along the folders of a folder structure, so each shard fills one folder
+
+    :param date_start: (datetime.date) first date of the range
+    :param date_end: (datetime.date) last date of the range (inclusive)
+    :param folder_structure: (str) format string of the relative folder path of a date
+    :return: (list) shards, oldest first
+    """
+    unit = granularity(folder_structure)
+    shards = []
+    start = date_start
+    while start <= date_end:
+        following = _next_start(start, unit)
+        shards.append(Shard(folder_structure.format(start), start, min(following - datetime.timedelta(days=1), date_end)))
+        start = following
+    return shards
+
+
+class LeaseStore:
+    """Shards of a run in a SQLite file, which processes claim with time-limited leases
+
+    Every claim happens in a write transaction, so two processes can never lease the same shard. A lease
+    that isn't renewed before it expires, because its process died or its host lost the shared storage,
+    can be claimed by anyone. The file can live on storage shared by several hosts, as long as it
+    supports file locks, which is why it doesn't use WAL mode.
+
+    :param path: (str) path of the SQLite database file
+    :param lease_seconds: (float) how long a lease lasts before it has to be renewed
+    :param max_attempts: (int) times a shard is tried before it's marked failed
+    """
+
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path='pycloud_leases.db', lease_seconds=900, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "key TEXT PRIMARY KEY, start TEXT NOT NULL, end TEXT NOT NULL, state TEXT NOT NULL, "
+            "owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def _transaction(self, sql, params=()):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+                return cursor
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def add(self, shards):
+        """Add shards that aren't in the store yet. Returns the number added"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = self.conn.executemany(
+                    "INSERT OR IGNORE INTO shards (key, start, end, state) VALUES (?, ?, ?, ?)",
+                    [(shard.key, shard.start.isoformat(), shard.end.isoformat(), self.PENDING) for shard in shards]
+                ).rowcount
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def claim(self, owner):
+        """Lease the oldest pending shard, or one whose lease expired. Returns None if there are none left"""
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT key, start, end FROM shards WHERE state = ? OR (state = ? AND expires < ?) "
+                    "ORDER BY start LIMIT 1", (self.PENDING, self.LEASED, now)
+                ).fetchone()
+                if row:
+                    self.conn.execute(
+                        "UPDATE shards SET state = ?, owner = ?, expires = ?, attempts = attempts + 1 WHERE key = ?",
+                        (self.LEASED, owner, now + self.lease_seconds, row[0]))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        key, start, end = row
+        return Shard(key, datetime.date.fromisoformat(start), datetime.date.fromisoformat(end))
+
+    def renew(self, shard, owner):
+        """Extend a lease. Returns False if it was lost, e.g. because it expired and another process took it"""
+        return self._transaction(
+            "UPDATE shards SET expires = ? WHERE key = ? AND owner = ? AND state = ?",
+            (time.time() + self.lease_seconds, shard.key, owner, self.LEASED)).rowcount == 1
+
+    def complete(self, shard, owner):
+        """Mark a leased shard done"""
+        return self._transaction(
+            "UPDATE shards SET state = ?, expires = NULL WHERE key = ? AND owner = ?",
+            (self.DONE, shard.key, owner)).rowcount == 1
+
+    def release(self, shard, owner):
+        """Give up a leased shard, so it can be claimed again, or mark it failed once it's used all its attempts"""
+        return self._transaction(
+            "UPDATE shards SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, owner = NULL, expires = NULL "
+            "WHERE key = ? AND owner = ?",
+            (self.max_attempts, self.FAILED, self.PENDING, shard.key, owner)).rowcount == 1
+
+    def progress(self):
+        """Number of shards in each state"""
+        with self._lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+class ShardRunner:
+    """Claims shards from a :class:`LeaseStore` and works on them one at a time until none are left
+
+    While a shard is being worked on, its lease is renewed every third of the lease time from a background
+    thread, so only a process that stops responding loses its lease.
+
+    :param store: (LeaseStore) store to claim shards from
+    :param owner: (str) unique name of this process, e.g. "<hostname>-<pid>"
+    """
+
+    def __init__(self, store, owner):
+        self.store = store
+        self.owner = owner
+        self.logger = PyCloudLogger(name='ShardRunner')
+
+    def run(self, work):
+        """Work on shards until none are left
+
+        :param work: callable taking a :class:`Shard`; returns True if the shard was fully transferred
+        :return: (int) number of shards completed by this process
+        """
+        completed = 0
+        while shard := self.store.claim(self.owner):
+            self.logger.info(f'{self.owner} claimed shard {shard.key} ({shard.start} to {shard.end})')
+            stop = threading.Event()
+            keeper = threading.Thread(target=self._renew, args=(shard, stop), name='lease-keeper', daemon=True)
+            keeper.start()
+            try:
+                done = work(shard)
+            except Exception as e:
+                self.logger.error(f'Shard {shard.key} failed: {e}')
+                done = False
+            finally:
+                stop.set()
+                keeper.join()
+
+            if done:
+                self.store.complete(shard, self.owner)
+                completed += 1
+            else:
+                self.store.release(shard, self.owner)
+            self.logger.info('Shards: %s', self.store.progress())
+        return completed
+
+    def _renew(self, shard, stop):
+        while not stop.wait(self.store.lease_seconds / 3):
+            if not self.store.renew(shard, self.owner):
+                self.logger.warning(f'Lost the lease on shard {shard.key}')
+                return
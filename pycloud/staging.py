@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+import collections
+
+from pycloud.logger import PyCloudLogger
+
+# Suffix of files still being downloaded, after the pid of the process downloading them. Any left behind by a
+# process that isn't running anymore are removed at startup
+PART_SUFFIX = '.part'
+
+
+def _process_running(pid):
+    """Whether another process with the given pid is running on this host"""
+    if pid == os.getpid():
+        return False
+    if os.name != 'posix':
+        # Signals can't probe a process elsewhere, so the part file is assumed to be in use
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _part_owner(filename):
+    """Pid of the process that a part file is downloaded by, or None if it doesn't name one"""
+    pid = filename[:-len(PART_SUFFIX)].rpartition('.')[2]
+    return int(pid) if pid.isdigit() else None
+
+
+class StagingCache:
+    """Downloaded photos waiting to be uploaded, kept on disk within a byte budget
+
+    A download reserves the size of its photo before it starts, and waits while the budget is used up.
+    Once downloaded, a photo stays staged until its upload is verified, so a photo whose upload fails
+    can be retried from disk, later in the run or in the next one, instead of being downloaded again.
+    Staged photos that no job is using are evicted when space is needed, least recently used first,
+    and only until the space needed is free.
+
+    Files still being downloaded end in ``.<pid>.part``, and any left by a process that was cut off are
+    removed when the cache is opened, while those of other processes still running are left alone.
+    Complete files are kept, and can be reused by a retry.
+
+    :param root: (str) directory photos are staged in
+    :param budget: (int) max bytes staged and reserved at once. A photo larger than the whole budget is
+        still admitted once nothing else is staged
+    :param timeout: (float) max seconds a download waits for space, e.g. while pinned photos fill the budget
+    """
+
+    def __init__(self, root, budget=4 * 1024 ** 3, timeout=600.0):
+        self.root = root
+        self.budget = budget
+        self.timeout = timeout
+        self.used = 0  # Bytes of staged photos
+        self.reserved = 0  # Bytes reserved for downloads in progress
+        self._entries = collections.OrderedDict()  # Path -> size of staged photos, least recently used first
+        self._pinned = set()  # Paths of staged photos that a job is using
+        self._cond = threading.Condition()
+        self.logger = PyCloudLogger(name='StagingCache')
+        self._scan()
+
+    def _scan(self):
+        """Remove partial downloads of stopped processes, and stage the complete files, oldest first"""
+        found, removed = [], 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(PART_SUFFIX):
+                    owner = _part_owner(filename)
+                    if owner is None or not _process_running(owner):
+                        self._remove(path)
+                        removed += 1
+                else:
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, os.path.normpath(path), stat.st_size))
+
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self.used += size
+        with self._cond:
+            self._evict(0)
+        if removed or found:
+            self.logger.info(f'Removed {removed} partial downloads from {self.root}, '
+                             f'kept {len(self._entries)} staged photos ({self.used} bytes)')
+
+    @staticmethod
+    def part_path(path):
+        """Path a photo is downloaded to by this process before it's complete"""
+        return f'{path}.{os.getpid()}{PART_SUFFIX}'
+
+    def contains(self, path, size=None):
+        """Whether a photo is staged at a path, with the given size if provided, without pinning it"""
+        path = os.path.normpath(path)
+        with self._cond:
+            staged = self._entries.get(path)
+            return staged is not None and (size is None or staged == size) and os.path.exists(path)
+
+    def get(self, path, size=None):
+        """Whether a photo is staged at a path, with the given size if provided
+
+        A staged photo is pinned, so it isn't evicted until it's released or discarded.
+        """
+        path = os.path.normpath(path)
+        with self._cond:
+            staged = self._entries.get(path)
+            if staged is None or (size is not None and staged != size) or not os.path.exists(path):
+                return False
+            self._entries.move_to_end(path)
+            self._pinned.add(path)
+            return True
+
+    def reserve(self, size):
+        """Reserve space for a download, evicting unused photos or waiting for space to be freed as needed
+
+        :return: (bool) False if there was no room within :attr:`timeout` seconds
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._evict(size)
+                if self.used + self.reserved + size <= self.budget or not (self.used or self.reserved):
+                    self.reserved += size
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+    def cancel(self, size):
+        """Give back the space reserved for a download that failed"""
+        with self._cond:
+            self.reserved -= size
+            self._cond.notify_all()
+
+    def add(self, path, size):
+        """Stage a downloaded photo in the space reserved for it. It's pinned until it's released or discarded"""
+        path = os.path.normpath(path)
+        with self._cond:
+            self.reserved -= size
+            self.used += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._pinned.add(path)
+            self._cond.notify_all()
+
+    def release(self, path):
+        """Unpin a staged photo. It's kept for a retry until it's evicted"""
+        with self._cond:
+            self._pinned.discard(os.path.normpath(path))
+            self._cond.notify_all()
+
+    def discard(self, path):
+        """Remove a photo, once it's no longer needed"""
+        path = os.path.normpath(path)
+        with self._cond:
+            self._pinned.discard(path)
+            self.used -= self._entries.pop(path, 0)
+            self._remove(path)
+            self._cond.notify_all()
+
+    def _evict(self, size):
+        """Remove unpinned photos, least recently used first, until ``size`` more bytes fit in the budget"""
+        for path in list(self._entries):
+            if self.used + self.reserved + size <= self.budget:
+                return
+            if path not in self._pinned:
+                self.used -= self._entries.pop(path)
+                self._remove(path)
+                self.logger.debug(f'Evicted {path} from the staging cache')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
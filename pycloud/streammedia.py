@@ -0,0 +1,59 @@
+from googleapiclient.http import MediaUpload
+
+from pycloud.upload import StreamError, CHUNK_SIZE
+
+
+class StreamMedia(MediaUpload):
+    """Media for a resumable upload that's read from an iterator of byte chunks, such as a download response
+
+    Only the bytes that Drive hasn't committed yet are kept in memory, which is at most one upload chunk plus
+    one source chunk. A failed upload chunk can be retried from that buffer, but if Drive asks to resume from
+    before it, the source would have to be read again, so a :class:`StreamError` is raised instead.
+
+    :param chunks: iterable of bytes
+    :param mimetype: (str) mime type of the file
+    :param chunksize: (int) bytes per upload request, a multiple of 256 KiB
+    :param size: (int) total size in bytes, if known
+    """
+
+    def __init__(self, chunks, mimetype='application/octet-stream', chunksize=CHUNK_SIZE, size=None):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._size = size
+        self._buffer = bytearray()
+        self._buffer_start = 0  # Offset in the file of the first buffered byte
+        self._eof = False
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise StreamError(f'Cannot rewind stream to byte {begin}, {self._buffer_start} bytes were discarded')
+
+        # Everything before begin has been committed by Drive, so it's safe to let go of
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+
+        while len(self._buffer) < length and not self._eof:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                self._eof = True
+            except Exception as e:
+                raise StreamError(f'Failed to read stream at byte {self._buffer_start + len(self._buffer)}') from e
+        return bytes(self._buffer[:length])
@@ -0,0 +1,176 @@
+import os
+import json
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows, where a single process is expected to use the sessions file
+    fcntl = None
+
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_SIZE = 32 * 256 * 1024
+
+# Files smaller than this are uploaded in a single multipart request instead of a resumable session
+MULTIPART_THRESHOLD = 5 * 1024 * 1024
+
+# Bytes read at a time when hashing the part of a file that an upload didn't read
+HASH_READ_SIZE = 1024 * 1024
+
+
+class StreamError(Exception):
+    """Raised when a streamed upload can't continue, because its source failed or can't be rewound"""
+
+
+def hashed(chunks, digest):
+    """Pass through an iterable of byte chunks, updating a hashlib digest with each one as it goes by"""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+class HashingReader:
+    """Wraps a file being uploaded, and hashes each byte of it the first time it's read
+
+    Uploads seek back to resend a failed chunk, so reads that overlap what's already been hashed only
+    hash the bytes past it, and the digest ends up covering the file exactly once, in order.
+
+    :param fd: file object opened in binary mode
+    :param digest: hashlib digest to update
+    """
+
+    def __init__(self, fd, digest):
+        self._fd = fd
+        self.digest = digest
+        self.hashed = 0  # Bytes of the file hashed so far
+
+    def __getattr__(self, name):
+        return getattr(self._fd, name)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._fd.seek(offset, whence)
+
+    def tell(self):
+        return self._fd.tell()
+
+    def read(self, size=-1):
+        start = self._fd.tell()
+        data = self._fd.read(size)
+        end = start + len(data)
+        if start <= self.hashed < end:
+            self.digest.update(memoryview(data)[self.hashed - start:])
+            self.hashed = end
+        return data
+
+    def finish(self):
+        """Hash whatever part of the file wasn't read in order, and return the hex digest
+
+        This only reads the file again if the upload skipped part of it, i.e. when it resumed a session.
+        """
+        position = self._fd.tell()
+        self._fd.seek(self.hashed)
+        while chunk := self._fd.read(HASH_READ_SIZE):
+            self.digest.update(chunk)
+            self.hashed += len(chunk)
+        self._fd.seek(position)
+        return self.digest.hexdigest()
+
+
+def resumable_upload(request, http=None, num_retries=5, on_session=None):
+    """Send every chunk of a resumable upload request. Returns the metadata of the uploaded file
+
+    :param request: googleapiclient HttpRequest with resumable media. Set its resumable_uri and
+        resumable_progress to continue an existing session
+    :param http: authorized http object to send the chunks with
+    :param num_retries: (int) times to retry each chunk after a server error or rate limit
+    :param on_session: callable taking the session URI, called once a new session has been started
+    """
+    new_session = request.resumable_uri is None
+    response = None
+    while response is None:
+        _, response = request.next_chunk(http=http, num_retries=num_retries)
+        if new_session and request.resumable_uri and on_session:
+            on_session(request.resumable_uri)
+            new_session = False
+    return response
+
+
+def query_upload_offset(http, uri, size):
+    """Ask Drive how much of a resumable upload session it has committed
+
+    :param http: authorized http object
+    :param uri: (str) resumable session URI
+    :param size: (int) total size of the file in bytes
+    :return: tuple of (offset, metadata). Metadata is only set if the upload already completed, and
+        offset is None if the session expired
+    """
+    resp, content = http.request(
+        uri, method='PUT', headers={'Content-Length': '0', 'Content-Range': f'bytes */{size}'})
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status == 308:
+        # The Range header holds the last committed byte, and is missing if nothing was committed
+        committed = resp.get('range')
+        return (int(committed.rsplit('-', 1)[1]) + 1 if committed else 0), None
+    return None, None
+
+
+class UploadSessions:
+    """Resumable upload session URIs saved to a JSON file, so uploads cut off by a crash can be resumed
+
+    Sessions are keyed by the path, size and modification time of the file being uploaded. Several processes
+    can share the file: each write holds a lock on it, and merges the sessions saved or removed by this
+    process into what the others wrote.
+
+    :param path: (str) path of the JSON file
+    """
+
+    def __init__(self, path='upload_sessions.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sessions = self._read()
+        self._changes = {}  # Key -> session URI saved, or None if removed, since the file was last written
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def key(filepath):
+        stat = os.stat(filepath)
+        return f'{os.path.abspath(filepath)}|{stat.st_size}|{int(stat.st_mtime)}'
+
+    def get(self, filepath):
+        with self._lock:
+            return self._sessions.get(self.key(filepath))
+
+    def save(self, filepath, uri):
+        with self._lock:
+            key = self.key(filepath)
+            self._sessions[key] = self._changes[key] = uri
+            self._write()
+
+    def remove(self, filepath):
+        with self._lock:
+            key = self.key(filepath)
+            if self._sessions.pop(key, None) is not None:
+                self._changes[key] = None
+                self._write()
+
+    def _write(self):
+        with open(f'{self.path}.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            sessions = self._read()
+            for key, uri in self._changes.items():
+                if uri is None:
+                    sessions.pop(key, None)
+                else:
+                    sessions[key] = uri
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.path)
+        self._sessions = sessions
+        self._changes = {}
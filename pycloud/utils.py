@@ -1,9 +1,161 @@
 import json
+import time
+import base64
 import datetime
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.parse import urlencode
 from pyicloud_ipd.services.photos import PhotoAlbum, PhotoAsset
 
+from pycloud.index import AlbumIndex
+from pycloud.records import AssetRecord
+from pycloud.ratelimit import RequestScheduler
+
+FULL_KEYS = [
+    u"resJPEGFullWidth",
+    u"resJPEGFullHeight",
+    u"resJPEGFullFileType",
+    u"resJPEGFullFingerprint",
+    u"resJPEGFullRes",
+    u"resJPEGLargeWidth",
+    u"resJPEGLargeHeight",
+    u"resJPEGLargeFileType",
+    u"resJPEGLargeFingerprint",
+    u"resJPEGLargeRes",
+    u"resJPEGMedWidth",
+    u"resJPEGMedHeight",
+    u"resJPEGMedFileType",
+    u"resJPEGMedFingerprint",
+    u"resJPEGMedRes",
+    u"resJPEGThumbWidth",
+    u"resJPEGThumbHeight",
+    u"resJPEGThumbFileType",
+    u"resJPEGThumbFingerprint",
+    u"resJPEGThumbRes",
+    u"resVidFullWidth",
+    u"resVidFullHeight",
+    u"resVidFullFileType",
+    u"resVidFullFingerprint",
+    u"resVidFullRes",
+    u"resVidMedWidth",
+    u"resVidMedHeight",
+    u"resVidMedFileType",
+    u"resVidMedFingerprint",
+    u"resVidMedRes",
+    u"resVidSmallWidth",
+    u"resVidSmallHeight",
+    u"resVidSmallFileType",
+    u"resVidSmallFingerprint",
+    u"resVidSmallRes",
+    u"resSidecarWidth",
+    u"resSidecarHeight",
+    u"resSidecarFileType",
+    u"resSidecarFingerprint",
+    u"resSidecarRes",
+    u"itemType",
+    u"dataClassType",
+    u"filenameEnc",
+    u"originalOrientation",
+    u"resOriginalWidth",
+    u"resOriginalHeight",
+    u"resOriginalFileType",
+    u"resOriginalFingerprint",
+    u"resOriginalRes",
+    u"resOriginalAltWidth",
+    u"resOriginalAltHeight",
+    u"resOriginalAltFileType",
+    u"resOriginalAltFingerprint",
+    u"resOriginalAltRes",
+    u"resOriginalVidComplWidth",
+    u"resOriginalVidComplHeight",
+    u"resOriginalVidComplFileType",
+    u"resOriginalVidComplFingerprint",
+    u"resOriginalVidComplRes",
+    u"isDeleted",
+    u"isExpunged",
+    u"dateExpunged",
+    u"remappedRef",
+    u"recordName",
+    u"recordType",
+    u"recordChangeTag",
+    u"masterRef",
+    u"adjustmentRenderType",
+    u"assetDate",
+    u"addedDate",
+    u"isFavorite",
+    u"isHidden",
+    u"orientation",
+    u"duration",
+    u"assetSubtype",
+    u"assetSubtypeV2",
+    u"assetHDRType",
+    u"burstFlags",
+    u"burstFlagsExt",
+    u"burstId",
+    u"captionEnc",
+    u"locationEnc",
+    u"locationV2Enc",
+    u"locationLatitude",
+    u"locationLongitude",
+    u"adjustmentType",
+    u"timeZoneOffset",
+    u"vidComplDurValue",
+    u"vidComplDurScale",
+    u"vidComplDispValue",
+    u"vidComplDispScale",
+    u"vidComplVisibilityState",
+    u"customRenderedValue",
+    u"containerId",
+    u"itemId",
+    u"position",
+    u"isKeyAsset",
+]
+
+# Everything needed to download and upload the original resource
+TRANSFER_KEYS = [
+    u"recordName",
+    u"recordType",
+    u"recordChangeTag",
+    u"masterRef",
+    u"assetDate",
+    u"addedDate",
+    u"itemType",
+    u"filenameEnc",
+    u"resOriginalWidth",
+    u"resOriginalHeight",
+    u"resOriginalFileType",
+    u"resOriginalFingerprint",
+    u"resOriginalRes",
+]
+
+# Enough to index photos by date and identify their original resource
+SIMPLE_KEYS = [
+    u"assetDate",
+    u"recordName",
+    u"recordType",
+    u"recordChangeTag",
+    u"masterRef",
+    u"filenameEnc",
+    u"resOriginalRes",
+    u"resOriginalFingerprint",
+]
+
+# Named desiredKeys projections that photos can be fetched with
+PROFILES = {
+    'full': FULL_KEYS,
+    'transfer': TRANSFER_KEYS,
+    'index': SIMPLE_KEYS,
+}
+
+try:
+    # Decodes records/query pages several times faster than the json module, if it's installed
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
 
 def convert_bytes(bytes, format='MB'):
     formats = {
@@ -24,9 +176,28 @@ class FilterAlbum(PhotoAlbum):
     """
     Wrapper class for PhotoAlbum with additional methods to filter photos by date range
     Methods adapted from @magus0219 via https://github.com/picklepete/pyicloud/pull/276
+
+    Photos can be fetched with any of the desiredKeys projections in :data:`PROFILES`: ``full`` for every
+    field, ``transfer`` for only what's needed to transfer the original, or ``index`` (same as ``simple=True``)
+    for the fields kept in the index.
+
+    Every request goes through a :class:`RequestScheduler`, which paces it and retries it when throttled.
+
+    If an :class:`AlbumIndex` is provided, it's filled by every listing, and once
+    it holds the whole album, date range queries, counts and histograms are answered from it locally.
+
+    Pages are read ahead, with up to ``read_ahead`` requests in flight, and the number of photos per
+    page is tuned between ``min_page_size`` and ``max_page_size`` so that pages take about
+    ``target_page_latency`` seconds and stay under ``max_page_bytes``.
     """
 
-    def __init__(self, album: PhotoAlbum):
+    read_ahead = 4
+    min_page_size = 25
+    max_page_size = 500
+    target_page_latency = 1.0
+    max_page_bytes = 8 * 1024 * 1024
+
+    def __init__(self, album: PhotoAlbum, index: AlbumIndex = None, scheduler: RequestScheduler = None):
         album.direction = 'DESCENDING'
         super().__init__(
             album.service,
@@ -38,8 +209,74 @@ class FilterAlbum(PhotoAlbum):
             album.page_size
         )
         self.album = album
+        self.index = index
+        self.scheduler = scheduler or RequestScheduler()
+        self._rank_dates = {}
+        self._index_current = None
+        self._page_assets = self.page_size
+        self.page_stats = {'pages': 0, 'bytes': 0, 'request_seconds': 0.0, 'parse_seconds': 0.0}
+        self._stats_lock = threading.Lock()
+
+    def __len__(self):
+        """Length of the album, fetched once and shared with the wrapped album for the rest of the session"""
+        if getattr(self.album, '_len', None) is None:
+            self.album._len = len(self.album)
+        return self.album._len
+
+    def refresh(self):
+        """Forget the length, photo dates and index state cached for the session, e.g. once other processes
+        may have deleted photos from the album, which shifts the rank of every photo after them"""
+        self.album._len = None
+        self._rank_dates = {}
+        self._index_current = None
+
+    def _query(self, offset, profile='full', results_limit=None):
+        """Post a single records/query request for the page starting at the given rank
+
+        :param offset: (int) startRank of the page
+        :param profile: (str) name of the desiredKeys projection to fetch
+        :param results_limit: (int) max number of records to return, defaults to the album page size
+        :return: (dict) decoded response
+        """
+        return self._timed_query(offset, profile, results_limit)[0]
+
+    def _timed_query(self, offset, profile='full', results_limit=None):
+        """Same as :meth:`_query`, but returns a tuple of (response, seconds elapsed, bytes received)"""
+        query = self._list_query_gen(
+            offset,
+            self.list_type,
+            self.direction,
+            self.query_filter,
+            profile=profile,
+        )
+        if results_limit:
+            query["resultsLimit"] = results_limit
 
-    def _list_query_gen(self, offset, list_type, direction, query_filter=None, simple=False):
+        # pylint: disable=protected-access
+        url = ("%s/records/query?" % self.service._service_endpoint) + urlencode(
+            self.service.params
+        )
+        start = time.perf_counter()
+        request = self.scheduler.call(
+            'icloud.query',
+            self.service.session.post,
+            url,
+            data=json.dumps(query),
+            headers={"Content-type": "text/plain"},
+        )
+        content = request.content
+        received = time.perf_counter()
+        response = _loads(content)
+        parsed = time.perf_counter()
+
+        with self._stats_lock:
+            self.page_stats['pages'] += 1
+            self.page_stats['bytes'] += len(content)
+            self.page_stats['request_seconds'] += received - start
+            self.page_stats['parse_seconds'] += parsed - received
+        return response, received - start, len(content)
+
+    def _list_query_gen(self, offset, list_type, direction, query_filter=None, simple=False, profile=None):
         query = {
             u"query": {
                 u"filterBy": [
@@ -59,114 +296,7 @@ class FilterAlbum(PhotoAlbum):
             u"resultsLimit": self.page_size * 2,
             u"zoneID": {u"zoneName": u"PrimarySync"},
         }
-        if simple is False:
-            query["desiredKeys"] = [
-                u"resJPEGFullWidth",
-                u"resJPEGFullHeight",
-                u"resJPEGFullFileType",
-                u"resJPEGFullFingerprint",
-                u"resJPEGFullRes",
-                u"resJPEGLargeWidth",
-                u"resJPEGLargeHeight",
-                u"resJPEGLargeFileType",
-                u"resJPEGLargeFingerprint",
-                u"resJPEGLargeRes",
-                u"resJPEGMedWidth",
-                u"resJPEGMedHeight",
-                u"resJPEGMedFileType",
-                u"resJPEGMedFingerprint",
-                u"resJPEGMedRes",
-                u"resJPEGThumbWidth",
-                u"resJPEGThumbHeight",
-                u"resJPEGThumbFileType",
-                u"resJPEGThumbFingerprint",
-                u"resJPEGThumbRes",
-                u"resVidFullWidth",
-                u"resVidFullHeight",
-                u"resVidFullFileType",
-                u"resVidFullFingerprint",
-                u"resVidFullRes",
-                u"resVidMedWidth",
-                u"resVidMedHeight",
-                u"resVidMedFileType",
-                u"resVidMedFingerprint",
-                u"resVidMedRes",
-                u"resVidSmallWidth",
-                u"resVidSmallHeight",
-                u"resVidSmallFileType",
-                u"resVidSmallFingerprint",
-                u"resVidSmallRes",
-                u"resSidecarWidth",
-                u"resSidecarHeight",
-                u"resSidecarFileType",
-                u"resSidecarFingerprint",
-                u"resSidecarRes",
-                u"itemType",
-                u"dataClassType",
-                u"filenameEnc",
-                u"originalOrientation",
-                u"resOriginalWidth",
-                u"resOriginalHeight",
-                u"resOriginalFileType",
-                u"resOriginalFingerprint",
-                u"resOriginalRes",
-                u"resOriginalAltWidth",
-                u"resOriginalAltHeight",
-                u"resOriginalAltFileType",
-                u"resOriginalAltFingerprint",
-                u"resOriginalAltRes",
-                u"resOriginalVidComplWidth",
-                u"resOriginalVidComplHeight",
-                u"resOriginalVidComplFileType",
-                u"resOriginalVidComplFingerprint",
-                u"resOriginalVidComplRes",
-                u"isDeleted",
-                u"isExpunged",
-                u"dateExpunged",
-                u"remappedRef",
-                u"recordName",
-                u"recordType",
-                u"recordChangeTag",
-                u"masterRef",
-                u"adjustmentRenderType",
-                u"assetDate",
-                u"addedDate",
-                u"isFavorite",
-                u"isHidden",
-                u"orientation",
-                u"duration",
-                u"assetSubtype",
-                u"assetSubtypeV2",
-                u"assetHDRType",
-                u"burstFlags",
-                u"burstFlagsExt",
-                u"burstId",
-                u"captionEnc",
-                u"locationEnc",
-                u"locationV2Enc",
-                u"locationLatitude",
-                u"locationLongitude",
-                u"adjustmentType",
-                u"timeZoneOffset",
-                u"vidComplDurValue",
-                u"vidComplDurScale",
-                u"vidComplDispValue",
-                u"vidComplDispScale",
-                u"vidComplVisibilityState",
-                u"customRenderedValue",
-                u"containerId",
-                u"itemId",
-                u"position",
-                u"isKeyAsset",
-            ]
-        else:
-            query["desiredKeys"] = [
-                u"assetDate",
-                u"recordName",
-                u"recordType",
-                u"recordChangeTag",
-                u"masterRef",
-            ]
+        query["desiredKeys"] = PROFILES[profile or ('index' if simple else 'full')]
 
         if query_filter:
             query["query"]["filterBy"].extend(query_filter)
@@ -239,7 +369,213 @@ class FilterAlbum(PhotoAlbum):
             return album_len - 1 - idx_first, idx_last - idx_first + 1
         return idx_first, idx_last - idx_first + 1
 
-    def calculate_offset_and_cnt(self, album_len=None, last=None, date_start=None, date_end=None):
+    def _lookup(self, record_names, profile='full'):
+        """Fetch records by name with a single records/lookup request
+
+        :param record_names: (list) recordNames of CPLAsset and/or CPLMaster records
+        :param profile: (str) name of the desiredKeys projection to fetch
+        :return: (dict) records by recordName, excluding any that weren't found
+        """
+        # pylint: disable=protected-access
+        url = ("%s/records/lookup?" % self.service._service_endpoint) + urlencode(
+            self.service.params
+        )
+        request = self.scheduler.call(
+            'icloud.query',
+            self.service.session.post,
+            url,
+            data=json.dumps({
+                u"records": [{u"recordName": name} for name in record_names],
+                u"zoneID": {u"zoneName": u"PrimarySync"},
+                u"desiredKeys": PROFILES[profile],
+            }),
+            headers={"Content-type": "text/plain"},
+        )
+        return {
+            rec["recordName"]: rec for rec in request.json()["records"]
+            if "serverErrorCode" not in rec
+        }
+
+    def index_is_current(self):
+        """Whether the index holds every record of the album. Checked once per session"""
+        if self.index is None:
+            return False
+        if self._index_current is None:
+            album_len = len(self)
+            newest = None
+            if album_len:
+                # Photos added and removed since the last sync would leave the count unchanged
+                newest = (self._rank_asset(album_len - 1) or {}).get("recordName")
+            self._index_current = self.index.is_current(self.name, album_len, newest)
+        return self._index_current
+
+    def update_index(self):
+        """Index the photos added to the album since the index was synced, without listing the others
+
+        Ranks follow photo dates, so photos added with later dates than every indexed one take the ranks
+        after those. That's checked by probing the photo at the rank of the newest indexed one, and only
+        the ranks after it are listed.
+
+        :return: (int) photos added to the index, or None if the album changed in some other way, e.g. photos
+            were added with older dates or removed by something else, so it has to be rebuilt with :meth:`sync_index`
+        """
+        if self.index_is_current():
+            return 0
+        album_len = len(self)
+        indexed = self.index.count(self.name)
+        if not indexed or indexed >= album_len or self.index.synced_count(self.name) != indexed:
+            return None
+        newest = self._rank_asset(indexed - 1)
+        if not newest or newest["recordName"] != self.index.newest(self.name):
+            return None
+
+        added = 0
+        offset = album_len - 1 if self.direction == "DESCENDING" else indexed
+        for asset_records, master_records in self._read_pages(offset, album_len - indexed, 'index'):
+            self.index.add(self.name, [
+                AlbumIndex.row_from_records(asset_record, master_records[master_id])
+                for asset_record, master_id in asset_records
+            ])
+            added += len(asset_records)
+        self.index.mark_synced(self.name, indexed + added)
+        self._index_current = None
+        return added if self.index_is_current() else None
+
+    def sync_index(self):
+        """Rebuild the index of the album from a full listing of its index fields"""
+        self.index.clear(self.name)
+        self._index_current = False
+        count = 0
+        for _ in self.fetch_photos(simple=True):
+            count += 1
+        self.index.mark_synced(self.name, count)
+        self._index_current = count == len(self)
+        return count
+
+    def count(self, date_start=None, date_end=None):
+        """Number of photos in the album, or within a date range, answered locally if the index is current"""
+        if self.index_is_current():
+            return self.index.count(self.name, date_start, date_end)
+        if not date_start:
+            return len(self)
+        return self.calculate_offset_and_cnt(date_start=date_start, date_end=date_end)[1]
+
+    def histogram(self, date_start=None, date_end=None):
+        """Number of photos per month as a dict of "YYYY/mm" to count. Requires a current index"""
+        if not self.index_is_current():
+            raise RuntimeError(f'Index of album {self.name} is not current, run sync_index() first')
+        return self.index.histogram(self.name, date_start, date_end)
+
+    def _records_from_row(self, row):
+        """Rebuild simple (master, asset) records from an index row"""
+        record_name, asset_date, master_ref, change_tag, filename, size, fingerprint, master_change_tag = row
+        asset_record = {
+            u"recordName": record_name,
+            u"recordType": u"CPLAsset",
+            u"recordChangeTag": change_tag,
+            u"fields": {
+                u"assetDate": {u"value": asset_date},
+                u"masterRef": {u"value": {u"recordName": master_ref}},
+            },
+        }
+        master_fields = {}
+        if filename is not None:
+            master_fields[u"filenameEnc"] = {u"value": base64.b64encode(filename.encode("utf-8")).decode()}
+        if size is not None:
+            master_fields[u"resOriginalRes"] = {u"value": {u"size": size}}
+        if fingerprint is not None:
+            master_fields[u"resOriginalFingerprint"] = {u"value": fingerprint}
+        master_record = {
+            u"recordName": master_ref,
+            u"recordType": u"CPLMaster",
+            u"recordChangeTag": master_change_tag,
+            u"fields": master_fields,
+        }
+        return master_record, asset_record
+
+    def _fetch_indexed(self, last=None, date_start=None, date_end=None, profile='full', compact=False):
+        """Select photos from the index, then hydrate them in bulk unless only index fields are needed
+
+        Compact records only hold index fields whatever the profile, and are looked up again when they're
+        promoted, so they're built from the rows without hydrating them.
+        """
+        rows = self.index.select(
+            self.name, date_start, date_end, last, descending=self.direction == "DESCENDING"
+        )
+        if compact:
+            for record_name, asset_date, master_ref, change_tag, filename, size, fingerprint, master_tag in rows:
+                yield AssetRecord(self, record_name, master_ref, asset_date, filename, size, fingerprint,
+                                  asset_change_tag=change_tag, master_change_tag=master_tag)
+            return
+        if profile == 'index':
+            for row in rows:
+                yield PhotoAsset(self.service, *self._records_from_row(row))
+            return
+
+        for i in range(0, len(rows), self.page_size):
+            batch = rows[i:i + self.page_size]
+            records = self._lookup([row[0] for row in batch] + [row[2] for row in batch], profile)
+            for row in batch:
+                asset_record, master_record = records.get(row[0]), records.get(row[2])
+                if asset_record and master_record:  # Skip photos deleted since the index was synced
+                    yield self._photo(asset_record, master_record, compact)
+
+    def _rank_date(self, rank):
+        """Date of the photo at a given rank, probed with a single record query
+
+        Ranks count up from the oldest photo in the album, regardless of the query direction
+        """
+        if rank not in self._rank_dates:
+            rec = self._rank_asset(rank)
+            if rec is None:
+                raise LookupError(f"No photo found at rank {rank} of album {self.name}")
+            self._rank_dates[rank] = datetime.datetime.fromtimestamp(
+                rec["fields"]["assetDate"]["value"] // 1000
+            ).date()
+        return self._rank_dates[rank]
+
+    def _rank_asset(self, rank):
+        """CPLAsset record of the photo at a given rank with only index fields, or None if there's none"""
+        # A page of 2 records holds the CPLAsset at this rank and its CPLMaster
+        for rec in self._query(rank, 'index', results_limit=2)["records"]:
+            if rec["recordType"] == "CPLAsset":
+                return rec
+        return None
+
+    def _bisect_rank(self, album_len, date, inclusive):
+        """Binary search for the first rank whose date is after (or on, if not inclusive) the given date"""
+        lo, hi = 0, album_len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rank_date = self._rank_date(mid)
+            if rank_date > date or (not inclusive and rank_date == date):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def __seek_offset_and_cnt_by_date(self, album_len, date_start, date_end):
+        """Get idx and cnt of date query by binary searching the boundary ranks
+
+        Photos are sorted by date, so this takes about 2 * log2(album_len) single record queries
+
+        :param self:
+        :param album_len: (int) len of album
+        :param date_start: (datetime.date) start date of query
+        :param date_end: (datetime.date) end date of query(include)
+        :return: (offset, cnt)
+        """
+        first = self._bisect_rank(album_len, date_start, inclusive=False)
+        end = self._bisect_rank(album_len, date_end, inclusive=True)
+        cnt = max(end - first, 0)
+        if not cnt:
+            return 0, 0
+
+        if self.direction == "DESCENDING":
+            return end - 1, cnt
+        return first, cnt
+
+    def calculate_offset_and_cnt(self, album_len=None, last=None, date_start=None, date_end=None, seek=True):
         """A method to calculate offset and cnt from input
 
         Photos are sorted by date in ascending order, and the idx is reverted.
@@ -255,6 +591,7 @@ class FilterAlbum(PhotoAlbum):
         :param last: (int) cnt of recent photos
         :param date_start: (datetime.date) start date of query
         :param date_end: (datetime.date) end date of query(include)
+        :param seek: (bool) flag to binary search for the date range instead of scanning the album
         :return:
         """
         if not album_len:
@@ -264,9 +601,14 @@ class FilterAlbum(PhotoAlbum):
             if not date_end:
                 date_end = datetime.date.today() + datetime.timedelta(days=1)
 
-            offset, cnt = self.__get_offset_and_cnt_by_date(
-                album_len, date_start, date_end
-            )
+            if seek:
+                offset, cnt = self.__seek_offset_and_cnt_by_date(
+                    album_len, date_start, date_end
+                )
+            else:
+                offset, cnt = self.__get_offset_and_cnt_by_date(
+                    album_len, date_start, date_end
+                )
 
         elif last:
             if last > album_len:
@@ -286,7 +628,13 @@ class FilterAlbum(PhotoAlbum):
 
         return offset, cnt
 
-    def fetch_photos(self, album_len=None, last=None, date_start=None, date_end=None, simple=False):
+    def _photo(self, asset_record, master_record, compact=False):
+        if compact:
+            return AssetRecord.from_records(self, asset_record, master_record)
+        return PhotoAsset(self.service, master_record, asset_record)
+
+    def fetch_photos(self, album_len=None, last=None, date_start=None, date_end=None, simple=False, seek=True,
+                     profile=None, compact=False):
         """Fetch photos using offset and cnt
 
         :param album_len: (int) len of album
@@ -294,58 +642,106 @@ class FilterAlbum(PhotoAlbum):
         :param date_start: (datetime.date) start date of query
         :param date_end: (datetime.date) end date of query(include)
         :param simple: (bool) flag to fetch only simple metadata of photo
+        :param seek: (bool) flag to binary search for the date range instead of scanning the album
+        :param profile: (str) name of the desiredKeys projection to fetch, one of :data:`PROFILES`.
+            Defaults to "index" if simple, otherwise "full"
+        :param compact: (bool) flag to yield compact :class:`AssetRecord` objects instead of PhotoAssets, which
+            are only promoted to a PhotoAsset when they're downloaded
         :return:
         """
+        profile = profile or ('index' if simple else 'full')
+        if profile not in PROFILES:
+            raise ValueError('Not a valid profile. Valid profiles: {}'.format([p for p in PROFILES]))
+
+        if (profile == 'index' or last or date_start) and self.index_is_current():
+            yield from self._fetch_indexed(last, date_start, date_end, profile, compact)
+            return
 
         offset, cnt = self.calculate_offset_and_cnt(
-            album_len=album_len, last=last, date_start=date_start, date_end=date_end
+            album_len=album_len, last=last, date_start=date_start, date_end=date_end, seek=seek
         )
 
-        while cnt:
-            # pylint: disable=protected-access
-            url = ("%s/records/query?" % self.service._service_endpoint) + urlencode(
-                self.service.params
-            )
-            request = self.service.session.post(
-                url,
-                data=json.dumps(
-                    self._list_query_gen(
-                        offset,
-                        self.list_type,
-                        self.direction,
-                        self.query_filter,
-                        simple,
-                    )
-                ),
-                headers={"Content-type": "text/plain"},
-            )
-            response = request.json()
-
-            asset_records = []
-            master_records = {}
-            for rec in response["records"]:
-                if rec["recordType"] == "CPLAsset":
-                    master_id = rec["fields"]["masterRef"]["value"]["recordName"]
-                    asset_records.append({"master_id": master_id, "record": rec})
-                elif rec["recordType"] == "CPLMaster":
-                    master_records[rec["recordName"]] = rec
-
-            asset_records_len = len(asset_records)
-            if asset_records_len:
-                if self.direction == "DESCENDING":
-                    offset = offset - asset_records_len
-                else:
-                    offset = offset + asset_records_len
-
-                for asset_record in asset_records:
-                    if cnt:
-                        yield PhotoAsset(
-                            self.service,
-                            master_records[asset_record["master_id"]],
-                            asset_record["record"],
-                        )
-                        cnt -= 1
-                    else:
+        for asset_records, master_records in self._read_pages(offset, cnt, profile):
+            if self.index is not None:
+                self.index.add(self.name, [
+                    AlbumIndex.row_from_records(asset_record, master_records[master_id])
+                    for asset_record, master_id in asset_records
+                ])
+
+            for asset_record, master_id in asset_records:
+                yield self._photo(asset_record, master_records[master_id], compact)
+
+    @staticmethod
+    def _parse_page(response):
+        """Split a records/query response into (CPLAsset, masterRef recordName) pairs and CPLMaster records by name"""
+        asset_records = []
+        master_records = {}
+        for rec in response["records"]:
+            if rec["recordType"] == "CPLAsset":
+                asset_records.append((rec, rec["fields"]["masterRef"]["value"]["recordName"]))
+            elif rec["recordType"] == "CPLMaster":
+                master_records[rec["recordName"]] = rec
+        return asset_records, master_records
+
+    def _read_pages(self, offset, cnt, profile='full'):
+        """Yield pages of (asset_records, master_records) in order, keeping up to read_ahead requests in flight
+
+        The startRank of each upcoming page is computed from the sizes of the pages before it. If a page
+        comes back short, the pages after it are dropped and requested again from the right offset.
+
+        :param offset: (int) startRank of the first page
+        :param cnt: (int) number of photos to fetch
+        :param profile: (str) name of the desiredKeys projection to fetch
+        """
+        step = -1 if self.direction == "DESCENDING" else 1
+        pending = collections.deque()
+        next_offset, unscheduled = offset, cnt
+
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            try:
+                while cnt:
+                    while unscheduled and len(pending) < self.read_ahead:
+                        size = min(self._page_assets, unscheduled)
+                        future = executor.submit(self._timed_query, next_offset, profile, size * 2)
+                        pending.append((next_offset, size, future))
+                        next_offset += step * size
+                        unscheduled -= size
+
+                    if not pending:
                         break
-            else:
-                break  # pragma: no cove
+                    page_offset, size, future = pending.popleft()
+                    response, elapsed, nbytes = future.result()
+                    asset_records, master_records = self._parse_page(response)
+                    if not asset_records:
+                        break  # pragma: no cover
+
+                    got = len(asset_records)
+                    asset_records = asset_records[:min(size, cnt)]
+                    cnt -= len(asset_records)
+                    self._tune_page_size(size, got, elapsed, nbytes, more=bool(cnt))
+
+                    if got < size:
+                        # Offsets of the pages in flight assumed a full page, so they're wrong now
+                        for _, _, stale in pending:
+                            stale.cancel()
+                        pending.clear()
+                        next_offset = page_offset + step * got
+                        unscheduled = cnt
+
+                    yield asset_records, master_records
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    def _tune_page_size(self, size, got, elapsed, nbytes, more=True):
+        """Adjust the number of photos per page from the latency and payload size of the last page"""
+        if got < size and more:
+            # A short page before the end of the album means the server caps the page size
+            self.max_page_size = max(got, self.min_page_size)
+            self._page_assets = min(self._page_assets, self.max_page_size)
+            return
+
+        if elapsed < self.target_page_latency / 2 and nbytes < self.max_page_bytes / 2:
+            self._page_assets = min(self._page_assets * 2, self.max_page_size)
+        elif elapsed > self.target_page_latency * 2 or nbytes > self.max_page_bytes:
+            self._page_assets = max(self._page_assets // 2, self.min_page_size)
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+
+from urllib.parse import urlencode
+
+from pycloud.utils import PROFILES
+from pycloud.records import AssetRecord
+from pycloud.logger import PyCloudLogger
+
+ZONE = 'PrimarySync'
+
+# Record types followed in the change feed
+RECORD_TYPES = ['CPLAsset', 'CPLMaster']
+
+# Asset fields that leave a photo out of the album queries, so changed assets with any of them set are skipped.
+# Photos deleted after they're transferred come back through the feed with isDeleted set
+EXCLUDED_FLAGS = ('isDeleted', 'isHidden', 'isExpunged')
+
+# Seconds waited after a failed poll or transfer, doubled after each one in a row up to MAX_RETRY_DELAY
+RETRY_DELAY = 30.0
+MAX_RETRY_DELAY = 3600.0
+
+
+class SyncToken:
+    """Sync token of the change feed, saved to a JSON file so that watching resumes where it left off
+
+    :param path: (str) path of the JSON file
+    """
+
+    def __init__(self, path='pycloud_sync_token.json'):
+        self.path = path
+        self.value = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.value = json.load(f).get('syncToken')
+
+    def save(self, value):
+        """Replace the saved token atomically"""
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'syncToken': value, 'saved': time.time()}, f)
+        os.replace(tmp, self.path)
+        self.value = value
+
+
+class ChangeWatcher:
+    """Follows the change feed of the PrimarySync zone, to queue only the photos added or changed since the last poll
+
+    Each poll sends changes/zone requests from the saved sync token, one per page of changes, so a poll
+    where nothing changed costs one request however large the library is. Changed assets whose CPLMaster
+    didn't change come without it, and their masters are looked up with one records/lookup request per
+    ``page_size`` assets. The feed covers the whole library, whatever the album.
+
+    Without a saved token, watching starts from the current token of the zone, so the photos already in
+    the library aren't queued; those are transferred with a normal run.
+
+    :param album: (FilterAlbum) album whose service and request scheduler are used, and that the photos are
+        looked up through when they're downloaded
+    :param token_path: (str) path of the JSON file that the sync token is saved to
+    :param profile: (str) name of the desiredKeys projection to fetch, one of :data:`PROFILES`
+    :param results_limit: (int) max records per changes/zone page
+    """
+
+    def __init__(self, album, token_path='pycloud_sync_token.json', profile='transfer', results_limit=200):
+        self.album = album
+        self.token = SyncToken(token_path)
+        self.keys = PROFILES[profile] + list(EXCLUDED_FLAGS)
+        self.profile = profile
+        self.results_limit = results_limit
+        self.logger = PyCloudLogger(name='ChangeWatcher')
+        self._requeued = {}
+
+    def _post(self, path, data):
+        # pylint: disable=protected-access
+        url = f'{self.album.service._service_endpoint}/{path}?' + urlencode(self.album.service.params)
+        response = self.album.scheduler.call(
+            'icloud.query',
+            self.album.service.session.post,
+            url,
+            data=json.dumps(data),
+            headers={"Content-type": "text/plain"},
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def current_token(self):
+        """Current sync token of the zone, from which only changes made afterwards are fetched"""
+        for zone in self._post('zones/list', {}).get('zones', []):
+            if zone['zoneID']['zoneName'] == ZONE:
+                return zone['syncToken']
+        raise RuntimeError(f'Zone {ZONE} not found in iCloud')
+
+    def _changes(self, token):
+        """Yield a tuple of (records, sync token after them) for each page of changes since a sync token"""
+        more = True
+        while more:
+            zone = self._post('changes/zone', {
+                'zones': [{
+                    'zoneID': {'zoneName': ZONE},
+                    'syncToken': token,
+                    'desiredRecordTypes': RECORD_TYPES,
+                    'desiredKeys': self.keys,
+                    'resultsLimit': self.results_limit,
+                    'reverse': False,
+                }]
+            })['zones'][0]
+            if 'serverErrorCode' in zone:
+                # An expired token can't be recovered, since changes before the current token would be missed
+                raise RuntimeError(
+                    f'Failed to fetch changes of zone {ZONE}: {zone.get("reason", zone["serverErrorCode"])}. '
+                    f'Transfer recent photos with a normal run, then remove {self.token.path} to watch from now')
+            token = zone['syncToken']
+            more = zone.get('moreComing', False)
+            yield zone.get('records', []), token
+
+    def poll(self):
+        """Photos added or changed since the saved sync token
+
+        :return: tuple of the list of :class:`AssetRecord` objects, and the sync token to save once they're handled
+        """
+        assets, masters = {}, {}
+        token = self.token.value
+        for records, token in self._changes(token):
+            for rec in records:
+                name = rec['recordName']
+                if rec.get('recordType') == 'CPLMaster':
+                    if not rec.get('deleted'):
+                        masters[name] = rec
+                    continue
+                fields = rec.get('fields', {})
+                if rec.get('deleted') or any(fields.get(flag, {}).get('value') for flag in EXCLUDED_FLAGS):
+                    assets.pop(name, None)
+                else:
+                    assets[name] = rec
+
+        master_names = {rec['fields']['masterRef']['value']['recordName'] for rec in assets.values()}
+        missing = sorted(master_names - masters.keys())
+        for i in range(0, len(missing), self.album.page_size):
+            masters.update(self.album._lookup(missing[i:i + self.album.page_size], self.profile))
+
+        photos = []
+        for rec in assets.values():
+            master = masters.get(rec['fields']['masterRef']['value']['recordName'])
+            if master:  # Skip photos whose master was deleted since
+                photos.append(AssetRecord.from_records(self.album, rec, master))
+        return photos, token
+
+    def requeue(self, photos):
+        """Queue photos again with the next poll, e.g. ones that failed to transfer"""
+        for photo in photos:
+            self._requeued[photo.id] = photo
+
+    def step(self, transfer):
+        """Poll once, and transfer the photos added or changed along with those queued again
+
+        The sync token of the poll is only saved once its photos are transferred, so if the poll or the
+        transfer raises, or the process stops, they're fetched again by the next poll.
+
+        :param transfer: callable taking a list of :class:`AssetRecord` objects and returning those that failed or
+            were skipped, e.g. for the Drive quota, which are queued again with the next poll
+        """
+        if self.token.value is None:
+            self.token.save(self.current_token())
+            self.logger.info(f'Watching for photos added from now on, with the sync token saved to {self.token.path}')
+            return
+
+        photos, token = self.poll()
+        queued = {**self._requeued, **{photo.id: photo for photo in photos}}
+        if queued:
+            self.logger.info(f'{len(photos)} new or changed photos, {len(queued) - len(photos)} queued again')
+            failed = transfer(list(queued.values()))
+            self._requeued = {}
+            self.requeue(failed)
+        if token != self.token.value:
+            self.token.save(token)
+
+    def watch(self, transfer, interval=300.0):
+        """Poll every ``interval`` seconds and transfer what changed, until interrupted
+
+        A poll or transfer that raises is logged and tried again from the same sync token, after
+        :data:`RETRY_DELAY` seconds, doubled after each failure in a row.
+
+        :param transfer: callable taking a list of :class:`AssetRecord` objects and returning those to queue again
+        :param interval: (float) seconds between the start of each poll
+        """
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                self.step(transfer)
+            except Exception as e:
+                failures += 1
+                delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+                self.logger.error(f'Failed to poll or transfer changes ({e}), trying again in {delay:.0f}s')
+                time.sleep(delay)
+                continue
+            failures = 0
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,8 @@
+import tempfile
+
+from pycloud.logger import setup_logging
+
+
+def pytest_configure(config):
+    # Logs go to a temporary directory instead of pycloud.log in the working directory
+    setup_logging(f'{tempfile.mkdtemp(prefix="pycloud-tests-")}/pycloud.log')
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+pytest.importorskip('tzlocal', reason='pycloud.services needs tzlocal')
+
+from pycloud.services import DeleteBuffer  # noqa: E402
+
+
+class Cloud:
+    def __init__(self, fail):
+        self.fail = fail
+        self.errors = []
+
+    def delete_photos(self, photos, permanent=False, batch_size=100):
+        if self.fail:
+            raise ConnectionError('reset by peer')
+        return list(photos), []
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+def test_failed_request_reports_batch_as_failed():
+    cloud = Cloud(fail=True)
+    batches = []
+    buffer = DeleteBuffer(cloud, max_size=2, max_wait=60, callback=lambda deleted, failed: batches.append(
+        (deleted, failed)))
+
+    buffer.add('a')
+    buffer.add('b')
+    buffer.close()
+
+    assert batches == [([], ['a', 'b'])]
+    assert len(cloud.errors) == 1
+
+
+def test_timer_survives_failed_request():
+    cloud = Cloud(fail=True)
+    flushed = threading.Event()
+    batches = []
+
+    def callback(deleted, failed):
+        batches.append((deleted, failed))
+        flushed.set()
+
+    buffer = DeleteBuffer(cloud, max_size=100, max_wait=0.01, callback=callback)
+    buffer.add('a')
+    assert flushed.wait(5)
+
+    # The timer thread still flushes the batches after the failed one
+    cloud.fail = False
+    flushed.clear()
+    buffer.add('b')
+    assert flushed.wait(5)
+    buffer.close()
+
+    assert batches == [([], ['a']), (['b'], [])]
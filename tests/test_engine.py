@@ -0,0 +1,242 @@
+import os
+import hashlib
+
+import pytest
+
+pytest.importorskip('tzlocal', reason='pycloud.services needs tzlocal')
+
+from pycloud.engine import TransferEngine  # noqa: E402
+from pycloud.journal import TransferJournal  # noqa: E402
+from pycloud.ratelimit import RequestScheduler  # noqa: E402
+from pycloud.staging import StagingCache  # noqa: E402
+
+SIZE = 100
+
+
+class Photo:
+    def __init__(self, name):
+        self.filename = f'{name}.jpg'
+        self.size = SIZE
+        self._asset_record = {'recordName': name}
+
+    def download(self, version):
+        return Download(self.filename[0].encode() * SIZE)
+
+
+class Download:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        return iter([self.data])
+
+    def close(self):
+        pass
+
+
+class Quota:
+    total = 10 * SIZE
+    used = reserved = committed = released = 0
+
+    def __init__(self, admits, fits):
+        self.admits = admits
+        self._fits = fits
+
+    def reserve(self, size):
+        return self.admits
+
+    def fits(self, size):
+        return self._fits
+
+    def release(self, size, error=False):
+        self.released += size
+
+    def commit(self, size):
+        self.committed += size
+
+
+class Cloud:
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self.scheduler = RequestScheduler()
+        self.deleted = []
+
+    def info(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+    @staticmethod
+    def date_path(photo):
+        return '2020/01'
+
+    def delete_photos(self, photos, permanent=False, batch_size=100):
+        self.deleted.append([photo.filename for photo in photos])
+        return list(photos), []
+
+
+class Drive:
+    def __init__(self, quota, files=None):
+        self.quota = quota
+        self.folders = {'2020/01': 'folder'}
+        self.files = files or {}
+        self.failing = set()
+        self.uploaded = []
+
+    def info(self, message):
+        pass
+
+    def get_file(self, title, folder_id, size=None):
+        return self.files.get(title)
+
+    def get_date_folder(self, date):
+        return self.folders[date]
+
+    def upload_stream(self, chunks, title, parent_id=None, size=None, digest=None):
+        if title in self.failing:
+            raise ConnectionError('reset by peer')
+        data = b''.join(chunks)
+        digest.update(data)
+        self.uploaded.append(title)
+        return {'id': title, 'fileSize': str(len(data)), 'md5Checksum': hashlib.md5(data).hexdigest()}
+
+
+@pytest.fixture
+def staged(tmp_path):
+    """A staging cache holding a downloaded photo, and a journal that resumes it at the upload stage"""
+    staging = StagingCache(str(tmp_path / 'staging'))
+    path = os.path.join(staging.root, '2020', '01', 'a.jpg')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(b'a' * SIZE)
+    staging = StagingCache(staging.root)
+
+    journal = TransferJournal(str(tmp_path / 'journal.db'))
+    journal.record('a', TransferJournal.DOWNLOADED, filename='a.jpg', date_path='2020/01', download_path=path)
+    yield staging, journal, path
+    journal.close()
+
+
+def _engine(tmp_path, drive, staging, journal, **kwargs):
+    return TransferEngine(Cloud(str(tmp_path)), drive, staging=staging, journal=journal, delete_wait=0.01, **kwargs)
+
+
+def test_deferred_photo_is_not_pinned(tmp_path, staged):
+    staging, journal, path = staged
+    engine = _engine(tmp_path, Drive(Quota(admits=False, fits=True)), staging, journal)
+
+    success, failed = engine.run([Photo('a')])
+
+    assert (success, failed) == ([], [])
+    assert [photo.filename for photo in engine.skipped] == ['a.jpg']
+    assert not staging._pinned
+    assert staging.contains(path, SIZE)
+
+
+def test_skipped_photo_is_not_pinned(tmp_path, staged):
+    staging, journal, path = staged
+    engine = _engine(tmp_path, Drive(Quota(admits=False, fits=False)), staging, journal)
+
+    engine.run([Photo('a')])
+
+    assert [photo.filename for photo in engine.skipped] == ['a.jpg']
+    assert not staging._pinned
+
+
+def test_photo_in_drive_releases_its_staged_copy(tmp_path, staged):
+    staging, journal, path = staged
+    drive = Drive(Quota(admits=True, fits=True), files={'a.jpg': {'id': 'file', 'fileSize': str(SIZE)}})
+    engine = _engine(tmp_path, drive, staging, journal, delete=False, verify=False)
+
+    success, failed = engine.run([Photo('a')])
+
+    assert [photo.filename for photo in success] == ['a.jpg']
+    assert not staging._pinned
+    assert not staging.contains(path)
+
+
+def _in_drive(md5):
+    return Drive(Quota(admits=True, fits=True),
+                 files={'a.jpg': {'id': 'file', 'fileSize': str(SIZE), 'md5Checksum': md5}})
+
+
+def test_photo_in_drive_is_deleted_when_its_staged_copy_matches(tmp_path, staged):
+    staging, journal, path = staged
+    engine = _engine(tmp_path, _in_drive(hashlib.md5(b'a' * SIZE).hexdigest()), staging, journal, verify=False)
+
+    success, failed = engine.run([Photo('a')])
+
+    assert ([photo.filename for photo in success], failed) == (['a.jpg'], [])
+    assert journal.stage('a') == TransferJournal.DELETED
+
+
+def test_photo_in_drive_is_kept_when_its_staged_copy_differs(tmp_path, staged):
+    staging, journal, path = staged
+    engine = _engine(tmp_path, _in_drive(hashlib.md5(b'b' * SIZE).hexdigest()), staging, journal, verify=False)
+
+    success, failed = engine.run([Photo('a')])
+
+    assert (success, [photo.filename for photo in failed]) == ([], ['a.jpg'])
+    assert journal.stage('a') == TransferJournal.MISMATCH
+
+
+def test_photo_in_drive_is_kept_without_a_checksum(tmp_path):
+    journal = TransferJournal(str(tmp_path / 'journal.db'))
+    staging = StagingCache(str(tmp_path / 'staging'))
+    engine = _engine(tmp_path, _in_drive('unknown'), staging, journal, verify=False)
+
+    success, failed = engine.run([Photo('a')])
+
+    assert ([photo.filename for photo in success], failed) == (['a.jpg'], [])
+    assert journal.stage('a') == TransferJournal.UPLOADED
+    journal.close()
+    # A later run checks it again instead of deleting it
+    journal = TransferJournal(str(tmp_path / 'journal.db'))
+    engine = _engine(tmp_path, _in_drive('unknown'), staging, journal, verify=False)
+    engine.run([Photo('a')])
+    assert journal.stage('a') == TransferJournal.UPLOADED
+    journal.close()
+
+
+def test_pipeline_uploads_verifies_and_deletes_in_batches(tmp_path):
+    drive = Drive(Quota(admits=True, fits=True))
+    cloud = Cloud(str(tmp_path))
+    engine = TransferEngine(cloud, drive, stream=True, upload_workers=3, delete_batch_size=4, delete_wait=0.01)
+    photos = [Photo(name) for name in 'abcdefghij']
+
+    success, failed = engine.run(photos)
+
+    assert (sorted(photo.filename for photo in success), failed) == (sorted(p.filename for p in photos), [])
+    assert sorted(drive.uploaded) == sorted(photo.filename for photo in photos)
+    assert all(len(batch) <= 4 for batch in cloud.deleted)
+    assert sorted(sum(cloud.deleted, [])) == sorted(photo.filename for photo in photos)
+    assert drive.quota.committed == len(photos) * SIZE
+
+
+def test_failed_upload_releases_its_quota_and_others_continue(tmp_path):
+    drive = Drive(Quota(admits=True, fits=True))
+    drive.failing.add('b.jpg')
+    cloud = Cloud(str(tmp_path))
+    engine = TransferEngine(cloud, drive, stream=True, delete_wait=0.01)
+
+    success, failed = engine.run([Photo(name) for name in 'abc'])
+
+    assert sorted(photo.filename for photo in success) == ['a.jpg', 'c.jpg']
+    assert [photo.filename for photo in failed] == ['b.jpg']
+    assert 'b.jpg' not in sum(cloud.deleted, [])
+    assert (drive.quota.committed, drive.quota.released) == (2 * SIZE, SIZE)
+
+
+def test_photos_are_not_deleted_without_the_delete_stage(tmp_path):
+    drive = Drive(Quota(admits=True, fits=True))
+    cloud = Cloud(str(tmp_path))
+    engine = TransferEngine(cloud, drive, stream=True, delete=False)
+
+    success, failed = engine.run([Photo(name) for name in 'ab'])
+
+    assert sorted(photo.filename for photo in success) == ['a.jpg', 'b.jpg']
+    assert cloud.deleted == []
@@ -0,0 +1,26 @@
+from pycloud.index import AlbumIndex
+
+
+def _records(name, date):
+    asset = {'recordName': name, 'recordType': 'CPLAsset', 'recordChangeTag': 'a',
+             'fields': {'assetDate': {'value': date}, 'masterRef': {'value': {'recordName': f'M{name}'}}}}
+    master = {'recordName': f'M{name}', 'recordType': 'CPLMaster', 'recordChangeTag': 'm', 'fields': {}}
+    return asset, master
+
+
+def test_newest_and_synced_count(tmp_path):
+    index = AlbumIndex(str(tmp_path / 'index.db'))
+    assert index.newest('All') is None
+    assert index.synced_count('All') is None
+
+    index.add('All', [AlbumIndex.row_from_records(*_records(name, date)) for name, date in (('a', 2), ('b', 3), ('c', 1))])
+    index.mark_synced('All', 3)
+
+    assert index.newest('All') == 'b'
+    assert index.synced_count('All') == 3
+    assert index.is_current('All', 3, 'b')
+
+    index.remove(['b'])
+    assert index.newest('All') == 'a'
+    assert index.synced_count('All') == 2
+    index.close()
@@ -0,0 +1,47 @@
+import pytest
+
+from pycloud.journal import TransferJournal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'journal.db')
+
+
+def test_entries_are_resumed_by_the_next_run(path):
+    journal = TransferJournal(path)
+    journal.record('a', TransferJournal.DOWNLOADED, filename='a.jpg', download_path='/staging/a.jpg')
+    journal.record('a', TransferJournal.UPLOADED, drive_id='file')
+    journal.close()
+
+    journal = TransferJournal(path)
+    assert journal.get('a') == {'stage': TransferJournal.UPLOADED, 'filename': 'a.jpg', 'date_path': None,
+                                'download_path': '/staging/a.jpg', 'drive_id': 'file', 'md5': None}
+    assert journal.reached('a', TransferJournal.DOWNLOADED)
+    assert not journal.reached('a', TransferJournal.DELETED)
+    assert journal.stage('b') is None
+    journal.close()
+
+
+def test_updates_are_committed_in_batches(path):
+    journal = TransferJournal(path, batch_size=3, flush_interval=60)
+    other = TransferJournal(path)
+
+    for name in ('a', 'b'):
+        journal.record(name, TransferJournal.DOWNLOADED)
+    other.reload()
+    assert other.get('a') is None
+
+    journal.record('c', TransferJournal.DOWNLOADED)
+    other.reload()
+    assert [other.stage(name) for name in 'abc'] == [TransferJournal.DOWNLOADED] * 3
+    journal.close()
+    other.close()
+
+
+def test_unknown_stage_is_rejected(path):
+    journal = TransferJournal(path)
+
+    with pytest.raises(ValueError):
+        journal.record('a', 'copied')
+    journal.close()
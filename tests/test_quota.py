@@ -0,0 +1,56 @@
+import pytest
+
+from pycloud.quota import QuotaTracker
+
+
+@pytest.fixture
+def quota():
+    fetches = []
+
+    def fetch():
+        fetches.append(None)
+        return {'quotaBytesTotal': '1000', 'quotaBytesUsed': '300', 'quotaBytesUsedInTrash': '100'}
+
+    quota = QuotaTracker(fetch)
+    quota.fetches = fetches
+    return quota
+
+
+def test_reservations_cant_overshoot_the_quota(quota):
+    assert quota.available == 600
+    assert quota.reserve(400)
+    assert not quota.reserve(300)
+    assert quota.fits(300)
+    assert quota.reserve(200)
+    assert quota.available == 0
+
+
+def test_committed_bytes_are_counted_as_used_without_syncing(quota):
+    quota.reserve(400)
+    quota.commit(400)
+
+    assert (quota.used, quota.reserved, quota.available) == (800, 0, 200)
+    assert len(quota.fetches) == 1
+
+
+def test_released_bytes_can_be_reserved_again(quota):
+    quota.reserve(600)
+    quota.release(600)
+
+    assert quota.reserve(600)
+    assert len(quota.fetches) == 1
+
+
+def test_upload_error_syncs_again_on_next_use(quota):
+    quota.reserve(100)
+    quota.release(100, error=True)
+
+    assert quota.available == 600
+    assert len(quota.fetches) == 2
+
+
+def test_snapshot_doesnt_fetch(quota):
+    assert quota.snapshot() is None
+    quota.sync()
+    assert quota.snapshot() == (400, 1000)
+    assert len(quota.fetches) == 1
@@ -0,0 +1,147 @@
+import pytest
+
+from pycloud.ratelimit import AIMDLimiter, RequestScheduler, TokenBucket, classify, rejected
+
+
+class Response:
+    def __init__(self, status_code, **headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+@pytest.fixture
+def scheduler():
+    return RequestScheduler(retries=3, base_delay=0.0)
+
+
+def _responses(*results):
+    results = list(results)
+    calls = []
+
+    def request():
+        calls.append(None)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return request, calls
+
+
+def test_connection_errors_are_transient():
+    assert classify(ConnectionResetError()) == 'transient'
+    assert classify(TimeoutError()) == 'transient'
+    assert classify(ValueError()) is None
+
+
+def test_only_rate_limits_are_rejected():
+    assert rejected(Response(429))
+    assert rejected(Response(403), 'userRateLimitExceeded')
+    assert not rejected(Response(403), 'insufficientPermissions')
+    assert not rejected(Response(503))
+    assert not rejected(ConnectionResetError())
+
+
+def test_idempotent_requests_are_retried_after_a_connection_error(scheduler):
+    request, calls = _responses(ConnectionResetError('reset by peer'), Response(200))
+
+    assert scheduler.call('drive.metadata', request).status_code == 200
+    assert len(calls) == 2
+
+
+def test_creates_are_not_retried_after_a_server_error(scheduler):
+    request, calls = _responses(Response(502), Response(200))
+
+    assert scheduler.call('drive.metadata', request, idempotent=False).status_code == 502
+    assert len(calls) == 1
+
+
+def test_creates_are_not_retried_after_a_connection_error(scheduler):
+    request, calls = _responses(ConnectionResetError('reset by peer'), Response(200))
+
+    with pytest.raises(ConnectionResetError):
+        scheduler.call('drive.metadata', request, idempotent=False)
+    assert len(calls) == 1
+
+
+def test_creates_are_retried_when_rate_limited(scheduler):
+    request, calls = _responses(Response(429), Response(200))
+
+    assert scheduler.call('drive.metadata', request, idempotent=False).status_code == 200
+    assert len(calls) == 2
+
+
+def test_throttled_requests_are_retried_and_cut_the_concurrency_limit(scheduler):
+    request, calls = _responses(Response(429), Response(503), Response(200))
+
+    assert scheduler.call('drive.upload', request).status_code == 200
+    family = scheduler.family('drive.upload')
+    assert family.stats == {'requests': 3, 'throttled': 2, 'retries': 2}
+    assert family.limiter.limit < 4
+
+
+def test_other_errors_are_raised_right_away(scheduler):
+    request, calls = _responses(Response(404), Response(200))
+
+    assert scheduler.call('drive.metadata', request).status_code == 404
+    request, calls = _responses(ValueError('bad request'))
+    with pytest.raises(ValueError):
+        scheduler.call('drive.metadata', request)
+    assert len(calls) == 1
+
+
+def test_throttled_response_is_returned_after_the_last_retry(scheduler):
+    request, calls = _responses(*[Response(429)] * 4)
+
+    assert scheduler.call('icloud.query', request).status_code == 429
+    assert len(calls) == scheduler.retries + 1
+
+
+def test_backoff_honours_retry_after(scheduler):
+    scheduler.max_delay = 30.0
+
+    assert scheduler.backoff(0, Response(429, **{'Retry-After': '7'})) == 7.0
+    assert scheduler.backoff(0, Response(429, **{'Retry-After': '120'})) == 30.0
+
+
+def test_limit_grows_while_requests_succeed():
+    limiter = AIMDLimiter(initial=2, maximum=3)
+
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 3
+
+
+def test_in_flight_throttles_cut_the_limit_once():
+    limiter = AIMDLimiter(initial=8, minimum=1, cooldown=60.0)
+    for _ in range(3):
+        limiter.acquire()
+
+    for _ in range(3):
+        limiter.release(throttled=True)
+    assert limiter.limit == 4
+
+
+def test_limit_isnt_cut_below_the_minimum():
+    limiter = AIMDLimiter(initial=2, minimum=2, cooldown=0.0)
+
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 2
+
+
+def test_slots_are_taken_only_within_the_limit():
+    limiter = AIMDLimiter(initial=1)
+
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release()
+    assert limiter.try_acquire()
+
+
+def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(rate=10.0, burst=2)
+
+    assert bucket.take() == bucket.take() == 0
+    assert 0 < bucket.take() <= 0.1
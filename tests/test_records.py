@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from pycloud import records
+from pycloud.records import AssetRecord, Promoter
+
+
+def _photo(name):
+    return AssetRecord(None, name, f'{name}-master', 0, filename=f'{name}.jpg', size=10)
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Batches looked up, by the first photo of each, and events that hold back a batch's lookup until set"""
+    lookups, blocked = [], {}
+
+    def promote_all(photos, profile='transfer'):
+        names = [photo.record_name for photo in photos]
+        lookups.append(names)
+        if names[0] in blocked:
+            assert blocked[names[0]].wait(5)
+        return {name: f'asset {name}' for name in names if name != 'gone'}
+
+    monkeypatch.setattr(records, 'promote_all', promote_all)
+    return lookups, blocked
+
+
+def test_queued_photos_are_looked_up_together(lookups):
+    lookups, _ = lookups
+    promoter = Promoter(batch_size=2)
+    photos = [_photo(name) for name in ('a', 'b', 'c')]
+    for photo in photos:
+        promoter.add(photo)
+
+    assert [promoter.get(photo) for photo in photos] == ['asset a', 'asset b', 'asset c']
+    assert lookups == [['a', 'b'], ['c']]
+
+
+def test_lookup_only_blocks_workers_waiting_on_its_batch(lookups):
+    lookups, blocked = lookups
+    promoter = Promoter(batch_size=2)
+    a, b, c = (_photo(name) for name in ('a', 'b', 'c'))
+    for photo in (a, b):
+        promoter.add(photo)
+    blocked['a'] = threading.Event()
+
+    results = {}
+    threads = [threading.Thread(target=lambda photo=photo: results.update({photo.id: promoter.get(photo)}))
+               for photo in (a, b)]
+    threads[0].start()
+    while not lookups:
+        pass
+    threads[1].start()
+
+    # c isn't in the lookup in progress, so it's looked up without waiting for it
+    assert promoter.get(c) == 'asset c'
+    assert not results
+
+    blocked['a'].set()
+    for thread in threads:
+        thread.join(5)
+    assert results == {'a': 'asset a', 'b': 'asset b'}
+    assert lookups == [['a', 'b'], ['c']]
+
+
+def test_photo_that_no_longer_exists_raises(lookups):
+    promoter = Promoter()
+
+    with pytest.raises(LookupError):
+        promoter.get(_photo('gone'))
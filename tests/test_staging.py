@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+
+from pycloud.staging import StagingCache
+
+
+def _stage(cache, path, data):
+    """Download a photo into the cache the way the engine does"""
+    assert cache.reserve(len(data))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(cache.part_path(path), 'wb') as f:
+        f.write(data)
+    os.replace(cache.part_path(path), path)
+    cache.add(path, len(data))
+
+
+def _stopped_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+def test_contains_does_not_pin(tmp_path):
+    cache = StagingCache(str(tmp_path), budget=100)
+    path = str(tmp_path / '2020' / '01' / 'a.jpg')
+    _stage(cache, path, b'a' * 60)
+    cache.release(path)
+
+    assert cache.contains(path, 60)
+    assert not cache.contains(path, 61)
+    assert not cache._pinned
+
+    # Unpinned, so it makes room for another photo
+    assert cache.reserve(60)
+    assert not cache.contains(path)
+    assert not os.path.exists(path)
+
+
+def test_get_pins_until_released(tmp_path):
+    cache = StagingCache(str(tmp_path), budget=100, timeout=0.1)
+    path = str(tmp_path / 'a.jpg')
+    _stage(cache, path, b'a' * 60)
+    cache.release(path)
+
+    assert cache.get(path, 60)
+    assert not cache.reserve(60)
+    cache.release(path)
+    assert cache.reserve(60)
+
+
+def test_reserve_times_out_when_pinned_photos_fill_the_budget(tmp_path):
+    cache = StagingCache(str(tmp_path), budget=100, timeout=0.1)
+    _stage(cache, str(tmp_path / 'a.jpg'), b'a' * 60)
+    _stage(cache, str(tmp_path / 'b.jpg'), b'b' * 40)
+
+    assert not cache.reserve(10)
+    assert cache.reserved == 0
+
+
+def test_scan_removes_only_parts_of_stopped_processes(tmp_path):
+    live = tmp_path / f'a.jpg.{os.getppid()}.part'
+    stopped = tmp_path / f'b.jpg.{_stopped_pid()}.part'
+    unowned = tmp_path / 'c.jpg.part'
+    staged = tmp_path / 'd.jpg'
+    for path in (live, stopped, unowned, staged):
+        path.write_bytes(b'x')
+
+    cache = StagingCache(str(tmp_path))
+
+    assert live.exists()
+    assert not stopped.exists()
+    assert not unowned.exists()
+    assert cache.contains(str(staged), 1)
+
+
+def test_part_path_is_scoped_to_the_process(tmp_path):
+    assert StagingCache.part_path('a.jpg') == f'a.jpg.{os.getpid()}.part'
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from pycloud.upload import UploadSessions, query_upload_offset, resumable_upload
+
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(b'a' * 100)
+    return str(path)
+
+
+def test_sessions_are_resumed_by_a_new_process(tmp_path, photo):
+    path = str(tmp_path / 'sessions.json')
+    UploadSessions(path).save(photo, 'https://upload/1')
+
+    sessions = UploadSessions(path)
+    assert sessions.get(photo) == 'https://upload/1'
+    sessions.remove(photo)
+    assert UploadSessions(path).get(photo) is None
+
+
+def test_session_of_a_changed_file_isnt_resumed(tmp_path, photo):
+    sessions = UploadSessions(str(tmp_path / 'sessions.json'))
+    sessions.save(photo, 'https://upload/1')
+
+    with open(photo, 'ab') as f:
+        f.write(b'b')
+    assert sessions.get(photo) is None
+
+
+def test_processes_sharing_the_file_keep_each_others_sessions(tmp_path, photo):
+    other = tmp_path / 'b.jpg'
+    other.write_bytes(b'b' * 100)
+    path = str(tmp_path / 'sessions.json')
+    first, second = UploadSessions(path), UploadSessions(path)
+
+    first.save(photo, 'https://upload/1')
+    second.save(str(other), 'https://upload/2')
+    second.remove(str(other))
+
+    with open(path) as f:
+        assert list(json.load(f).values()) == ['https://upload/1']
+
+
+class Resp(dict):
+    def __init__(self, status, **headers):
+        super().__init__(headers)
+        self.status = status
+
+
+class Http:
+    def __init__(self, resp, content=b''):
+        self.resp = resp
+        self.content = content
+
+    def request(self, uri, method, headers):
+        assert headers['Content-Range'] == 'bytes */100'
+        return self.resp, self.content
+
+
+@pytest.mark.parametrize('resp, content, expected', [
+    (Resp(308, range='bytes=0-49'), b'', (50, None)),
+    (Resp(308), b'', (0, None)),
+    (Resp(200), b'{"id": "file"}', (100, {'id': 'file'})),
+    (Resp(404), b'', (None, None)),
+])
+def test_query_upload_offset(resp, content, expected):
+    assert query_upload_offset(Http(resp, content), 'https://upload/1', 100) == expected
+
+
+class Request:
+    def __init__(self, chunks, resumable_uri=None):
+        self.chunks = chunks
+        self.resumable_uri = resumable_uri
+
+    def next_chunk(self, http=None, num_retries=0):
+        self.resumable_uri = 'https://upload/new'
+        self.chunks -= 1
+        return None, ({'id': 'file'} if not self.chunks else None)
+
+
+def test_new_session_is_saved_once():
+    sessions = []
+
+    assert resumable_upload(Request(3), on_session=sessions.append) == {'id': 'file'}
+    assert sessions == ['https://upload/new']
+
+
+def test_resumed_session_isnt_saved_again():
+    sessions = []
+
+    resumable_upload(Request(2, resumable_uri='https://upload/1'), on_session=sessions.append)
+    assert sessions == []
@@ -0,0 +1,73 @@
+import base64
+
+import pytest
+
+pytest.importorskip('pyicloud_ipd', reason='pycloud.watch lists photos through pycloud.utils, which needs pyicloud_ipd')
+
+from pycloud.watch import ChangeWatcher  # noqa: E402
+
+
+def _asset(name, master):
+    return {'recordName': name, 'recordType': 'CPLAsset',
+            'fields': {'assetDate': {'value': 1.6e12}, 'masterRef': {'value': {'recordName': master}}}}
+
+
+def _master(name):
+    return {'recordName': name, 'recordType': 'CPLMaster',
+            'fields': {'filenameEnc': {'value': base64.b64encode(f'{name}.jpg'.encode()).decode()},
+                       'resOriginalRes': {'value': {'size': 10}}}}
+
+
+class Album:
+    page_size = 100
+
+    def _lookup(self, names, profile):
+        return {name: _master(name) for name in names}
+
+
+@pytest.fixture
+def watcher(tmp_path, monkeypatch):
+    watcher = ChangeWatcher(Album(), str(tmp_path / 'token.json'))
+    watcher.token.save('t0')
+    changes = {'t0': ([_asset('a1', 'm1'), _master('m1'), _asset('a2', 'm2')], 't1'), 't1': ([], 't1')}
+    monkeypatch.setattr(watcher, '_changes', lambda token: iter([changes[token]]))
+    return watcher
+
+
+def test_token_is_kept_when_transfer_raises(watcher):
+    def transfer(photos):
+        raise ConnectionError('reset by peer')
+
+    with pytest.raises(ConnectionError):
+        watcher.step(transfer)
+    assert watcher.token.value == 't0'
+
+
+def test_failed_photos_are_queued_again(watcher):
+    transferred = []
+
+    def transfer(photos):
+        transferred.append(sorted(photo.id for photo in photos))
+        return photos[:1]
+
+    watcher.step(transfer)
+
+    assert transferred == [['a1', 'a2']]
+    assert watcher.token.value == 't1'
+    assert list(watcher._requeued) == ['a1']
+
+
+def test_skipped_photos_are_retried_after_the_token_moves_on(watcher):
+    transferred = []
+
+    def transfer(photos):
+        transferred.append(sorted(photo.id for photo in photos))
+        # a2 doesn't fit in the Drive quota this time
+        return [photo for photo in photos if photo.id == 'a2'] if len(transferred) == 1 else []
+
+    watcher.step(transfer)
+    assert watcher.token.value == 't1'
+    watcher.step(transfer)
+
+    assert transferred == [['a1', 'a2'], ['a2']]
+    assert not watcher._requeued
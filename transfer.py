@@ -1,26 +1,92 @@
 import os
 import sys
+import json
+import socket
 import datetime
 
-from tzlocal import get_localzone
-from icloudpd.download import download_media
-
-from pycloud import gDrive, iCloud, PyCloudLogger
+from pycloud import (
+    gDrive, iCloud, PyCloudLogger, TransferEngine, TransferJournal, TransferPlanner, StagingCache, ChangeWatcher,
+    RequestScheduler, Metrics
+)
+from pycloud.logger import setup_logging
+from pycloud.metrics import MetricsServer, TextfileWriter
+from pycloud.shard import LeaseStore, ShardRunner, make_shards
 
 USERNAME = None
 PASSWORD = None
 COOKIE_DIR = '~/.pyicloud'
 DOWNLOAD_DIR = './Photos'
 FOLDER_STRUCTURE = '{:%Y/%m}'
+INDEX_PATH = 'pycloud_index.db'  # Local album index used to answer date range queries; None to disable
+# Rebuild the index by listing the whole album when it can't be brought up to date by listing only the photos
+# added since the last run. Otherwise FROM-TO is found with a binary search over the album instead
+REBUILD_INDEX = False
+JOURNAL_PATH = 'pycloud_journal.db'  # Record of completed transfer stages, so re-runs skip finished work
+
+ALBUM = None  # Name of the album to transfer; None to be asked for it
 
 FROM = datetime.date(2020, 1, 1)
 TO = datetime.date(2020, 2, 1)
 
-drive = gDrive()
+# Plan mode ("python transfer.py plan") only reports the photos, bytes, folders, quota, requests and ETA of the
+# transfer, from photo metadata alone, then exits without transferring anything
+PLAN = len(sys.argv) > 1 and sys.argv[1] == 'plan'
+PLAN_PATH = 'pycloud_plan.json'  # JSON copy of the plan; None to disable
+THROUGHPUT = {}  # Bytes per second of one worker of each stage, e.g. {'stream': 4 * 1024 ** 2}. Stages left
+# out are measured from METRICS_SUMMARY of the last run, if there is one
+
+# Watch mode ("python transfer.py watch") keeps running, and transfers the photos added to the library since
+# the last poll, as reported by iCloud's change feed, instead of the photos from FROM to TO
+WATCH = len(sys.argv) > 1 and sys.argv[1] == 'watch'
+WATCH_INTERVAL = 300  # Seconds between polls of the change feed
+SYNC_TOKEN_PATH = 'pycloud_sync_token.json'  # Position in the change feed, so watching resumes after a restart
+
+# Sharded mode splits FROM-TO into one shard per FOLDER_STRUCTURE folder (e.g. a month for "{:%Y/%m}"), which
+# any number of processes, on any number of hosts sharing LEASE_PATH, claim and transfer one at a time
+SHARD = False
+LEASE_PATH = 'pycloud_leases.db'
+LEASE_SECONDS = 900  # A shard whose process stops renewing its lease for this long is claimed again
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+
+# Concurrency limits for each stage of the transfer, and max jobs waiting between stages
+DOWNLOAD_WORKERS = 4
+UPLOAD_WORKERS = 4
+DELETE_WORKERS = 2
+QUEUE_SIZE = 8
+DELETE_BATCH_SIZE = 100  # Photos deleted from iCloud per request
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes per resumable upload request, a multiple of 256 KiB
+STREAM = True  # Stream downloads straight into uploads instead of saving them to DOWNLOAD_DIR first
+STAGING_DIR = os.path.join(DOWNLOAD_DIR, 'PyCloud Staging')  # Where photos wait to be uploaded when not streamed.
+# In sharded mode each process stages photos in its own WORKER_ID subdirectory, within its own STAGING_BUDGET
+STAGING_BUDGET = 4 * 1024 ** 3  # Max bytes of photos staged at once; they're kept until their upload is verified
+RATE_LIMITS = {}  # Overrides of the rate, burst and starting concurrency of each endpoint family, e.g.
+# {'drive.upload': {'rate': 5.0, 'burst': 10, 'concurrency': 4}}. See pycloud.ratelimit.DEFAULT_LIMITS
+METRICS_PORT = None  # Port to serve Prometheus metrics on at http://127.0.0.1:<port>/metrics; None to disable
+METRICS_TEXTFILE = None  # Path of a .prom file for the node_exporter textfile collector; None to disable
+METRICS_SUMMARY = 'pycloud_metrics.json'  # JSON summary of the metrics, written at the end of the run
+LOG_PATH = 'pycloud.log'  # Log of the run, with DEBUG records that stdout leaves out
+
+setup_logging(LOG_PATH)
+
+metrics = Metrics()
+exporters = []
+if METRICS_PORT:
+    exporters.append(MetricsServer(metrics, METRICS_PORT).start())
+if METRICS_TEXTFILE:
+    exporters.append(TextfileWriter(metrics, METRICS_TEXTFILE).start())
+
+# Shared by both services, so every request is paced and backed off against the same limits
+scheduler = RequestScheduler(RATE_LIMITS, metrics=metrics)
+
+# Authenticating with Drive and mapping its folders happens in the background, while iCloud logs in
+drive = gDrive(chunk_size=UPLOAD_CHUNK_SIZE, scheduler=scheduler)
+drive.warm_up()
 cloud = iCloud(
     cookie_dir=COOKIE_DIR,
     download_dir=DOWNLOAD_DIR,
-    folder_structure=FOLDER_STRUCTURE).login(
+    folder_structure=FOLDER_STRUCTURE,
+    index_path=INDEX_PATH,
+    scheduler=scheduler).login(
     USERNAME,
     PASSWORD
 )
@@ -30,7 +96,7 @@ log = PyCloudLogger(name='transfer.py')
 while True:
     try:
         # album = cloud.get_album('All Photos')
-        album = cloud.get_album(input('Enter an album name:\n>'))
+        album = cloud.get_album(ALBUM or input('Enter an album name:\n>'))
         if album:
             cloud.info(f'Retrieved album {album.name}')
             break
@@ -38,71 +104,113 @@ while True:
         log.info('Exiting script')
         sys.exit(0)
 
-photos = album.fetch_photos(date_start=FROM, date_end=TO)
-cloud.info(f'Fetched photos from {album.name}')
-
-# All directories will be made by the icloudpd.download.download_media() function
-download_dir = os.path.join(cloud.download_dir,
-                            f'PyCloud Photo Transfer {datetime.datetime.today().date()}')
+# Watch mode doesn't list the album, so it doesn't need the index
+if not WATCH and album.index is not None and not album.index_is_current():
+    added = album.update_index()
+    if added is not None:
+        cloud.info(f'Indexed {added} new photos from {album.name}')
+    elif REBUILD_INDEX:
+        cloud.info(f'Indexed {album.sync_index()} photos from {album.name}')
+    else:
+        log.info(f'Index of {album.name} is out of date, so photos are found with a binary search. '
+                 f'Set REBUILD_INDEX to rebuild it')
+
+if PLAN:
+    planner = TransferPlanner(
+        cloud,
+        drive,
+        download_workers=DOWNLOAD_WORKERS,
+        upload_workers=UPLOAD_WORKERS,
+        queue_size=QUEUE_SIZE,
+        stream=STREAM,
+        delete_batch_size=DELETE_BATCH_SIZE,
+        throughput=THROUGHPUT,
+        metrics_summary=METRICS_SUMMARY
+    )
+    plan = planner.plan(album, FROM, TO)
+    for line in plan.report():
+        log.info(line)
+    if PLAN_PATH:
+        with open(PLAN_PATH, 'w') as f:
+            json.dump(plan.summary(), f, indent=2, default=str)
+        log.info(f'Wrote plan to {PLAN_PATH}')
+    sys.exit(0)
+
+engine = TransferEngine(
+    cloud,
+    drive,
+    download_workers=DOWNLOAD_WORKERS,
+    upload_workers=UPLOAD_WORKERS,
+    delete_workers=DELETE_WORKERS,
+    queue_size=QUEUE_SIZE,
+    delete_batch_size=DELETE_BATCH_SIZE,
+    stream=STREAM,
+    journal=TransferJournal(JOURNAL_PATH),
+    metrics=metrics,
+    staging=StagingCache(os.path.join(STAGING_DIR, WORKER_ID) if SHARD else STAGING_DIR, STAGING_BUDGET)
+)
 
-success, failed = [], []
-for photo in photos:
-    if photo.size > drive.available_storage:
-        # If not enough space, go to the next photo/video as it might be small enough
-        continue
+if SHARD:
+    store = LeaseStore(LEASE_PATH, lease_seconds=LEASE_SECONDS)
+    store.add(make_shards(FROM, TO, FOLDER_STRUCTURE))
+    success, failed = [], []
+
+    def transfer_shard(shard):
+        # Other processes delete photos from the album as they transfer their shards, and a shard whose lease
+        # expired may have been partly transferred by another process
+        album.refresh()
+        engine.journal.reload()
+        # Every photo of a shard goes to the folder it's named after
+        shard_success, shard_failed = engine.run(
+            album.fetch_photos(date_start=shard.start, date_end=shard.end, profile='transfer', compact=True),
+            folders={shard.key})
+        success.extend(shard_success)
+        failed.extend(shard_failed)
+        return not shard_failed
+
+    completed = ShardRunner(store, WORKER_ID).run(transfer_shard)
+    log.info(f'{WORKER_ID} completed {completed} shards')
+    store.close()
+elif WATCH:
+    watcher = ChangeWatcher(album, SYNC_TOKEN_PATH)
+    success, failed = [], []
+
+    def transfer_changes(photos):
+        batch_success, batch_failed = engine.run(photos, folders=cloud.date_paths(photos))
+        success.extend(batch_success)
+        # Photos that failed are tried again with the next poll, so only the latest ones are still failed
+        failed[:] = batch_failed
+        # Skipped photos are queued again too, since the sync token moves past them once it's saved
+        return batch_failed + engine.skipped
 
     try:
-        created_date = photo.created.astimezone(get_localzone())
-    except (ValueError, OSError):
-        log.error(
-            "Could not convert photo created date to local timezone (%s)" % photo.created)
-        created_date = photo.created
-
-    date_path = cloud.folder_structure.format(created_date)
-    download_path = os.path.normpath(os.path.join(download_dir, date_path, photo.filename))
-
-    downloaded = download_media(
-        cloud.api,
-        photo,
-        download_path,
-        size='original'
-    )
-    if downloaded:
-        cloud.info("Downloaded {} to {}".format(
-                photo.filename,
-                date_path))
-    else:
-        log.error(f"Failed to download photo {photo.filename} from iCloud")
-        failed.append(photo)
-        continue
-
-    upload_id = drive.get_date_folder(date_path)
-    file = drive.add_file(download_path, parent_id=upload_id)
-    if not file.uploaded:
-        log.error(
-            f'Failed to upload photo {photo.filename} to Google Drive folder {date_path}'
-        )
-        failed.append(photo)
-        file = None
-        os.remove(download_path)
-        continue
+        watcher.watch(transfer_changes, WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        log.info('Stopped watching')
+else:
+    # Photos are kept as compact records, and only promoted to full PhotoAssets when they're downloaded
+    photos = album.fetch_photos(date_start=FROM, date_end=TO, profile='transfer', compact=True)
+    cloud.info(f'Fetched photos from {album.name}')
 
-    else:
-        drive.info(f'Uploaded {photo.filename} to folder {date_path}')
-        file = None
-        os.remove(download_path)
+    # With a current index, the folders the photos go to are known without paging through the album
+    folders = None
+    if album.index_is_current():
+        folders = cloud.date_paths(album.fetch_photos(date_start=FROM, date_end=TO, simple=True))
 
-    deleted = cloud.delete_photo(photo)
-    if not deleted:
-        failed.append(photo)
+    success, failed = engine.run(photos, folders=folders)
 
 log.info(f'Finish transferring photos from album {album.name}')
+log.debug('Album paging: %(pages)d pages, %(bytes)d bytes, %(request_seconds).2fs requests, '
+          '%(parse_seconds).2fs parsing', album.page_stats)
+log.debug('Requests: %s', scheduler.stats())
+for exporter in exporters:
+    exporter.close()
+if METRICS_SUMMARY:
+    metrics.write_summary(METRICS_SUMMARY)
+    log.info(f'Wrote metrics summary to {METRICS_SUMMARY}')
 if failed:
     for content in failed:
         log.debug('Failed: %s' % content.id)
 
 log.info('Exiting script...')
 sys.exit(0)
-
-
-